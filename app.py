@@ -1,39 +1,88 @@
-import pandas as pd
-import openpyxl
-from openpyxl import load_workbook
-from openpyxl.styles import Alignment, numbers
-from openpyxl.utils import get_column_letter
+import time
+# Measured from the first import so the reported startup time includes module loading
+_startup_started = time.perf_counter()
 import os
 import io
 import base64
+import cProfile
+import gzip
+import json
+import multiprocessing
+import pickle
+import pstats
 import re
-import tempfile
 import shutil
+import tempfile
+import threading
+import uuid
+import zipfile
 import atexit # For cleanup
+import gc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, send_from_directory, abort, stream_with_context
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
 import logging
+from processor import (
+    FinancialStatementProcessor, ResultCache, StageMetrics, StatementScreener, StatementStore, UploadedFile,
+    WorkbookStore, _input_name, columnar_statements, configure_logging,
+)
 
-# Configure basic logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Configure logging: LOG_LEVEL (INFO; DEBUG adds per-step and per-formula detail), LOG_FORMAT
+# (text or json) and LOG_QUEUE (1 = written by a background thread, 0 = directly by the caller)
+configure_logging(os.environ.get('LOG_LEVEL', 'INFO').upper(), os.environ.get('LOG_FORMAT', 'text'),
+                  use_queue=os.environ.get('LOG_QUEUE', '1') == '1')
 
 # --- Flask App Setup ---
 app = Flask(__name__)
 # IMPORTANT: Change this to a random secret key for production
 app.config['SECRET_KEY'] = 'a81caae88add9d287d582423cfa6f8c8402083945dd5bade' # CHANGE THIS!
-# Define a temporary directory for uploads within the instance folder
-UPLOAD_FOLDER = os.path.join(app.instance_path, 'uploads')
-# Ensure the instance folder and upload folder exist
+# Uploads are processed in memory; the instance folder holds templates, jobs and caches
 try:
     os.makedirs(app.instance_path, exist_ok=True)
-    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-    logging.info(f"Upload folder created/ensured at: {UPLOAD_FOLDER}")
+    logging.info(f"Instance folder created/ensured at: {app.instance_path}")
 except OSError as e:
-    logging.error(f"Could not create upload folder: {e}")
+    logging.error(f"Could not create instance folder: {e}")
     # Depending on severity, you might want to exit or handle this differently
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 # 16 MB limit for uploads
+# Background job mode: uploads return a job id at once and are processed in a bounded process pool
+app.config['ASYNC_JOBS'] = os.environ.get('ASYNC_JOBS', '0') == '1'
+app.config['JOB_MAX_WORKERS'] = int(os.environ.get('JOB_MAX_WORKERS', 2)) # Concurrent jobs per app process
+app.config['JOB_MAX_QUEUE'] = int(os.environ.get('JOB_MAX_QUEUE', 16)) # Queued + running jobs per app process
+app.config['JOB_RESULT_TTL'] = int(os.environ.get('JOB_RESULT_TTL', 3600)) # Seconds to keep finished jobs
+app.config['JOB_FOLDER'] = os.path.join(app.instance_path, 'jobs')
+# Result cache: in-memory LRU entries per process, plus an optional on-disk tier (0 MB = disabled)
+app.config['RESULT_CACHE_ENTRIES'] = int(os.environ.get('RESULT_CACHE_ENTRIES', 64))
+app.config['RESULT_CACHE_DISK_MB'] = int(os.environ.get('RESULT_CACHE_DISK_MB', 0))
+# Tickers whose last evaluation is kept per process, so a changed re-upload only recomputes what changed (0 = off)
+app.config['EVALUATION_CACHE_ENTRIES'] = int(os.environ.get('EVALUATION_CACHE_ENTRIES', 16))
+# Downloadable workbooks: unserialized workbooks kept per process, and disk space for saved ones
+app.config['WORKBOOK_STORE_ENTRIES'] = int(os.environ.get('WORKBOOK_STORE_ENTRIES', 4))
+app.config['WORKBOOK_STORE_DISK_MB'] = int(os.environ.get('WORKBOOK_STORE_DISK_MB', 256))
+# Disk space for the uploads behind those workbooks, so any worker can rebuild one it did not build.
+# Every upload is then written to disk on the request path (0 MB = disabled)
+app.config['WORKBOOK_INPUTS_DISK_MB'] = int(os.environ.get('WORKBOOK_INPUTS_DISK_MB', 0))
+# Gunicorn worker processes (see gunicorn.conf.py). With more than one, a download can reach a worker that
+# did not build the workbook, so workbooks are saved to the disk tier when they are built instead of on download
+app.config['WEB_WORKERS'] = int(os.environ.get('WEB_CONCURRENCY', 1))
+# Per-stage metrics for /metrics; each process writes its counts here so any worker can report them all
+app.config['METRICS_FOLDER'] = os.path.join(app.instance_path, 'metrics')
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN') # If set, /metrics requires "Authorization: Bearer <token>"
+# Profiling: PROFILE_REQUESTS=1 profiles every upload; with PROFILE_TOKEN set, an upload sending
+# "X-Profile-Token: <token>" is profiled on its own. Either way the stats land in PROFILE_FOLDER, and
+# /profiles only lists and serves them with the token (without one they stay on disk only).
+app.config['PROFILE_REQUESTS'] = os.environ.get('PROFILE_REQUESTS', '0') == '1'
+app.config['PROFILE_TOKEN'] = os.environ.get('PROFILE_TOKEN')
+app.config['PROFILE_FOLDER'] = os.path.join(app.instance_path, 'profiles')
+app.config['PROFILE_KEEP'] = int(os.environ.get('PROFILE_KEEP', 50)) # Newest profiles kept on disk
+# Bulk mode: a ZIP of many tickers' CSV triples, processed in parallel with results streamed back
+app.config['BULK_MAX_WORKERS'] = int(os.environ.get('BULK_MAX_WORKERS', os.cpu_count() or 1))
+app.config['BULK_MAX_TICKERS'] = int(os.environ.get('BULK_MAX_TICKERS', 500))
+app.config['BULK_MAX_UNCOMPRESSED_MB'] = int(os.environ.get('BULK_MAX_UNCOMPRESSED_MB', 256)) # Guards against zip bombs
+# Statement store: every processed ticker's cleaned and computed values, kept across restarts (empty = disabled)
+app.config['STATEMENT_STORE_PATH'] = os.environ.get('STATEMENT_STORE_PATH', '')
 
 # ========== PASTE YOUR BASE64 MASTER FILE HERE ==========
 # Replace the placeholder comment and the empty string below
@@ -43,10 +92,11 @@ TEMPLATE_DATA = "" # PASTE YOUR ACTUAL BASE64 STRING HERE!
 
 # --- Global variable for the decoded template path ---
 _temp_template_path = None
+_temp_template_owner_pid = None # Forked workers (gunicorn --preload, job pool) share the file but must not delete it
 
 def decode_master_template():
     """Decodes the base64 template string into a temporary Excel file path."""
-    global _temp_template_path # To store the path globally
+    global _temp_template_path, _temp_template_owner_pid # To store the path globally
     if _temp_template_path and os.path.exists(_temp_template_path):
         logging.info("Temporary template already exists.")
         return _temp_template_path # Return existing path if already decoded
@@ -71,6 +121,7 @@ def decode_master_template():
             template_path = temp_excel_file.name
             temp_excel_file.write(decoded_bytes)
         _temp_template_path = template_path # Store the path globally
+        _temp_template_owner_pid = os.getpid()
         logging.info(f"Decoded template saved to temporary file: {template_path}")
         return template_path
     except base64.binascii.Error as b64_error:
@@ -100,6 +151,8 @@ def decode_master_template():
 def cleanup_temp_template_on_exit():
     """Function to clean up the temporary template file on application exit."""
     global _temp_template_path
+    if _temp_template_owner_pid != os.getpid():
+        return # Only the process that decoded the template removes it
     if _temp_template_path and os.path.exists(_temp_template_path):
         try:
             os.remove(_temp_template_path)
@@ -120,649 +173,460 @@ def cleanup_temp_template_on_exit():
 # --- Register cleanup function to run when the application exits ---
 atexit.register(cleanup_temp_template_on_exit)
 
-# --- Financial Processor Class (Adapted for Web) ---
-class FinancialStatementProcessor:
-    # Keep most methods as they are, just add data extraction
-    def __init__(self, template_path):
-        self.template_path = template_path
-        self.wb_template_structure = None # Store the initial template structure
+# --- Request Profiling ---
+class RequestProfiler:
+    """
+    Runs a call under cProfile and saves the stats as <name>.pstats (load with pstats or
+    snakeviz) plus <name>.txt, the top functions by cumulative time. Only the newest `keep`
+    profiles are kept. Nothing is set up unless a call is actually profiled.
+    """
+    NAME_PATTERN = re.compile(r"^[0-9]{8}-[0-9]{6}_[A-Za-z0-9_.-]+\.(pstats|txt)$")
+
+    def __init__(self, folder, keep=50):
+        self.folder = folder
+        self.keep = keep
+
+    def run(self, label, func, *args, **kwargs):
+        profile = cProfile.Profile()
+        started = time.perf_counter()
         try:
-            # Load the template structure once during initialization
-            self.wb_template_structure = self.load_template_from_path(data_only=False)
-            self.validate_template_sheets(self.wb_template_structure)
-        except Exception as e:
-            logging.error(f"Processor Initialization failed: {e}")
-            # No need to call cleanup_temp_template here, atexit handles it
-            raise e # Re-raise to prevent app start if processor fails
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self._save(profile, label, time.perf_counter() - started)
 
-    def load_template_from_path(self, data_only=False):
+    def _save(self, profile, label, elapsed):
         try:
-            if not os.path.exists(self.template_path):
-                raise FileNotFoundError(f"Template not found: {self.template_path}")
-            # Load a fresh copy each time processing happens if modifying it
-            wb = load_workbook(self.template_path, data_only=data_only)
-            logging.info(f"Loaded template structure from: {self.template_path} (data_only={data_only})")
-            return wb
-        except Exception as e:
-            logging.error(f"Error loading template: {e}")
-            raise Exception(f"Error loading template: {e}")
-
-    def validate_template_sheets(self, wb_to_check):
-        required = ["Income Statement", "Balance Sheet", "Cash Flow Statement"]
-        available_sheets = wb_to_check.sheetnames
-        for sheet in required:
-            if sheet not in available_sheets:
-                logging.error(f"Template sheet validation failed. Missing: '{sheet}'. Available: {available_sheets}")
-                raise ValueError(f"Required sheet '{sheet}' missing in template. Available: {available_sheets}")
-        logging.info("Template sheets validated successfully.")
-
-    def load_csv(self, file_path, sheet_name):
-        try:
-            logging.info(f"Loading CSV: {os.path.basename(file_path)} for sheet {sheet_name}")
-            df = pd.read_csv(file_path)
-            logging.info(f"Successfully loaded CSV: {os.path.basename(file_path)}")
-            return df
-        except FileNotFoundError:
-            logging.error(f"CSV not found: {file_path}")
-            raise FileNotFoundError(f"CSV file not found: {os.path.basename(file_path)}")
-        except pd.errors.EmptyDataError:
-            logging.warning(f"CSV file is empty: {file_path}")
-            # Return an empty DataFrame instead of raising an error immediately
-            return pd.DataFrame()
-        except Exception as e:
-            logging.error(f"Error reading CSV {file_path}: {e}")
-            raise Exception(f"Error reading CSV {os.path.basename(file_path)}: {e}")
-
-    def clean_data(self, df, sheet_name):
-        if df.empty:
-             logging.warning(f"Skipping cleaning for empty DataFrame: {sheet_name}")
-             return df
-        logging.info(f"Cleaning data for sheet: {sheet_name}")
-        df.columns = df.columns.str.strip()
-        if df.columns.tolist() and len(df.columns) >= 1:
+            os.makedirs(self.folder, exist_ok=True)
+            name = f"{datetime.now():%Y%m%d-%H%M%S}_{secure_filename(label) or 'upload'}_{os.getpid()}_{uuid.uuid4().hex[:6]}"
+            profile.dump_stats(os.path.join(self.folder, f"{name}.pstats"))
+            with open(os.path.join(self.folder, f"{name}.txt"), 'w') as summary_file:
+                summary_file.write(f"{label}: {elapsed:.3f}s wall time (pid {os.getpid()})\n\n")
+                pstats.Stats(profile, stream=summary_file).sort_stats('cumulative').print_stats(40)
+            logging.info(f"Saved profile {name} ({elapsed:.3f}s)")
+            self._prune()
+        except OSError as e:
+            logging.warning(f"Could not save profile for {label}: {e}")
+
+    def _prune(self):
+        profiles = sorted(name for name in os.listdir(self.folder) if name.endswith('.pstats'))
+        for name in profiles[:-self.keep] if self.keep > 0 else profiles:
+            for suffix in ('.pstats', '.txt'):
+                try: os.remove(os.path.join(self.folder, name[:-len('.pstats')] + suffix))
+                except OSError: pass
+
+    def list(self):
+        """Saved profiles, newest first: [{'name', 'created', 'size', 'summary'}]."""
+        if not os.path.isdir(self.folder):
+            return []
+        entries = []
+        for name in sorted(os.listdir(self.folder), reverse=True):
+            if not (name.endswith('.pstats') and self.NAME_PATTERN.match(name)):
+                continue
+            base = name[:-len('.pstats')]
             try:
-                # Ensure the first column exists before trying to access iloc[:, 0]
-                if df.shape[1] > 0:
-                    df.iloc[:, 0] = df.iloc[:, 0].astype(str).str.replace(r"^\s+|\s+$|\t", "", regex=True)
-                else:
-                     logging.warning(f"DataFrame for {sheet_name} has no columns, skipping first column cleaning.")
-            except Exception as e:
-                logging.warning(f"Warning: Cleaning the first column failed for {sheet_name}: {e}")
-        # Drop rows where ALL columns are NaN
-        df.dropna(how='all', inplace=True)
-        logging.info(f"Finished cleaning data for sheet: {sheet_name}. Shape: {df.shape}")
-        return df
-
-    def append_data_to_excel(self, df, wb, sheet_name, start_row):
-        if sheet_name not in wb.sheetnames:
-             logging.error(f"Sheet '{sheet_name}' not found in workbook during append.")
-             raise ValueError(f"Sheet '{sheet_name}' not found.")
-
-        ws = wb[sheet_name]
-        target_start_row = start_row
-        # Find the first truly empty row starting from 'start_row'
-        current_row_check = start_row
-        while current_row_check <= ws.max_row + 5: # Check a bit beyond max_row just in case
-            row_has_data = False
-            # Check only first few columns for performance maybe? Let's check all for now.
-            for cell in ws[current_row_check]:
-                if cell.value is not None and str(cell.value).strip() != "":
-                    row_has_data = True
-                    break
-            if not row_has_data:
-                 # Check if the next few rows are also empty to confirm end of data
-                 all_next_empty = True
-                 for next_row_offset in range(1, 4):
-                    next_row_idx = current_row_check + next_row_offset
-                    # Only check within actual sheet bounds if possible
-                    if next_row_idx <= ws.max_row:
-                         for cell in ws[next_row_idx]:
-                              if cell.value is not None and str(cell.value).strip() != "":
-                                   all_next_empty = False
-                                   break
-                    if not all_next_empty: break # Stop checking next rows if one has data
-                 if all_next_empty:
-                     target_start_row = current_row_check
-                     break # Found the start of the empty block
-
-            current_row_check += 1
-
-        # If loop finished without finding an empty block, append after last row with data
-        if current_row_check > ws.max_row + 5:
-             actual_max_row = 1 # Default to 1 if sheet is completely empty initially
-             for row in ws.iter_rows(min_row=1, max_col=ws.max_column, max_row=ws.max_row):
-                  row_contains_data = False
-                  for cell in row:
-                       if cell.value is not None and str(cell.value).strip() != "":
-                            row_contains_data = True
-                            break
-                  if row_contains_data:
-                       actual_max_row = row[0].row # Get row index from the first cell of the row
-             target_start_row = actual_max_row + 1
-             logging.info(f"Could not find empty block, determined last data row as {actual_max_row}, appending from {target_start_row}")
-
-
-        logging.info(f"Determined append start row for '{sheet_name}' as {target_start_row}")
-
-        if df.empty:
-            logging.warning(f"DataFrame for '{sheet_name}' is empty. Skipping append.")
-            return # Don't try to append an empty dataframe
-
-        logging.info(f"Appending {len(df)} rows to '{sheet_name}' starting at row {target_start_row}")
-
-        for r_offset, row_data_tuple in enumerate(df.itertuples(index=False, name=None)):
-            current_ws_row = target_start_row + r_offset
-            # Ensure we don't write beyond reasonable column limits
-            max_cols_to_write = min(len(row_data_tuple), 50) # Limit writing width
-            for c_offset, value in enumerate(row_data_tuple[:max_cols_to_write], start=1):
-                # Defensive check for row/column indices (should be okay here but safe)
-                if current_ws_row > openpyxl.worksheet.worksheet.Worksheet.max_row or c_offset > openpyxl.worksheet.worksheet.Worksheet.max_column:
-                    logging.warning(f"Skipping write beyond max excel limits at R{current_ws_row}C{c_offset} in sheet {sheet_name}")
-                    continue
+                stat = os.stat(os.path.join(self.folder, name))
+                with open(os.path.join(self.folder, f"{base}.txt")) as summary_file:
+                    summary = summary_file.readline().strip()
+            except OSError:
+                continue
+            entries.append({'name': base, 'created': datetime.fromtimestamp(stat.st_mtime).isoformat(timespec='seconds'),
+                            'size': stat.st_size, 'summary': summary})
+        return entries
 
-                cell_to_write = ws.cell(row=current_ws_row, column=c_offset)
-                try:
-                    if pd.isna(value):
-                        cell_to_write.value = None
-                    elif isinstance(value, str):
-                        # Attempt to convert numeric strings
-                        cleaned_value = value.replace(',', '').strip()
-                        if not cleaned_value: # Handle empty strings
-                             cell_to_write.value = None
-                             continue
-                        try:
-                            # Check for parentheses indicating negative numbers
-                            is_negative = False
-                            if cleaned_value.startswith('(') and cleaned_value.endswith(')'):
-                                cleaned_value = cleaned_value[1:-1]
-                                is_negative = True
-
-                            if '.' in cleaned_value:
-                                num_value = float(cleaned_value)
-                            else:
-                                num_value = int(cleaned_value)
-
-                            cell_to_write.value = -num_value if is_negative else num_value
-                            cell_to_write.number_format = numbers.FORMAT_NUMBER_00 # Apply basic format
-                        except ValueError:
-                            # If conversion fails, keep as string
-                            cell_to_write.value = value
-                    elif isinstance(value, (int, float)):
-                         cell_to_write.value = value
-                         cell_to_write.number_format = numbers.FORMAT_NUMBER_00 # Apply basic format
-                    elif isinstance(value, datetime):
-                         cell_to_write.value = value
-                         cell_to_write.number_format = numbers.FORMAT_DATE_YYYYMMDD2 # Apply date format
-                    else:
-                         # Try converting other types to string as fallback
-                         cell_to_write.value = str(value)
 
-                except Exception as cell_write_error:
-                    logging.error(f"Error writing cell (R{current_ws_row}, C{c_offset}) for sheet '{sheet_name}': {cell_write_error}. Value: {repr(value)}")
-                    try:
-                        cell_to_write.value = str(value) # Fallback to string representation
-                    except:
-                        cell_to_write.value = "WRITE_ERROR" # Final fallback
-
-        # Apply alignment formatting after appending all data for this sheet
-        self.apply_formatting(ws, target_start_row, len(df))
-
-
-    def apply_formatting(self, ws, start_row, num_rows):
-        if num_rows <= 0: return
-        end_row = start_row + num_rows - 1
-        logging.info(f"Applying alignment formatting to '{ws.title}' rows {start_row}-{end_row}")
-        max_col_to_format = min(ws.max_column + 1, 50) # Limit formatting width
-
-        for row_idx in range(start_row, end_row + 1):
-            # Check row existence defensively
-            if row_idx > openpyxl.worksheet.worksheet.Worksheet.max_row:
-                 logging.warning(f"Attempted to format non-existent row {row_idx} in sheet '{ws.title}'.")
-                 continue
-            for col_idx in range(1, max_col_to_format):
-                 # Check column existence defensively
-                if col_idx > openpyxl.worksheet.worksheet.Worksheet.max_column:
-                     continue
-                try:
-                    cell = ws.cell(row=row_idx, column=col_idx)
-                    # Apply alignment
-                    cell.alignment = Alignment(horizontal="left", vertical="top", wrap_text=True)
-                    # Number formats are now applied during append, so this only does alignment
-                except Exception as e:
-                    cell_coord = f"R{row_idx}C{col_idx}"
-                    try:
-                        cell_coord = ws.cell(row=row_idx, column=col_idx).coordinate
-                    except: pass # Ignore if coordinate fails
-                    logging.warning(f"Alignment formatting error in sheet '{ws.title}' at cell {cell_coord}. Error: {e}")
-
-    def update_formulas(self, wb, data_length_map, formula_config):
-        logging.info("Starting formula update process...")
-        max_end_row_map = {}
-
-        # Determine the actual end row for data in each relevant sheet
-        for sheet_name, details in formula_config.items():
-            data_start_row_config = details['adjust_rows_from'] # The row where data STARTS
-            if sheet_name in data_length_map and data_length_map[sheet_name] > 0:
-                 # Find the actual start row of the appended data
-                ws_check = wb[sheet_name]
-                first_data_row = -1
-                current_row_check = data_start_row_config
-                # Check rows where data could have been appended
-                # Increase check range slightly beyond expected end based on data length
-                max_check_row = data_start_row_config + data_length_map[sheet_name] + 5
-                max_check_row = min(max_check_row, ws_check.max_row + 5) # Don't check excessively far
-
-                while current_row_check <= max_check_row:
-                    # Check if *any* cell in the row has data
-                    row_has_data = any(cell.value is not None and str(cell.value).strip() != "" for cell in ws_check[current_row_check])
-                    if row_has_data and first_data_row == -1:
-                         # Potential start row found
-                         # Check if the row *before* the configured start was actually empty, suggesting config row is correct start
-                         if current_row_check == data_start_row_config:
-                              prev_row_empty = True
-                              if current_row_check > 1:
-                                   prev_row_empty = all(cell.value is None or str(cell.value).strip() == "" for cell in ws_check[current_row_check - 1])
-                              if prev_row_empty:
-                                   first_data_row = current_row_check
-                                   # Don't break yet, keep checking in case of empty rows within data
-                         else:
-                              # Found data after configured start, likely the real start
-                               first_data_row = current_row_check
-                               # Don't break yet
-
-                    elif not row_has_data and first_data_row != -1:
-                         # Found an empty row *after* finding some data. Assume data ended just before this.
-                         max_end_row_map[sheet_name] = current_row_check - 1
-                         logging.info(f"Determined data range for '{sheet_name}': Rows {first_data_row} to {max_end_row_map[sheet_name]}")
-                         break # Exit inner loop once end is found
-
-                    current_row_check += 1
-                else: # Loop finished without finding an empty row after data started
-                    if first_data_row != -1:
-                        # Data likely goes to the end of checked range or sheet max row
-                        max_end_row_map[sheet_name] = first_data_row + data_length_map[sheet_name] - 1 # Calculate based on length
-                        # Cap at actual sheet max row
-                        max_end_row_map[sheet_name] = min(max_end_row_map[sheet_name], ws_check.max_row)
-                        logging.info(f"Data seems contiguous for '{sheet_name}'. Determined range: Rows {first_data_row} to {max_end_row_map[sheet_name]}")
-                    else:
-                        # Could not find any data start row, use config start row for end calculation
-                        max_end_row_map[sheet_name] = data_start_row_config + data_length_map[sheet_name] - 1
-                        logging.warning(f"Could not find data start row for '{sheet_name}'. Using config start {data_start_row_config}. Calculated end row: {max_end_row_map[sheet_name]}")
+# --- Global Processor Instance ---
+# Per-stage timings and counts, exported on /metrics
+stage_metrics = StageMetrics(app.config['METRICS_FOLDER'])
+# Repeat uploads of identical files are served from this cache instead of re-running the pipeline
+result_cache = ResultCache(
+    max_entries=app.config['RESULT_CACHE_ENTRIES'],
+    disk_dir=os.path.join(app.instance_path, 'result_cache'),
+    disk_max_bytes=app.config['RESULT_CACHE_DISK_MB'] * 1024 * 1024,
+)
+# The last evaluation per ticker; a re-upload with some files or columns changed starts from it
+evaluation_cache = ResultCache(max_entries=app.config['EVALUATION_CACHE_ENTRIES']) if app.config['EVALUATION_CACHE_ENTRIES'] > 0 else None
+# Generated workbooks for the download link: a few unserialized per process, saved bytes shared on disk
+workbook_store = WorkbookStore(
+    max_pending=app.config['WORKBOOK_STORE_ENTRIES'],
+    byte_cache=ResultCache(
+        max_entries=app.config['WORKBOOK_STORE_ENTRIES'],
+        disk_dir=os.path.join(app.instance_path, 'workbooks'),
+        disk_max_bytes=app.config['WORKBOOK_STORE_DISK_MB'] * 1024 * 1024,
+    ),
+    metrics=stage_metrics,
+    input_cache=ResultCache(
+        max_entries=0, # The CSVs are only needed by other processes, so they live on disk only
+        disk_dir=os.path.join(app.instance_path, 'workbooks', 'inputs'),
+        disk_max_bytes=app.config['WORKBOOK_INPUTS_DISK_MB'] * 1024 * 1024,
+    ) if app.config['WORKBOOK_INPUTS_DISK_MB'] > 0 else None,
+    save_on_add=app.config['WEB_WORKERS'] > 1 and app.config['WORKBOOK_STORE_DISK_MB'] > 0,
+)
+# Processed statements by ticker and period, for history views without re-uploading
+statement_store = None
+if app.config['STATEMENT_STORE_PATH']:
+    try:
+        statement_store = StatementStore(app.config['STATEMENT_STORE_PATH'])
+    except Exception as e:
+        logging.error(f"Could not open the statement store at {app.config['STATEMENT_STORE_PATH']}: {e}")
+# Profiles of selected uploads (see PROFILE_REQUESTS / PROFILE_TOKEN)
+request_profiler = RequestProfiler(app.config['PROFILE_FOLDER'], keep=app.config['PROFILE_KEEP'])
+# Initialize processor when the app starts
+try:
+    # Decode the template first
+    _template_path_on_startup = decode_master_template()
+    if _template_path_on_startup:
+        # Create the processor instance
+        processor = FinancialStatementProcessor(_template_path_on_startup, result_cache=result_cache,
+                                                workbook_store=workbook_store, metrics=stage_metrics,
+                                                statement_store=statement_store, evaluation_cache=evaluation_cache)
+        logging.info("FinancialStatementProcessor initialized successfully.")
+    else:
+         # Should not happen if decode_master_template raises Exception on failure
+         logging.fatal("FATAL: decode_master_template returned None without raising error.")
+         processor = None
+except Exception as e:
+    logging.fatal(f"FATAL: Could not initialize FinancialStatementProcessor: {e}", exc_info=True)
+    # If the processor fails to initialize, the app can't run.
+    processor = None # Ensure processor is None if init fails
 
-            else:
-                # If no data was appended, the "last row" for formula adjustment is effectively the row *before* data would start
-                max_end_row_map[sheet_name] = data_start_row_config - 1
-                logging.info(f"No data appended to '{sheet_name}'. Effective last row for formula adjustment: {max_end_row_map[sheet_name]}")
-
-        # Now, adjust formulas based on the calculated max_end_row_map
-        for sheet_name_formula_adjustments, details in formula_config.items():
-            if sheet_name_formula_adjustments not in wb.sheetnames:
-                logging.warning(f"Sheet '{sheet_name_formula_adjustments}' specified in formula_config not found in workbook. Skipping.")
-                continue
+# Wall-clock time from the first import to a ready processor; with gunicorn --preload this is paid once, in the master
+app.config['STARTUP_SECONDS'] = round(time.perf_counter() - _startup_started, 3)
+logging.info(f"Startup completed in {app.config['STARTUP_SECONDS']:.3f}s (pid {os.getpid()})")
+
+
+def prepare_for_workers():
+    """
+    Called in the gunicorn master after the app is preloaded and before workers are forked
+    (see gunicorn.conf.py). Loads the modules requests need so workers don't import them on
+    their first upload, then moves every object allocated so far (the parsed template, the
+    rewrite plan, imported modules) out of the garbage collector's reach. The collector would
+    otherwise write to those pages in each worker and undo the copy-on-write sharing.
+    """
+    import numpy # noqa: F401
+    import pandas # noqa: F401
+    stage_metrics.clear() # Metric files of a previous run's workers
+    gc.collect()
+    gc.freeze()
+    logging.info(f"Preloaded app ready to fork; {gc.get_freeze_count()} objects frozen")
+
+
+# --- Background Job Queue ---
+class JobQueueFull(Exception):
+    """Raised when the job queue already holds JOB_MAX_QUEUE queued or running jobs."""
+
+
+class JobQueue:
+    """
+    Runs uploads through the processor in a bounded process pool. No broker is involved:
+    each job has a directory under JOB_FOLDER holding a state.json and, when finished, a
+    pickled result. Any app process (e.g. any gunicorn worker) can
+    therefore answer status polls for any job.
+    """
+    JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+    def __init__(self, job_folder, max_workers, max_queue, result_ttl):
+        self.job_folder = job_folder
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.result_ttl = result_ttl
+        self._executor = None # Created on first submit so idle processes don't hold a pool
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            # fork lets workers inherit the already-initialized processor instead of re-decoding the template
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+        return self._executor
+
+    def submit(self, uploads, profile=False):
+        """Queues a list of UploadedFile objects for processing and returns the new job id."""
+        with self._lock:
+            if self._active >= self.max_queue:
+                raise JobQueueFull(f"{self._active} jobs already queued or running.")
+            self._active += 1
+        try:
+            self._purge_expired()
+            job_id = uuid.uuid4().hex
+            job_dir = os.path.join(self.job_folder, job_id)
+            os.makedirs(job_dir)
+            _write_job_state(job_dir, 'queued')
+            # The upload bytes are handed to the worker directly; no CSVs are written to disk
+            future = self._get_executor().submit(_run_job, job_dir, uploads, profile)
+        except Exception:
+            self._job_finished(None)
+            raise
+        future.add_done_callback(self._job_finished)
+        logging.info(f"Queued job {job_id} ({self._active}/{self.max_queue} slots in use)")
+        return job_id
+
+    def _job_finished(self, future):
+        with self._lock:
+            self._active -= 1
+        if future is not None and future.exception() is not None:
+            # The worker process itself died (e.g. killed); _run_job records ordinary failures
+            logging.error(f"Job worker failed: {future.exception()}")
+
+    def _job_dir(self, job_id):
+        if not self.JOB_ID_PATTERN.match(job_id or ''):
+            return None
+        job_dir = os.path.join(self.job_folder, job_id)
+        return job_dir if os.path.isdir(job_dir) else None
+
+    def status(self, job_id):
+        """Returns the job's state dict ({'state': queued|running|done|failed, ...}) or None if unknown."""
+        job_dir = self._job_dir(job_id)
+        if job_dir is None:
+            return None
+        try:
+            with open(os.path.join(job_dir, 'state.json')) as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            # state.json is replaced atomically, so this only happens before the first write
+            return {'state': 'queued'}
+
+    def wait(self, job_id, timeout):
+        """Long-poll helper: returns the status once the job has finished or timeout seconds have passed."""
+        deadline = time.monotonic() + timeout
+        status = self.status(job_id)
+        while status is not None and status['state'] in ('queued', 'running') and time.monotonic() < deadline:
+            time.sleep(0.25)
+            status = self.status(job_id)
+        return status
+
+    def result(self, job_id):
+        job_dir = self._job_dir(job_id)
+        if job_dir is None:
+            return None
+        try:
+            with open(os.path.join(job_dir, 'result.pkl'), 'rb') as result_file:
+                return pickle.load(result_file)
+        except OSError:
+            return None
+
+    def _purge_expired(self):
+        if not os.path.isdir(self.job_folder):
+            return
+        cutoff = time.time() - self.result_ttl
+        for job_id in os.listdir(self.job_folder):
+            job_dir = os.path.join(self.job_folder, job_id)
+            try:
+                if os.path.getmtime(job_dir) < cutoff:
+                    shutil.rmtree(job_dir, ignore_errors=True)
+            except OSError:
+                pass
 
-            ws = wb[sheet_name_formula_adjustments]
-            formula_range_str = details['range']
-            logging.info(f"Processing formulas in '{sheet_name_formula_adjustments}' range {formula_range_str}")
 
-            try:
-                min_col_idx, min_row_idx, max_col_idx, max_row_idx = openpyxl.utils.range_boundaries(formula_range_str)
-            except Exception as range_parse_error:
-                logging.error(f"Error parsing formula range '{formula_range_str}' for sheet '{sheet_name_formula_adjustments}': {range_parse_error}. Skipping sheet.")
-                continue
+def _write_job_state(job_dir, state, **details):
+    # Write then rename so pollers never read a half-written file
+    temp_path = os.path.join(job_dir, 'state.json.tmp')
+    with open(temp_path, 'w') as state_file:
+        json.dump(dict(details, state=state), state_file)
+    os.replace(temp_path, os.path.join(job_dir, 'state.json'))
 
-            # Regex specifically for VLOOKUP range adjustment (improved)
-            # Handles 'Sheet Name'!A1:B10, SheetName!A1:B10, A1:B10, $A$1:$B$10 etc.
-            vlookup_pattern = re.compile(
-                 r"(VLOOKUP\s*\([^,]+,\s*)"  # Start of VLOOKUP, lookup value, comma (Group 1)
-                 r"((?:'[^']+'!|[^'!]+!)?"  # Optional Sheet Prefix (quoted or unquoted) (Group 3 within Group 2)
-                 r"(\$?[A-Za-z]+\$?\d+:\$?[A-Za-z]+\$?\d+))"  # The range A1:B10, $A$1:$B$10 (Group 4 within Group 2, total range is Group 2)
-                 r"(\s*,)"  # Comma after range (Group 5)
-            )
-
-            def replace_vlookup_range(match):
-                try:
-                    vlookup_prefix = match.group(1)       # e.g., "VLOOKUP(A2,"
-                    original_range_str = match.group(2)   # e.g., "'Sheet1'!$A$5:B10" or Data!A5:B10 or $C$5:$D$10
-                    sheet_prefix = match.group(3) or ''   # e.g., "'Sheet1'!" or "Data!" or ""
-                    range_only = match.group(4)           # e.g., "$A$5:B10" or "A5:B10"
-                    vlookup_suffix_comma = match.group(5) # e.g., ","
-
-                    # Parse the range_only part
-                    range_match = re.match(r"(\$?[A-Za-z]+\$?)(\d+):(\$?[A-Za-z]+\$?)(\d+)", range_only)
-                    if not range_match:
-                         logging.warning(f"    Could not parse range part '{range_only}' from VLOOKUP. Skipping.")
-                         return match.group(0) # Return original match
-                    start_col_ref, start_row, end_col_ref, end_row_old = range_match.groups()
-
-                    # Determine the target sheet for max_end_row lookup
-                    target_sheet_name = sheet_name_formula_adjustments # Default to current sheet
-                    if sheet_prefix:
-                        # Extract sheet name, handling quotes
-                        sheet_match = re.match(r"'([^']+)'!", sheet_prefix)
-                        if sheet_match:
-                            target_sheet_name = sheet_match.group(1)
-                        else: # Unquoted sheet name
-                             target_sheet_name = sheet_prefix[:-1] # Remove trailing '!'
-
-                    if target_sheet_name in max_end_row_map:
-                        new_end_row_num = max_end_row_map[target_sheet_name]
-                        # Only adjust if the new end row makes sense (is at least the start row)
-                        if new_end_row_num >= int(start_row):
-                            # Reconstruct the range using original column refs and new end row
-                            new_range = f"{start_col_ref}{start_row}:{end_col_ref}{new_end_row_num}"
-                            # Reconstruct the full VLOOKUP part
-                            reconstructed = f"{vlookup_prefix}{sheet_prefix}{new_range}{vlookup_suffix_comma}"
-                            # logging.debug(f"    Replacing VLOOKUP range {original_range_str} -> {sheet_prefix}{new_range}")
-                            return reconstructed
-                        else:
-                             logging.warning(f"    VLOOKUP adjustment skipped for {original_range_str} in {target_sheet_name}: new end row {new_end_row_num} is before start row {start_row}.")
-                             return match.group(0) # Return original match if adjustment doesn't make sense
-                    else:
-                         logging.warning(f"    VLOOKUP adjustment skipped: Sheet '{target_sheet_name}' (from range {original_range_str}) not found in calculated max_end_row_map.")
-                         return match.group(0) # Return original match if sheet not found
-
-                except IndexError:
-                    logging.error(f"    Regex group index error processing VLOOKUP match: {match.group(0)}. Skipping adjustment.")
-                    return match.group(0)
-                except Exception as e:
-                    logging.error(f"    Unexpected error in replace_vlookup_range for {match.group(0)}: {e}. Skipping adjustment.")
-                    return match.group(0)
-
-            # Iterate through cells in the specified formula range
-            for row_idx in range(min_row_idx, max_row_idx + 1):
-                for col_idx in range(min_col_idx, max_col_idx + 1):
-                    # Add boundary checks for safety
-                    if row_idx > ws.max_row or col_idx > ws.max_column: continue
+
+def _run_job(job_dir, uploads, profile=False):
+    """Executed in a pool worker process."""
+    _write_job_state(job_dir, 'running')
+    try:
+        if processor is None:
+            raise RuntimeError("The statement processor could not be initialized.")
+        if profile:
+            results_data = request_profiler.run(_upload_label(uploads), processor.process_files_for_web, uploads)
+        else:
+            results_data = processor.process_files_for_web(uploads)
+        if processor.workbook_store is not None and results_data.get('result_key'):
+            # This worker's memory is not reachable from the web process, so save the workbook now
+            processor.workbook_store.persist(results_data['result_key'])
+        with open(os.path.join(job_dir, 'result.pkl'), 'wb') as result_file:
+            pickle.dump(results_data, result_file)
+        _write_job_state(job_dir, 'done')
+    except (ValueError, FileNotFoundError) as user_error:
+        _write_job_state(job_dir, 'failed', error=f"Processing Error: {user_error}")
+    except Exception as e:
+        logging.error(f"Unexpected error in job {os.path.basename(job_dir)}: {e}", exc_info=True)
+        _write_job_state(job_dir, 'failed', error="An unexpected error occurred during processing. Please check file formats and try again.")
+    finally:
+        stage_metrics.flush() # Pool workers may sit idle (or exit) before their next periodic write
+
+
+job_queue = JobQueue(app.config['JOB_FOLDER'], app.config['JOB_MAX_WORKERS'],
+                     app.config['JOB_MAX_QUEUE'], app.config['JOB_RESULT_TTL'])
+
+
+# --- Bulk Processing ---
+class BulkArchiveError(ValueError):
+    """The uploaded archive is unreadable or exceeds the bulk limits."""
+
+
+class BulkProcessor:
+    """
+    Processes many tickers from one ZIP archive. Members are grouped by ticker with the
+    processor's filename pattern, and each ticker is submitted to a process pool as soon as its
+    three files are listed; results come back in completion order. A ticker that fails only
+    produces an error entry for itself.
+
+    The archive is not decompressed as a stream: a ZIP's member list (central directory) is at
+    its end, so zipfile needs the whole upload, seekable. Werkzeug spools it to a temporary file
+    once it is large. Until a ticker is complete only its members' entries are kept; its three
+    files are decompressed when it is submitted. Submitted tickers wait in the pool's queue with
+    their files in memory, so max_uncompressed_bytes (checked against the sizes the archive
+    declares, which zipfile verifies while reading) bounds the memory one archive can take.
+    """
+    def __init__(self, max_workers, max_tickers, max_uncompressed_bytes):
+        self.max_workers = max_workers
+        self.max_tickers = max_tickers
+        self.max_uncompressed_bytes = max_uncompressed_bytes
+        self._executor = None # Created on first use, like the job queue's pool
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+            return self._executor
+
+    def submit_archive(self, archive_file):
+        """
+        Reads the archive and queues every complete ticker. Returns (futures by ticker,
+        problems), where problems are result entries for files and tickers that could not
+        be queued. Raises BulkArchiveError for an unusable archive.
+        """
+        try:
+            archive = zipfile.ZipFile(archive_file)
+        except (zipfile.BadZipFile, OSError) as e:
+            raise BulkArchiveError(f"Not a readable ZIP archive: {e}")
+        pattern = FinancialStatementProcessor.FILENAME_PATTERN
+        pending = {}   # ticker -> {statement type: ZipInfo}
+        futures = {}   # ticker -> Future
+        problems = []
+        total_bytes = 0
+        executor = self._get_executor()
+        with archive:
+            for info in archive.infolist():
+                filename = os.path.basename(info.filename)
+                if info.is_dir() or not filename or info.filename.startswith('__MACOSX/'):
+                    continue
+                match = pattern.fullmatch(filename)
+                if not match:
+                    problems.append({'file': info.filename, 'status': 'skipped', 'error': "Name does not match TICKER_annual_type.csv"})
+                    continue
+                ticker, statement = match.group(1).upper(), match.group(2).lower()
+                if ticker in futures or statement in pending.get(ticker, {}):
+                    problems.append({'file': info.filename, 'status': 'skipped', 'error': f"Duplicate {statement} file for {ticker}"})
+                    continue
+                if ticker not in pending and len(pending) + len(futures) >= self.max_tickers:
+                    raise BulkArchiveError(f"The archive holds more than {self.max_tickers} tickers.")
+                total_bytes += info.file_size
+                if total_bytes > self.max_uncompressed_bytes:
+                    raise BulkArchiveError(f"The archive expands to more than {self.max_uncompressed_bytes // (1024 * 1024)} MB.")
+                pending.setdefault(ticker, {})[statement] = info
+                if len(pending[ticker]) == 3:
                     try:
-                        cell = ws.cell(row=row_idx, column=col_idx)
-                        if cell.data_type == 'f' and isinstance(cell.value, str) and cell.value.startswith('='):
-                            original_formula = cell.value
-                            # Apply VLOOKUP range adjustment
-                            new_formula = vlookup_pattern.sub(replace_vlookup_range, original_formula)
-
-                            # Add more formula adjustment patterns here if needed (e.g., SUM)
-
-                            if new_formula != original_formula:
-                                logging.info(f"Updating formula: {ws.title}!{cell.coordinate} From: '{original_formula}' To: '{new_formula}'")
-                                cell.value = new_formula
-                    except Exception as cell_proc_error:
-                         cell_coord = f"R{row_idx}C{col_idx}"
-                         try: cell_coord = ws.cell(row=row_idx, column=col_idx).coordinate
-                         except: pass
-                         logging.error(f"Error processing cell {cell_coord} in '{ws.title}' during formula update: {cell_proc_error}")
-
-        logging.info("Formula update finished.")
-
-
-    def _extract_data_from_workbook(self, wb, sheet_configs):
-        """ Extracts data from specified sheets and ranges in the workbook. """
-        extracted_data = {}
-        logging.info("Starting data extraction from processed workbook.")
-        for sheet_name, config in sheet_configs.items():
-            if sheet_name not in wb.sheetnames:
-                logging.warning(f"Sheet '{sheet_name}' not found in workbook for extraction.")
-                extracted_data[sheet_name] = {'headers': [], 'data': []}
-                continue
+                        uploads = [UploadedFile(os.path.basename(member.filename), archive.read(member))
+                                   for member in pending.pop(ticker).values()]
+                    except (zipfile.BadZipFile, OSError, RuntimeError, NotImplementedError) as e:
+                        raise BulkArchiveError(f"Could not read {ticker}'s files from the archive: {e}")
+                    futures[ticker] = executor.submit(_run_bulk_ticker, uploads)
+        for ticker, statements in sorted(pending.items()):
+            missing = sorted({'financials', 'balance-sheet', 'cash-flow'} - statements.keys())
+            problems.append({'ticker': ticker, 'status': 'error', 'error': f"Missing required file types: {', '.join(missing)}"})
+        logging.info(f"Bulk archive: {len(futures)} tickers queued, {len(problems)} problems")
+        return futures, problems
+
+    def iter_results(self, futures):
+        """Yields each ticker's result entry as soon as it finishes."""
+        tickers = {future: ticker for ticker, future in futures.items()}
+        for future in as_completed(tickers):
+            try:
+                yield future.result()
+            except BrokenProcessPool as e:
+                with self._lock:
+                    self._executor = None # A worker died and took the pool with it; the next batch gets a fresh one
+                yield {'ticker': tickers[future], 'status': 'error', 'error': f"Worker process failed: {e}"}
+            except Exception as e:
+                yield {'ticker': tickers[future], 'status': 'error', 'error': f"Worker process failed: {e}"}
 
-            ws = wb[sheet_name]
-            data_range_str = config.get('display_range', None)
-            header_row_num = config.get('header_row', 1) # Default to row 1 if not specified
 
-            sheet_data = []
-            headers = []
+def _run_bulk_ticker(uploads):
+    """Executed in a bulk pool worker: one ticker's triple -> its result entry."""
+    ticker = _upload_label(uploads).upper()
+    try:
+        if processor is None:
+            raise RuntimeError("The statement processor could not be initialized.")
+        result = processor.process_statements(uploads)
+        entry = dict(columnar_statements(result), status='ok')
+        store = processor.workbook_store
+        if store is not None and store.byte_cache.disk_dir:
+            # The workbook is only in this worker's memory; saved to the shared disk tier, the web process can serve it
+            entry['downloadable'] = store.persist(result['result_key'])
+        return entry
+    except (ValueError, FileNotFoundError) as user_error:
+        return {'ticker': ticker, 'status': 'error', 'error': str(user_error)}
+    except Exception as e:
+        logging.error(f"Unexpected error processing {ticker} in bulk: {e}", exc_info=True)
+        return {'ticker': ticker, 'status': 'error', 'error': "An unexpected error occurred during processing."}
+    finally:
+        stage_metrics.flush()
 
-            if data_range_str:
-                try:
-                    min_col_idx, min_row_idx, max_col_idx, max_row_idx = openpyxl.utils.range_boundaries(data_range_str)
 
-                    # Ensure max row doesn't exceed actual sheet dimensions
-                    max_row_idx = min(max_row_idx, ws.max_row)
-                    max_col_idx = min(max_col_idx, ws.max_column)
+bulk_processor = BulkProcessor(app.config['BULK_MAX_WORKERS'], app.config['BULK_MAX_TICKERS'],
+                               app.config['BULK_MAX_UNCOMPRESSED_MB'] * 1024 * 1024)
 
 
-                    # --- Extract Headers ---
-                    # Check if header row is valid and within sheet bounds
-                    if header_row_num >= 1 and header_row_num <= max_row_idx :
-                        actual_header_row = ws[header_row_num]
-                        # Extract headers only within the specified column range
-                        headers = [cell.value for idx, cell in enumerate(actual_header_row) if min_col_idx <= idx + 1 <= max_col_idx]
-                        # Adjust data start row if headers were within the display range
-                        if header_row_num >= min_row_idx:
-                             min_row_idx = header_row_num + 1
-                    else:
-                         logging.warning(f"Header row {header_row_num} is outside the sheet bounds or display range for sheet '{sheet_name}'. No headers extracted.")
-                         headers = [""] * (max_col_idx - min_col_idx + 1) # Placeholder headers
-
-
-                    # --- Extract Data Rows ---
-                    logging.info(f"Extracting data from '{sheet_name}' calculated range {get_column_letter(min_col_idx)}{min_row_idx}:{get_column_letter(max_col_idx)}{max_row_idx}")
-                    # Ensure min_row_idx is not greater than max_row_idx after header adjustment
-                    if min_row_idx <= max_row_idx:
-                        for row_idx in range(min_row_idx, max_row_idx + 1):
-                             # Extract row data only within the specified column range
-                             row_data = [ws.cell(row=row_idx, column=col_idx).value for col_idx in range(min_col_idx, max_col_idx + 1)]
-
-                             # Apply basic formatting for display (optional, can be done in Jinja2 too)
-                             formatted_row = []
-                             for cell_value in row_data:
-                                 if isinstance(cell_value, (int, float)):
-                                     # Basic number formatting for display
-                                     try:
-                                          # Simple comma format, 2 decimal places
-                                          formatted_row.append(f"{cell_value:,.2f}")
-                                     except (ValueError, TypeError):
-                                          formatted_row.append(cell_value) # Fallback
-                                 elif isinstance(cell_value, datetime):
-                                     formatted_row.append(cell_value.strftime('%Y-%m-%d'))
-                                 else:
-                                     formatted_row.append(cell_value) # Keep strings, None, etc. as is
-
-                             sheet_data.append(formatted_row)
-                    else:
-                         logging.info(f"No data rows to extract for sheet '{sheet_name}' after header processing (min_row > max_row).")
+# --- JSON API ---
+API_FORMAT_VERSION = 'v1' # Part of the ETag, so a change to the JSON layout invalidates clients' copies
+API_GZIP_MIN_BYTES = 1024
 
 
-                except Exception as extract_error:
-                    logging.error(f"Error extracting data from range '{data_range_str}' in sheet '{sheet_name}': {extract_error}", exc_info=True)
-                    # Provide empty data on error for this sheet
-                    headers = []
-                    sheet_data = []
-            else:
-                 logging.warning(f"No 'display_range' specified for sheet '{sheet_name}'. Skipping data extraction.")
+def _api_error(message, status):
+    return jsonify(error=message), status
 
 
-            extracted_data[sheet_name] = {'headers': headers, 'data': sheet_data}
-            logging.info(f"Extracted {len(sheet_data)} rows of data with {len(headers)} headers for sheet '{sheet_name}'.")
+def _api_etag(result_key):
+    return f"{API_FORMAT_VERSION}-{result_key}"
 
-        logging.info("Finished data extraction from workbook.")
-        return extracted_data
 
-    # Main processing method called by Flask
-    def process_files_for_web(self, file_paths):
-        """
-        Processes uploaded CSV files using the template and returns extracted data
-        suitable for web display. Doesn't save the final Excel file.
-        """
-        wb = None # Ensure wb is defined in this scope
-        wb_data_only = None # Define wb_data_only
-        temp_output_path = None # Keep track of temp file if created
-        ticker_symbol = None # Initialize ticker_symbol
+def _api_not_modified(etag):
+    """A 304 response if the client's If-None-Match holds this ETag (either encoding), else None."""
+    if request.if_none_match.contains_weak(etag) or request.if_none_match.contains_weak(f"{etag}-gzip"):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+        return response
+    return None
 
-        try:
-            if len(file_paths) != 3:
-                raise ValueError("Please provide exactly 3 CSV file paths.")
 
-            file_map = {}
+def _api_json_response(payload, etag):
+    body = json.dumps(payload, separators=(',', ':'), allow_nan=False).encode()
+    response = Response(body, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if len(body) >= API_GZIP_MIN_BYTES and request.accept_encodings['gzip']:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+        etag = f"{etag}-gzip" # Each encoding is a different representation
+    response.set_etag(etag)
+    return response
 
-            # --- File Classification ---
-            logging.info("Classifying input files...")
-            for file_path in file_paths:
-                filename = os.path.basename(file_path)
-                match = re.match(r"([A-Za-z0-9]+)_annual_(cash-flow|balance-sheet|financials)\.csv", filename, re.IGNORECASE)
-                if not match:
-                    raise ValueError(f"Invalid filename format: {filename}. Expected TICKER_annual_type.csv")
-
-                current_ticker, sheet_type_raw = match.groups()
-                current_ticker_upper = current_ticker.upper()
-
-                if ticker_symbol is None:
-                    ticker_symbol = current_ticker_upper
-                elif ticker_symbol != current_ticker_upper:
-                    raise ValueError(f"Ticker symbol mismatch in filenames: Expected '{ticker_symbol}', found '{current_ticker_upper}' in {filename}")
-
-                stype = sheet_type_raw.lower()
-                if stype == "financials" and 'income' not in file_map:
-                    file_map['income'] = file_path
-                elif stype == "balance-sheet" and 'balance' not in file_map:
-                    file_map['balance'] = file_path
-                elif stype == "cash-flow" and 'cashflow' not in file_map:
-                    file_map['cashflow'] = file_path
-                else:
-                     # Handle duplicate types
-                     raise ValueError(f"Duplicate file type '{stype}' found or invalid type for filename {filename}")
-
-            if len(file_map) != 3:
-                 missing = {'income', 'balance', 'cashflow'} - file_map.keys()
-                 # Map internal keys back to expected file types for user message
-                 type_map = {'income': 'financials', 'balance': 'balance-sheet', 'cashflow': 'cash-flow'}
-                 missing_types = [type_map[m] for m in missing]
-                 raise ValueError(f"Missing required file types: {', '.join(missing_types)}")
-            logging.info(f"Files classified successfully for ticker: {ticker_symbol}")
-
-            # --- Load and Clean Data ---
-            logging.info("Loading and cleaning CSV data...")
-            income_df = self.clean_data(self.load_csv(file_map['income'], "Income Statement"), "Income Statement")
-            balance_df = self.clean_data(self.load_csv(file_map['balance'], "Balance Sheet"), "Balance Sheet")
-            cash_flow_df = self.clean_data(self.load_csv(file_map['cashflow'], "Cash Flow Statement"), "Cash Flow Statement")
-
-            # --- Prepare In-Memory Workbook ---
-            logging.info("Creating temporary workbook from template...")
-            # Create a unique temp file name
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx", prefix=f"{ticker_symbol}_proc_", dir=app.config['UPLOAD_FOLDER']) as temp_wb_file:
-                 temp_output_path = temp_wb_file.name
-            shutil.copy(self.template_path, temp_output_path)
-            logging.info(f"Copied template to temporary path: {temp_output_path}")
-
-            # Load the temporary workbook for modification (formulas need data_only=False)
-            wb = load_workbook(temp_output_path, data_only=False)
-            logging.info("Loaded temporary workbook for processing.")
-
-            # --- Append Data ---
-            logging.info("Appending data to temporary workbook...")
-            sheet_append_info = {
-                "Income Statement": 10,
-                "Balance Sheet": 7,
-                "Cash Flow Statement": 9
-            }
-            self.append_data_to_excel(income_df, wb, "Income Statement", sheet_append_info["Income Statement"])
-            self.append_data_to_excel(balance_df, wb, "Balance Sheet", sheet_append_info["Balance Sheet"])
-            self.append_data_to_excel(cash_flow_df, wb, "Cash Flow Statement", sheet_append_info["Cash Flow Statement"])
-
-            # --- Update Formulas ---
-            logging.info("Updating formulas in temporary workbook...")
-            data_lengths = {
-                "Income Statement": len(income_df),
-                "Balance Sheet": len(balance_df),
-                "Cash Flow Statement": len(cash_flow_df)
-            }
-            formula_config = {
-                "Income Statement":    {'range': 'C2:L8', 'adjust_rows_from': sheet_append_info["Income Statement"]},
-                "Balance Sheet":       {'range': 'B2:K5', 'adjust_rows_from': sheet_append_info["Balance Sheet"]},
-                "Cash Flow Statement": {'range': 'C2:L5', 'adjust_rows_from': sheet_append_info["Cash Flow Statement"]}
-            }
-            self.update_formulas(wb, data_lengths, formula_config)
-
-            # --- Specific Formatting ---
-            logging.info("Applying specific formatting to Cash Flow Statement rows 2 & 3...")
-            try:
-                if "Cash Flow Statement" in wb.sheetnames:
-                    cf_ws = wb["Cash Flow Statement"]
-                    three_decimal_format = "0.000"
-                    # Determine max column dynamically but cap it reasonably
-                    max_col_to_format = min(cf_ws.max_column + 1, 27) # Cap at Z
-                    for row_idx in [2, 3]:
-                        if row_idx <= cf_ws.max_row:
-                            for col_idx in range(3, max_col_to_format): # Start from column C (3)
-                               if col_idx <= cf_ws.max_column:
-                                    cell = cf_ws.cell(row=row_idx, column=col_idx)
-                                    # Check if cell contains a number before formatting
-                                    if isinstance(cell.value, (int, float)):
-                                         cell.number_format = three_decimal_format
-                                    # else: Don't format non-numeric cells
-                else:
-                    logging.warning("Cash Flow Statement sheet not found for specific formatting.")
-            except Exception as fmt_error:
-                logging.warning(f"Could not apply specific formatting to Cash Flow rows 2-3: {fmt_error}")
-
-            # --- Save temporary workbook to calculate formulas ---
-            logging.info("Saving temporary workbook to calculate formulas...")
-            wb.save(temp_output_path)
-            wb.close() # Close the workbook object
-            wb = None # Reset wb variable
-            logging.info("Temporary workbook saved and closed.")
-
-            # --- Reload Workbook with Calculated Values ---
-            logging.info("Reloading temporary workbook with calculated values (data_only=True)...")
-            wb_data_only = load_workbook(temp_output_path, data_only=True)
-            logging.info("Reloaded workbook with data_only=True.")
-
-
-            # --- Extract Data for Display ---
-            logging.info("Extracting data for web display...")
-            # Define which parts of each sheet to display - ADJUST THESE RANGES AS NEEDED
-            sheet_display_configs = {
-                 # Ranges should cover headers and potential data area
-                "Income Statement":  {'display_range': 'A1:L40', 'header_row': 9}, # Adjusted range potentially
-                "Balance Sheet":     {'display_range': 'A1:K50', 'header_row': 6}, # Adjusted range potentially
-                "Cash Flow Statement":{'display_range': 'A1:L50', 'header_row': 8} # Adjusted range potentially
-            }
-            processed_data = self._extract_data_from_workbook(wb_data_only, sheet_display_configs)
-
-            wb_data_only.close() # Close the data_only workbook
-            wb_data_only = None # Reset
-            logging.info("Closed data_only workbook.")
-
-            logging.info("Processing for web display complete.")
-            return {'ticker': ticker_symbol, 'sheets': processed_data}
 
-        except Exception as e:
-            logging.error(f"Error during web processing: {e}", exc_info=True) # Log traceback
-            # Ensure workbooks are closed if they were opened
-            if wb is not None:
-                try: wb.close()
-                except: pass
-            if wb_data_only is not None:
-                try: wb_data_only.close()
-                except: pass
-            raise # Re-raise the exception for Flask handler
+# --- Profiling Access ---
+def _has_profile_token():
+    token = app.config['PROFILE_TOKEN']
+    return bool(token) and request.headers.get('X-Profile-Token') == token
 
-        finally:
-             # --- Cleanup Temporary Processing Workbook File ---
-             if temp_output_path and os.path.exists(temp_output_path):
-                 try:
-                      os.remove(temp_output_path)
-                      logging.info(f"Cleaned up temporary processing workbook: {temp_output_path}")
-                 except OSError as e:
-                      logging.warning(f"Could not remove temporary processing workbook {temp_output_path}: {e}")
 
+def _profiling_requested():
+    """Whether this upload should be profiled: always in PROFILE_REQUESTS mode, else only for admins who ask."""
+    return app.config['PROFILE_REQUESTS'] or _has_profile_token()
 
-# --- Global Processor Instance ---
-# Initialize processor when the app starts
-try:
-    # Decode the template first
-    _template_path_on_startup = decode_master_template()
-    if _template_path_on_startup:
-        # Create the processor instance
-        processor = FinancialStatementProcessor(_template_path_on_startup)
-        logging.info("FinancialStatementProcessor initialized successfully.")
-    else:
-         # Should not happen if decode_master_template raises Exception on failure
-         logging.fatal("FATAL: decode_master_template returned None without raising error.")
-         processor = None
-except Exception as e:
-    logging.fatal(f"FATAL: Could not initialize FinancialStatementProcessor: {e}", exc_info=True)
-    # If the processor fails to initialize, the app can't run.
-    processor = None # Ensure processor is None if init fails
+
+def _upload_label(uploads):
+    """Names a profile after the uploaded files' ticker prefix (the ticker is only validated later)."""
+    return _input_name(uploads[0]).split('_', 1)[0] if uploads else 'upload'
 
 
 # --- Flask Routes ---
@@ -792,10 +656,9 @@ def index():
             flash(f'Please select exactly 3 CSV files. You selected {len(files)}.', 'warning')
             return redirect(request.url)
 
-        saved_files = []
-        temp_upload_dir = app.config['UPLOAD_FOLDER']
+        uploads = []
         try:
-            # Save files temporarily
+            # Read the files into memory; nothing is written to disk
             for file in files:
                  # Double check file object and filename
                  if file and file.filename:
@@ -804,27 +667,37 @@ def index():
                         filename = secure_filename(file.filename)
                         if not filename: # Handle cases where secure_filename returns empty string
                             filename = f"upload_{datetime.now().timestamp()}.csv" # Fallback name
-                        filepath = os.path.join(temp_upload_dir, filename)
-                        file.save(filepath)
-                        saved_files.append(filepath)
-                        logging.info(f"Saved uploaded file: {filepath}")
+                        uploads.append(UploadedFile(filename, file.read()))
+                        logging.debug("Read uploaded file: %s", filename)
                     else:
                         flash(f'Invalid file type: "{file.filename}". Only CSV files are allowed.', 'danger')
-                        raise ValueError("Invalid file type uploaded.") # Raise error to trigger cleanup
+                        raise ValueError("Invalid file type uploaded.")
                  else:
                     # Handle case where one of the file inputs might be empty/invalid
                      flash('One of the file inputs was empty or invalid.', 'danger')
-                     raise ValueError("Empty or invalid file input.") # Raise error to trigger cleanup
+                     raise ValueError("Empty or invalid file input.")
+
+            profile = _profiling_requested()
+            if app.config['ASYNC_JOBS']:
+                # --- Queue Files for Background Processing ---
+                job_id = job_queue.submit(uploads, profile=profile)
+                return redirect(url_for('job_page', job_id=job_id))
 
             # --- Process Files ---
-            logging.info("Calling processor.process_files_for_web...")
-            results_data = processor.process_files_for_web(saved_files)
-            logging.info("Processing successful.")
+            logging.debug("Calling processor.process_files_for_web...")
+            if profile:
+                results_data = request_profiler.run(_upload_label(uploads), processor.process_files_for_web, uploads)
+            else:
+                results_data = processor.process_files_for_web(uploads)
+            logging.debug("Processing successful.")
 
             # --- Render Results ---
             # Don't flash success here, the results page is the success indicator
             return render_template('results.html', results=results_data)
 
+        except JobQueueFull as full:
+             flash('The server is busy processing other uploads. Please try again in a moment.', 'warning')
+             logging.warning(f"Rejected upload, job queue full: {full}")
         except ValueError as ve:
              flash(f'Processing Error: {ve}', 'danger')
              logging.error(f"ValueError during processing: {ve}")
@@ -835,18 +708,8 @@ def index():
             flash(f'An unexpected error occurred during processing. Please check file formats and try again.', 'danger')
             # Log the full error for debugging
             logging.error(f"Unexpected error during processing: {e}", exc_info=True) # Log traceback
-        finally:
-            # --- Clean up temporarily uploaded files ---
-            logging.info(f"Cleaning up {len(saved_files)} uploaded files...")
-            for sf in saved_files:
-                if os.path.exists(sf):
-                    try:
-                        os.remove(sf)
-                        logging.info(f"Cleaned up uploaded file: {sf}")
-                    except OSError as e:
-                        logging.warning(f"Could not remove uploaded file {sf} during cleanup: {e}")
 
-        # Redirect back to form on any error encountered after file saving started
+        # Redirect back to form on any error encountered while reading or processing the files
         return redirect(url_for('index'))
 
     # --- GET Request ---
@@ -854,11 +717,245 @@ def index():
     return render_template('index.html')
 
 
+@app.route('/jobs/<job_id>')
+def job_page(job_id):
+    """Results page for a background job: shows a progress page until the job has finished."""
+    status = job_queue.status(job_id)
+    if status is None:
+        flash('Unknown or expired processing job. Please upload the files again.', 'warning')
+        return redirect(url_for('index'))
+    if status['state'] == 'failed':
+        flash(status.get('error', 'Processing failed.'), 'danger')
+        return redirect(url_for('index'))
+    if status['state'] == 'done':
+        results_data = job_queue.result(job_id)
+        if results_data is not None:
+            return render_template('results.html', results=results_data)
+        flash('The processing result is no longer available. Please upload the files again.', 'warning')
+        return redirect(url_for('index'))
+    return render_template('job_status.html', job_id=job_id, state=status['state'])
+
+
+@app.route('/jobs/<job_id>/status')
+def job_status(job_id):
+    """JSON job state. ?wait=N long-polls for up to N seconds (max 25) until the job finishes."""
+    wait_seconds = min(max(request.args.get('wait', 0, type=float), 0), 25)
+    status = job_queue.wait(job_id, wait_seconds) if wait_seconds else job_queue.status(job_id)
+    if status is None:
+        return jsonify({'state': 'unknown'}), 404
+    return jsonify(status)
+
+
+@app.route('/download/<result_key>')
+def download_workbook(result_key):
+    """Streams the populated workbook for a processed upload without re-running the pipeline."""
+    artifact = None
+    if re.fullmatch(r"[0-9a-f]{64}", result_key) and processor is not None and processor.workbook_store is not None:
+        artifact = processor.workbook_store.get(result_key, rebuild=processor.rebuild_workbook)
+    if artifact is None:
+        flash('That workbook is no longer available. Please upload the files again to regenerate it.', 'warning')
+        return redirect(url_for('index'))
+    ticker, workbook_bytes = artifact
+    response = Response(wrap_file(request.environ, io.BytesIO(workbook_bytes)), direct_passthrough=True,
+                        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    response.headers['Content-Length'] = str(len(workbook_bytes))
+    response.headers['Content-Disposition'] = f'attachment; filename="{secure_filename(ticker) or "statements"}_analysis.xlsx"'
+    return response
+
+
+@app.route('/profiles')
+def list_profiles():
+    """Recent profiles with links to their stats files. Requires the X-Profile-Token header."""
+    if not _has_profile_token():
+        abort(404)
+    profiles = request_profiler.list()
+    for entry in profiles:
+        entry['pstats_url'] = url_for('get_profile', filename=f"{entry['name']}.pstats")
+        entry['summary_url'] = url_for('get_profile', filename=f"{entry['name']}.txt")
+    return jsonify(profiles=profiles)
+
+
+@app.route('/profiles/<filename>')
+def get_profile(filename):
+    if not _has_profile_token() or not RequestProfiler.NAME_PATTERN.match(filename):
+        abort(404)
+    return send_from_directory(request_profiler.folder, filename, as_attachment=filename.endswith('.pstats'))
+
+
+@app.teardown_request
+def flush_stage_metrics(exc):
+    stage_metrics.flush()
+
+
+@app.route('/api/statements', methods=['POST'])
+def api_statements():
+    """
+    Runs the three uploaded CSVs (form field csv_files) through the pipeline and returns the
+    statements as columnar JSON. Always synchronous, also in ASYNC_JOBS mode. The ETag is
+    derived from the inputs' content hash, so a client re-sending the same files with
+    If-None-Match gets a 304 without the pipeline running.
+    """
+    if processor is None:
+        return _api_error("The statement processor could not be initialized.", 503)
+    files = [file for file in request.files.getlist('csv_files') if file and file.filename]
+    if len(files) != 3:
+        return _api_error(f"Expected exactly 3 CSV files in 'csv_files', got {len(files)}.", 400)
+    uploads = []
+    for file in files:
+        if not file.filename.lower().endswith('.csv'):
+            return _api_error(f"Invalid file type: {file.filename}. Only CSV files are allowed.", 400)
+        uploads.append(UploadedFile(secure_filename(file.filename), file.read()))
+    try:
+        ticker_symbol, file_map = processor.classify_files(uploads)
+        not_modified = _api_not_modified(_api_etag(processor.result_cache_key(ticker_symbol, file_map)))
+        if not_modified is not None:
+            return not_modified
+        result = processor.process_statements(uploads)
+    except (ValueError, FileNotFoundError) as user_error:
+        return _api_error(str(user_error), 400)
+    except Exception as e:
+        logging.error(f"Unexpected error during API processing: {e}", exc_info=True)
+        return _api_error("An unexpected error occurred during processing.", 500)
+    return _api_json_response(columnar_statements(result), _api_etag(result['result_key']))
+
+
+@app.route('/bulk', methods=['POST'])
+def bulk_upload():
+    """
+    Processes a ZIP archive (form field 'archive') holding any number of tickers' CSV triples.
+    The response is newline-delimited JSON: one line per ticker as it finishes (the columnar
+    statements plus a download link, or an error), lines for skipped files, and a final
+    summary line. Download links need the workbook store's disk tier (WORKBOOK_STORE_DISK_MB),
+    as the workbooks are built in the bulk pool's processes; without it they are left out.
+    """
+    if processor is None:
+        return _api_error("The statement processor could not be initialized.", 503)
+    archive = request.files.get('archive')
+    if archive is None or not archive.filename.lower().endswith('.zip'):
+        return _api_error("Upload a .zip archive in the 'archive' field.", 400)
+    try:
+        futures, problems = bulk_processor.submit_archive(archive.stream)
+    except BulkArchiveError as archive_error:
+        return _api_error(str(archive_error), 400)
+
+    def generate():
+        succeeded = failed = 0
+        for entry in problems:
+            yield json.dumps(entry) + "\n"
+        for entry in bulk_processor.iter_results(futures):
+            if entry['status'] == 'ok':
+                succeeded += 1
+                if entry.pop('downloadable', False):
+                    entry['download_url'] = url_for('download_workbook', result_key=entry['result_key'])
+            else:
+                failed += 1
+            yield json.dumps(entry, allow_nan=False) + "\n"
+        failed += sum(1 for entry in problems if entry['status'] == 'error')
+        skipped = sum(1 for entry in problems if entry['status'] == 'skipped')
+        yield json.dumps({'summary': {'succeeded': succeeded, 'failed': failed, 'skipped_files': skipped}}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/api/statements/<result_key>')
+def api_statement_result(result_key):
+    """A previously processed result by its result_key, while it is still in the result cache."""
+    if not re.fullmatch(r"[0-9a-f]{64}", result_key):
+        return _api_error("Unknown result key.", 404)
+    etag = _api_etag(result_key)
+    not_modified = _api_not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+    result = processor.result_cache.get(result_key) if processor is not None and processor.result_cache is not None else None
+    if result is None:
+        return _api_error("Result not available; POST the files to /api/statements again.", 404)
+    return _api_json_response(columnar_statements(result), etag)
+
+
+@app.route('/history')
+def history_lookup():
+    """Target of the index page's lookup form: ?ticker=XYZ -> /history/XYZ."""
+    ticker = request.args.get('ticker', '').strip().upper()
+    if not re.fullmatch(r"[A-Z0-9]+", ticker):
+        flash('Enter a ticker symbol (letters and digits only).', 'warning')
+        return redirect(url_for('index'))
+    return redirect(url_for('history_view', ticker=ticker))
+
+
+@app.route('/history/<ticker>')
+def history_view(ticker):
+    """The latest stored result for a ticker, read from the statement store instead of re-processed."""
+    result = statement_store.latest_result(ticker) if statement_store is not None else None
+    if result is None:
+        flash(f'No stored results for {ticker.upper()}. Upload its files to process them.', 'warning')
+        return redirect(url_for('index'))
+    return render_template('results.html', results=FinancialStatementProcessor.format_result_for_display(result))
+
+
+@app.route('/api/history')
+def api_history_tickers():
+    """The tickers in the statement store, with the newest period and time each was stored."""
+    if statement_store is None:
+        return _api_error("The statement store is disabled.", 503)
+    return jsonify(tickers=statement_store.tickers())
+
+
+@app.route('/api/history/<ticker>')
+def api_history(ticker):
+    """
+    Every stored period of a ticker's statements, newest first. ?kind=input (the cleaned CSV
+    values, default) or output (the computed sheets); ?statement= and ?period= (repeatable)
+    narrow the read.
+    """
+    if statement_store is None:
+        return _api_error("The statement store is disabled.", 503)
+    try:
+        history = statement_store.history(ticker, kind=request.args.get('kind', 'input'),
+                                          statements=request.args.getlist('statement'),
+                                          periods=request.args.getlist('period'))
+    except ValueError as bad_request:
+        return _api_error(str(bad_request), 400)
+    if not history:
+        return _api_error(f"No stored statements for {ticker.upper()}.", 404)
+    return jsonify(ticker=ticker.upper(), statements=history)
+
+
+@app.route('/api/screen')
+def api_screen():
+    """
+    Key metrics for every stored ticker, computed in one vectorized pass. ?where= filters
+    ("fcf_margin > 10% and revenue_cagr_3y > 5%"), ?sort= orders ("-fcf_margin" for
+    descending), ?limit= caps the rows and ?ticker= (repeatable) restricts the universe.
+    """
+    if statement_store is None:
+        return _api_error("The statement store is disabled.", 503)
+    try:
+        frame = StatementScreener(statement_store).screen(
+            request.args.get('where'), sort=request.args.get('sort'),
+            limit=request.args.get('limit', type=int), tickers=request.args.getlist('ticker'))
+    except ValueError as bad_request:
+        return _api_error(str(bad_request), 400)
+    return jsonify(metrics=StatementScreener.METRICS, count=len(frame), results=StatementScreener.records(frame))
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint: per-stage metrics summed over all app processes."""
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        return Response("Unauthorized\n", status=401, mimetype='text/plain')
+    body = stage_metrics.render(extra_gauges={
+        'statement_app_startup_seconds': ("Seconds from first import to a ready processor.", app.config['STARTUP_SECONDS']),
+    })
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
 # --- Main Execution ---
 if __name__ == '__main__':
+    stage_metrics.clear()
     # Development server (use Gunicorn for production/Render)
     # Host 0.0.0.0 makes it accessible on network (needed for Render health checks)
     # Use PORT environment variable provided by Render, default to 8080 locally
     port = int(os.environ.get("PORT", 8080))
     # Set debug=False for production environments like Render
-    app.run(host='0.0.0.0', port=port, debug=False)
+    app.run(host='0.0.0.0', port=port, debug=False, threaded=True) # Requests may run concurrently; see processor.py
@@ -0,0 +1,228 @@
+"""
+Offline batch processing: runs every TICKER_annual_*.csv triple in a directory through the
+statement processor, without Flask, and writes the populated workbooks and/or columnar JSON
+to an output directory.
+
+    python batch.py INPUT_DIR --template master.xlsx --output OUT_DIR --workers 4 --format both
+
+Tickers whose inputs (and template) are unchanged since the last run into OUT_DIR are skipped;
+pass --force to rebuild them anyway. Exits 1 if any ticker failed.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from processor import FinancialStatementProcessor, StatementStore, columnar_statements, configure_logging
+
+MANIFEST_NAME = '.batch_manifest.json'
+FORMATS = {'xlsx': ('xlsx',), 'json': ('json',), 'both': ('xlsx', 'json')}
+STATEMENT_TYPES = ('financials', 'balance-sheet', 'cash-flow')
+
+_processor = None # Built in the parent and inherited by forked workers; see _init_worker
+
+
+def _init_worker(template_path, store_path=None):
+    global _processor
+    if _processor is None:
+        _processor = FinancialStatementProcessor(template_path, statement_store=StatementStore(store_path) if store_path else None)
+
+
+def find_tickers(input_dir):
+    """Groups the directory's statement CSVs by ticker. Returns ({ticker: [3 paths]}, problems)."""
+    pattern = FinancialStatementProcessor.FILENAME_PATTERN
+    found = {}
+    problems = []
+    for filename in sorted(os.listdir(input_dir)):
+        path = os.path.join(input_dir, filename)
+        if not filename.lower().endswith('.csv') or not os.path.isfile(path):
+            continue
+        match = pattern.fullmatch(filename)
+        if not match:
+            problems.append(f"{filename}: name does not match TICKER_annual_type.csv")
+            continue
+        ticker, statement = match.group(1).upper(), match.group(2).lower()
+        statements = found.setdefault(ticker, {})
+        if statement in statements:
+            problems.append(f"{filename}: duplicate {statement} file for {ticker}")
+            continue
+        statements[statement] = path
+    tickers = {}
+    for ticker, statements in sorted(found.items()):
+        missing = [statement for statement in STATEMENT_TYPES if statement not in statements]
+        if missing:
+            problems.append(f"{ticker}: missing required file types: {', '.join(missing)}")
+        else:
+            tickers[ticker] = [statements[statement] for statement in STATEMENT_TYPES]
+    return tickers, problems
+
+
+def output_paths(output_dir, ticker, formats):
+    names = {'xlsx': f"{ticker}_analysis.xlsx", 'json': f"{ticker}.json"}
+    return {fmt: os.path.join(output_dir, names[fmt]) for fmt in formats}
+
+
+def _write_atomically(path, write):
+    """Writes through a temporary file in the same directory, so a crash never leaves a partial output."""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _write_json(path, payload):
+    with open(path, 'w') as json_file:
+        json.dump(payload, json_file, separators=(',', ':'), allow_nan=False)
+
+
+def run_ticker(ticker, file_paths, cache_key, output_dir, formats):
+    """Executed in a pool worker: builds one ticker's workbook and writes the requested outputs."""
+    started = time.perf_counter()
+    try:
+        ticker_symbol, file_map = _processor.classify_files(file_paths)
+        statement_dfs = _processor.load_statements(file_map)
+        paths = output_paths(output_dir, ticker_symbol, formats)
+        needs_values = 'json' in paths or _processor.statement_store is not None
+        # The xlsx is streamed from the template and the values are evaluated without a workbook;
+        # an openpyxl workbook is only built if the template cannot be streamed
+        output_wb = _processor.stream_workbook(statement_dfs) if 'xlsx' in paths else None
+        wb = None
+        if 'xlsx' in paths and output_wb is None:
+            wb, _ = _processor.build_workbook(file_map, statement_dfs)
+        if needs_values:
+            sheets = _processor.evaluate_statements(file_map, statement_dfs=statement_dfs).sheets
+            result = {'ticker': ticker_symbol, 'sheets': sheets, 'result_key': cache_key}
+        if _processor.statement_store is not None:
+            _processor.store_result(result, statement_dfs)
+        if 'json' in paths:
+            _write_atomically(paths['json'], lambda temp_path: _write_json(temp_path, columnar_statements(result)))
+        if 'xlsx' in paths:
+            _write_atomically(paths['xlsx'], (output_wb or wb).save)
+        if wb is not None:
+            wb.close()
+        return {'ticker': ticker, 'status': 'ok', 'seconds': time.perf_counter() - started}
+    except (ValueError, FileNotFoundError) as user_error:
+        return {'ticker': ticker, 'status': 'error', 'error': str(user_error)}
+    except Exception as e:
+        logging.error(f"Unexpected error processing {ticker}: {e}", exc_info=True)
+        return {'ticker': ticker, 'status': 'error', 'error': f"{type(e).__name__}: {e}"}
+
+
+def load_manifest(output_dir):
+    """{ticker: {'key', 'formats'}} from the previous run, or {} if there is none (or it is unreadable)."""
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as manifest_file:
+            return json.load(manifest_file).get('tickers', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(output_dir, tickers):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    _write_atomically(path, lambda temp_path: _write_json(temp_path, {'tickers': tickers}))
+
+
+def is_current(entry, cache_key, paths):
+    """True if the previous run wrote these outputs from identical inputs and template."""
+    return (entry is not None and entry.get('key') == cache_key
+            and set(paths) <= set(entry.get('formats', ()))
+            and all(os.path.exists(path) for path in paths.values()))
+
+
+def run_batch(input_dir, template_path, output_dir, workers=None, formats=FORMATS['xlsx'], force=False, store_path=None):
+    """
+    Processes every ticker in input_dir. With store_path, results also go into that
+    StatementStore database. Returns the number of tickers that failed.
+    """
+    global _processor
+    _processor = FinancialStatementProcessor(template_path, statement_store=StatementStore(store_path) if store_path else None)
+    if _processor.template_pool is None:
+        raise RuntimeError(f"Could not load the template {template_path}; see the log for details.")
+    os.makedirs(output_dir, exist_ok=True)
+
+    tickers, problems = find_tickers(input_dir)
+    for problem in problems:
+        print(f"SKIP   {problem}")
+    manifest = load_manifest(output_dir)
+
+    queued = {}
+    processed = unchanged = failures = 0
+    for ticker, file_paths in tickers.items():
+        try:
+            # The content key covers the three files, the ticker and the template fingerprint
+            _, file_map = _processor.classify_files(file_paths)
+            cache_key = _processor.result_cache_key(ticker, file_map)
+        except (ValueError, OSError) as e:
+            print(f"ERROR  {ticker}: {e}")
+            failures += 1
+            continue
+        if not force and is_current(manifest.get(ticker), cache_key, output_paths(output_dir, ticker, formats)):
+            print(f"SAME   {ticker}")
+            unchanged += 1
+            continue
+        queued[ticker] = (file_paths, cache_key)
+
+    if queued:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_worker, initargs=(template_path, store_path)) as executor:
+            futures = {executor.submit(run_ticker, ticker, file_paths, cache_key, output_dir, formats): ticker
+                       for ticker, (file_paths, cache_key) in queued.items()}
+            for future in as_completed(futures):
+                ticker = futures[future]
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    entry = {'ticker': ticker, 'status': 'error', 'error': f"Worker process failed: {e}"}
+                if entry['status'] == 'ok':
+                    print(f"OK     {ticker} ({entry['seconds']:.2f}s)")
+                    processed += 1
+                    # Recorded as each ticker finishes, so an interrupted run keeps the work already done
+                    cache_key = queued[ticker][1]
+                    previous = manifest.get(ticker) or {}
+                    kept = previous.get('formats', []) if previous.get('key') == cache_key else []
+                    manifest[ticker] = {'key': cache_key, 'formats': sorted(set(kept) | set(formats))}
+                    save_manifest(output_dir, manifest)
+                else:
+                    print(f"ERROR  {ticker}: {entry['error']}")
+                    manifest.pop(ticker, None)
+                    failures += 1
+
+    print(f"{len(tickers)} tickers: {processed} processed, {unchanged} unchanged, {failures} failed")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process a directory of statement CSV triples without the web app.")
+    parser.add_argument('input_dir', help="Directory holding TICKER_annual_{financials,balance-sheet,cash-flow}.csv files")
+    parser.add_argument('--template', required=True, help="Master template .xlsx")
+    parser.add_argument('--output', required=True, help="Directory for the workbooks / JSON files and the run manifest")
+    parser.add_argument('--workers', type=int, default=None, help="Process pool size (default: CPU count)")
+    parser.add_argument('--format', choices=sorted(FORMATS), default='xlsx')
+    parser.add_argument('--force', action='store_true', help="Reprocess tickers even if their inputs are unchanged")
+    parser.add_argument('--store', help="Also upsert the results into this statement store (SQLite file)")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Log the pipeline's progress messages")
+    args = parser.parse_args()
+
+    # Written directly: pool workers exit without running atexit, which would drop queued records
+    configure_logging(logging.INFO if args.verbose else logging.WARNING, use_queue=False)
+    if not os.path.isdir(args.input_dir):
+        parser.error(f"{args.input_dir} is not a directory")
+    try:
+        failures = run_batch(args.input_dir, args.template, args.output, args.workers, FORMATS[args.format], args.force, args.store)
+    except RuntimeError as e:
+        print(f"ERROR  {e}", file=sys.stderr)
+        sys.exit(2)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Synthetic inputs for the benchmarks: statement CSVs shaped like the uploads
+(TICKER_annual_financials.csv, _balance-sheet.csv, _cash-flow.csv) and a stand-in
+master template with the same sheet layout and VLOOKUP formula blocks as production.
+
+    python benchmarks/generate_statements.py OUT_DIR --tickers AAPL MSFT --rows 200 --periods 12
+"""
+import argparse
+import os
+import random
+from datetime import date
+
+import openpyxl
+from openpyxl.utils import get_column_letter
+
+STATEMENT_FILES = {
+    'financials': ["TotalRevenue", "CostOfRevenue", "GrossProfit", "OperatingIncome", "NetIncome"],
+    'balance-sheet': ["TotalAssets", "TotalLiabilities", "TotalDebt", "StockholdersEquity"],
+    'cash-flow': ["OperatingCashFlow", "CapitalExpenditure", "FreeCashFlow"],
+}
+
+
+def _format_number(value):
+    """Formats a value the way the statement exports do: "1,234", "(56)" for negatives."""
+    text = f"{abs(value):,}"
+    return f'"({text})"' if value < 0 else f'"{text}"'
+
+
+def write_statement_csvs(out_dir, ticker, rows=40, periods=10, blank_ratio=0.05, seed=0):
+    """
+    Writes the three annual statement CSVs for one ticker and returns their paths.
+    Each file has a name column, a ttm column and `periods - 1` fiscal year-end columns,
+    with `rows` line items after the named ones. Labels are padded with tabs/spaces,
+    numbers are comma-formatted, negatives are parenthesized and some cells are blank.
+    """
+    rng = random.Random(f"{seed}:{ticker}")
+    os.makedirs(out_dir, exist_ok=True)
+    last_year = date.today().year - 1
+    header = ["name", "ttm"] + [f"12/31/{last_year - i}" for i in range(periods - 1)]
+    paths = []
+    for statement, named_items in STATEMENT_FILES.items():
+        path = os.path.join(out_dir, f"{ticker}_annual_{statement}.csv")
+        with open(path, 'w', newline='') as csv_file:
+            csv_file.write(",".join(header) + "\n")
+            for item in named_items + [f"LineItem{i}" for i in range(rows)]:
+                values = ["" if rng.random() < blank_ratio else _format_number(rng.randint(-50000, 900000))
+                          for _ in range(periods)]
+                csv_file.write(f"\t{item} ," + ",".join(values) + "\n")
+        paths.append(path)
+    return paths
+
+
+def write_template(path, periods=10):
+    """
+    Writes a template with the sheets, header rows and formula ranges the processor expects
+    (FORMULA_CONFIG: C2:L8, B2:K5, C2:L5), built from VLOOKUPs over the appended rows.
+    """
+    wb = openpyxl.Workbook()
+    income = wb.active
+    income.title = "Income Statement"
+    balance = wb.create_sheet("Balance Sheet")
+    cash_flow = wb.create_sheet("Cash Flow Statement")
+    wb.create_sheet("Notes")["A1"] = "Synthetic benchmark template"
+
+    layouts = (
+        # sheet, header row, first formula column, item lookups
+        (income, 9, 3, ["TotalRevenue", "GrossProfit", "OperatingIncome", "NetIncome"]),
+        (balance, 6, 2, ["TotalAssets", "TotalDebt", "StockholdersEquity"]),
+        (cash_flow, 8, 3, ["OperatingCashFlow", "FreeCashFlow"]),
+    )
+    for ws, header_row, first_col, items in layouts:
+        data_start = header_row + 1
+        last_col = get_column_letter(first_col + 9)
+        ws.cell(row=1, column=1, value="Metric")
+        ws.cell(row=header_row, column=1, value="Breakdown")
+        for offset in range(periods):
+            ws.cell(row=header_row, column=2 + offset, value="ttm" if offset == 0 else f"FY-{offset}")
+        for row, item in enumerate(items, start=2):
+            ws.cell(row=row, column=1, value=item)
+            for offset in range(10):
+                ws.cell(row=row, column=first_col + offset,
+                        value=f"=VLOOKUP($A{row},$A${data_start}:${last_col}${data_start + 1},{offset + 2},FALSE)")
+
+    # Ratio rows reading other statements, as the production template does
+    for offset in range(10):
+        col = get_column_letter(3 + offset)
+        income[f"{col}6"] = f"=IFERROR({col}5/{col}2,0)"
+        income[f"{col}7"] = f"=IFERROR({col}3/{col}2,0)"
+        cash_flow[f"{col}4"] = (f"=IFERROR(VLOOKUP(\"FreeCashFlow\",$A$9:$L$10,{offset + 2},FALSE)/"
+                                f"VLOOKUP(\"TotalRevenue\",'Income Statement'!$A$10:$L$11,{offset + 2},FALSE),0)")
+    wb.save(path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic statement CSVs and a template for benchmarking.")
+    parser.add_argument('out_dir')
+    parser.add_argument('--tickers', nargs='+', default=["BENCH"])
+    parser.add_argument('--rows', type=int, default=40, help="Line items per statement beyond the named ones")
+    parser.add_argument('--periods', type=int, default=10, help="Period columns, including ttm")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--template', action='store_true', help="Also write template.xlsx")
+    args = parser.parse_args()
+    for ticker in args.tickers:
+        write_statement_csvs(args.out_dir, ticker, rows=args.rows, periods=args.periods, seed=args.seed)
+    if args.template:
+        write_template(os.path.join(args.out_dir, 'template.xlsx'), periods=args.periods)
+    print(f"Wrote {len(args.tickers)} ticker(s) to {args.out_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""
+Times each stage of the processing pipeline and the end-to-end upload POST, and writes
+the timings as JSON so runs can be compared.
+
+    python benchmarks/run_benchmarks.py --rows 200 --periods 12 --output bench.json
+    python benchmarks/run_benchmarks.py --compare bench.json   # exits 1 on a regression
+
+Without --template a synthetic template is generated (see generate_statements.py); pass
+the production template to measure the real formula layout.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from generate_statements import write_statement_csvs, write_template # noqa: E402
+
+SHEETS = (
+    # sheet name, index of the CSV returned by write_statement_csvs
+    ("Income Statement", 0),
+    ("Balance Sheet", 1),
+    ("Cash Flow Statement", 2),
+)
+
+
+def _time(samples, name, func):
+    """Runs func once, records its duration under name and returns its result."""
+    started = time.perf_counter()
+    result = func()
+    samples.setdefault(name, []).append(time.perf_counter() - started)
+    return result
+
+
+def bench_stages(processor, csv_paths, repeat):
+    """Times the pipeline stages one by one, as process_files_for_web runs them."""
+    from openpyxl import load_workbook
+    from processor import UploadedFile
+    samples = {}
+    file_map = {file_type: csv_paths[index] for file_type, (_, index) in zip(processor.STATEMENT_FILES, SHEETS)}
+    # The same upload with one line item added to the cash flow statement
+    with open(csv_paths[2], 'rb') as csv_file:
+        changed = UploadedFile(os.path.basename(csv_paths[2]), csv_file.read() + b'\tAddedItem ,"1,234"\n')
+    changed_map = dict(file_map, cashflow=changed)
+    for _ in range(repeat):
+        frames = {}
+        for sheet_name, index in SHEETS:
+            raw = _time(samples, 'load_csv', lambda: processor.load_csv(csv_paths[index], sheet_name))
+            frames[sheet_name] = _time(samples, 'clean_data', lambda: processor.clean_data(raw, sheet_name))
+
+        wb = _time(samples, 'template_checkout', processor.template_pool.checkout)
+        occupancy = {name: index.copy() for name, index in processor.template_occupancy.items()}
+        for sheet_name, _ in SHEETS:
+            # append_data_to_excel applies the alignment itself; apply_formatting is timed again
+            # on its own over the same rows so its share can be seen
+            _time(samples, 'append_data_to_excel', lambda: processor.append_data_to_excel(
+                frames[sheet_name], wb, sheet_name, processor.SHEET_APPEND_ROWS[sheet_name], occupancy[sheet_name]))
+            _time(samples, 'apply_formatting', lambda: processor.apply_formatting(
+                wb[sheet_name], processor.SHEET_APPEND_ROWS[sheet_name], len(frames[sheet_name])))
+
+        data_lengths = {sheet_name: len(frames[sheet_name]) for sheet_name, _ in SHEETS}
+        _time(samples, 'update_formulas', lambda: processor.update_formulas(
+            wb, data_lengths, processor.FORMULA_CONFIG, occupancy, processor.formula_rewrite_plan))
+
+        # The request path no longer saves and reloads, but downloads still serialize the workbook
+        buffer = io.BytesIO()
+        _time(samples, 'save', lambda: wb.save(buffer))
+        buffer.seek(0)
+        _time(samples, 'reload', lambda: load_workbook(buffer, data_only=False))
+        # Downloads and batch outputs are streamed from the template instead of saved from wb
+        _time(samples, 'stream_save', lambda: processor.stream_workbook(frames).save(io.BytesIO()))
+
+        _time(samples, '_extract_data_from_workbook',
+              lambda: processor._extract_data_from_workbook(wb, processor.DISPLAY_CONFIGS))
+
+        # The request path evaluates the display sheets on a view of the template, without a workbook
+        evaluation = _time(samples, 'evaluate_statements', lambda: processor.evaluate_statements(file_map, statement_dfs=frames))
+        # A re-upload with one statement changed only reloads that file and re-evaluates what it reaches
+        _time(samples, 'evaluate_incremental', lambda: processor.evaluate_statements(changed_map, evaluation))
+    return samples
+
+
+def bench_index_post(app_module, csv_paths, repeat):
+    """Times POST / through Flask's test client, with the result cache off and then warm."""
+    samples = {}
+    app_module.app.config['ASYNC_JOBS'] = False
+    app_module.app.config['TESTING'] = True
+    client = app_module.app.test_client()
+
+    def post():
+        data = {'csv_files': [(open(path, 'rb'), os.path.basename(path)) for path in csv_paths]}
+        response = client.post('/', data=data, content_type='multipart/form-data')
+        if response.status_code != 200 or b'alert-danger' in response.data:
+            raise RuntimeError(f"Upload failed with status {response.status_code}")
+        return response
+
+    processor = app_module.processor
+    cache = processor.result_cache
+    processor.result_cache = None
+    try:
+        for _ in range(repeat):
+            _time(samples, 'index_post', post)
+    finally:
+        processor.result_cache = cache
+    if cache is not None:
+        post() # Fill the cache
+        for _ in range(repeat):
+            _time(samples, 'index_post_cached', post)
+    return samples
+
+
+def summarize(samples):
+    """Per-stage statistics; stages run once per sheet have three samples per repeat."""
+    return {
+        name: {
+            'runs': len(values),
+            'min': min(values),
+            'median': statistics.median(values),
+            'mean': statistics.fmean(values),
+            'max': max(values),
+        }
+        for name, values in samples.items()
+    }
+
+
+def compare(current, baseline, threshold):
+    """Returns (name, baseline median, current median) for stages slower than baseline by more than threshold."""
+    regressions = []
+    for name, stats in current['stages'].items():
+        previous = baseline.get('stages', {}).get(name)
+        if previous and stats['median'] > previous['median'] * (1 + threshold):
+            regressions.append((name, previous['median'], stats['median']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the financial statement pipeline.")
+    parser.add_argument('--rows', type=int, default=40, help="Line items per statement beyond the named ones")
+    parser.add_argument('--periods', type=int, default=10, help="Period columns per statement, including ttm")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--template', help="Template .xlsx to use instead of a generated one")
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout")
+    parser.add_argument('--compare', help="Baseline JSON from an earlier run; exit 1 if a stage regressed")
+    parser.add_argument('--threshold', type=float, default=0.25, help="Allowed median slowdown for --compare (0.25 = 25%%)")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    # Configure logging before app.py does, so the pipeline's INFO lines don't swamp the output
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+    import processor as processor_module
+    import app as app_module
+
+    with tempfile.TemporaryDirectory(prefix='stmt_bench_') as work_dir:
+        template_path = args.template or write_template(os.path.join(work_dir, 'template.xlsx'), periods=args.periods)
+        csv_paths = write_statement_csvs(work_dir, 'BENCH', rows=args.rows, periods=args.periods)
+
+        started = time.perf_counter()
+        processor = processor_module.FinancialStatementProcessor(
+            template_path,
+            result_cache=processor_module.ResultCache(max_entries=4),
+            workbook_store=processor_module.WorkbookStore(max_pending=1, byte_cache=processor_module.ResultCache(max_entries=1)),
+        )
+        samples = {'processor_init': [time.perf_counter() - started]}
+        app_module.processor = processor
+
+        samples.update(bench_stages(processor, csv_paths, args.repeat))
+        samples.update(bench_index_post(app_module, csv_paths, args.repeat))
+
+    import openpyxl
+    import pandas
+    results = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'parameters': {'rows': args.rows, 'periods': args.periods, 'repeat': args.repeat,
+                       'template': args.template or 'synthetic'},
+        'environment': {'python': platform.python_version(), 'pandas': pandas.__version__,
+                        'openpyxl': openpyxl.__version__, 'platform': platform.platform()},
+        'unit': 'seconds',
+        'stages': summarize(samples),
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('parameters') != results['parameters']:
+            print(f"Note: baseline was run with {baseline.get('parameters')}", file=sys.stderr)
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after in regressions:
+            print(f"REGRESSION {name}: median {before * 1000:.2f}ms -> {after * 1000:.2f}ms", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+# Gunicorn settings, picked up automatically from the working directory (see Procfile).
+import os
+
+# Import app.py once in the master: the template is decoded and parsed a single time and
+# forked workers share that memory copy-on-write instead of each repeating the startup work.
+preload_app = True
+
+# Threaded serving: WEB_THREADS > 1 gives each worker process that many request threads
+# (gunicorn switches to its gthread worker). The processor is safe to share between threads
+# (see processor.py), so one worker's template copy and caches serve several uploads at once,
+# at a fraction of the memory of the extra processes. Workers default to $WEB_CONCURRENCY or 1.
+threads = int(os.environ.get('WEB_THREADS', 1))
+
+
+def when_ready(server):
+    # Runs in the master after the preloaded app is imported, before any worker is forked
+    from app import prepare_for_workers
+    prepare_for_workers()
@@ -0,0 +1,3346 @@
+"""
+The statement processing engine: appends the three statement CSVs to the master template,
+rewrites its formulas and extracts the computed sheets. The displayed values are evaluated on a
+view of the template overlaid with the statements (PopulatedWorkbookView), and a re-upload for a
+ticker only re-evaluates the formulas its changes reach (FormulaDependencyGraph). Populated
+workbooks are written out by streaming the statement rows into a copy of the template file
+(StreamingWorkbookWriter). Nothing here depends on Flask, so the web app (app.py) and the batch
+CLI (batch.py) share it.
+
+Concurrency: a FinancialStatementProcessor can serve any number of threads at once. Once
+__init__ returns, its template state (the parsed master, the formula rewrite plan and dependency
+graph, the row index and extents, the registered style ids, the streaming writer's prepared
+parts) is only read. Each call works on its own view or template copy, row index and formula
+evaluator, a previous StatementEvaluation it starts from is never modified, inputs are held in
+memory rather than on shared paths, and the caches, stores and metrics it shares lock
+internally. Forked processes can share an instance in the same way.
+"""
+import openpyxl
+from openpyxl import load_workbook
+from openpyxl.cell.cell import ERROR_CODES, ILLEGAL_CHARACTERS_RE, TIME_TYPES
+from openpyxl.compat import safe_string
+from openpyxl.compat.numbers import NUMERIC_TYPES
+from openpyxl.formula import Tokenizer
+from openpyxl.formula.tokenizer import Token
+from openpyxl.styles import Alignment, numbers
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.datetime import to_excel
+from openpyxl.utils.exceptions import IllegalCharacterError
+from openpyxl.utils.indexed_list import IndexedList
+import os
+import io
+import atexit
+import bisect
+import contextlib
+import copy
+import functools
+import hashlib
+import json
+import math
+import operator
+import pickle
+import posixpath
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+import zipfile
+from collections import OrderedDict, defaultdict, namedtuple
+from datetime import datetime
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr, unescape
+import logging
+import logging.handlers
+try:
+    import resource # Peak RSS for the stage metrics; not available on Windows
+except ImportError:
+    resource = None
+
+# Excel's sheet size limits (openpyxl does not enforce them on write)
+EXCEL_MAX_ROW = 1048576
+EXCEL_MAX_COLUMN = 16384
+
+
+def _temp_path(path):
+    """A scratch name next to path that no other process or thread uses, for write-then-rename."""
+    return f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+
+
+def _reset_in_forked_children(obj):
+    """
+    Calls obj._after_fork() in forked children. Under a threaded server the job and bulk pools
+    fork from request threads, possibly while another thread holds one of obj's locks.
+    """
+    if hasattr(os, 'register_at_fork'):
+        ref = weakref.ref(obj)
+        os.register_at_fork(after_in_child=lambda: ref() is not None and ref()._after_fork())
+
+# --- Logging ---
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line: time, level, message, plus any fields passed as extra={'fields': {...}}."""
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'message': record.getMessage()}
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues records untouched. The stock QueueHandler formats the message in the calling thread
+    so records can be pickled; this queue never leaves the process, so the listener thread does it.
+    """
+    def prepare(self, record):
+        return record
+
+
+class _QueueLogging:
+    """The root handler for configure_logging(use_queue=True), with the listener thread writing behind it."""
+    def __init__(self, target):
+        self.target = target
+        self.handler = _DeferredQueueHandler(queue.SimpleQueue())
+        self.listener = None
+        self._start()
+        atexit.register(self.stop) # Write out what is still queued
+        # The listener thread does not survive a fork (gunicorn workers, job pools); start a new one
+        _reset_in_forked_children(self)
+
+    def _start(self):
+        self.listener = logging.handlers.QueueListener(self.handler.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+
+    def _after_fork(self):
+        # Records still queued at the fork belong to the parent, which writes them itself
+        self.handler.queue = queue.SimpleQueue()
+        self._start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+
+def configure_logging(level='INFO', fmt='text', use_queue=True):
+    """
+    Sets up the root logger for the app and the batch CLI: plain text (LOG_FORMAT) or one JSON
+    object per line (fmt='json'), written to stderr. With use_queue, logging calls only put the
+    record on a queue and a background thread formats and writes it, so request threads never
+    wait on log I/O. Like logging.basicConfig, does nothing if the root logger already has handlers.
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    target = logging.StreamHandler()
+    target.setFormatter(JsonLogFormatter() if fmt == 'json' else logging.Formatter(LOG_FORMAT))
+    root.addHandler(_QueueLogging(target).handler if use_queue else target)
+    root.setLevel(level)
+
+
+# --- Template Pool ---
+class TemplatePool:
+    """
+    Keeps the parsed master template resident in memory and hands out an
+    independent copy of it for each request, so the xlsx zip is only read
+    and parsed once per process.
+    """
+    def __init__(self, master_wb):
+        self._master = master_wb
+
+    def checkout(self):
+        """Returns a fresh, fully independent copy of the master workbook."""
+        # openpyxl keeps its style tables in IndexedList objects, which do not survive
+        # copy.deepcopy (the items are dropped because the lookup dict is restored first).
+        # Seed the memo with rebuilt lists so cell style indices stay valid in the copy.
+        memo = {}
+        for attr_value in vars(self._master).values():
+            if isinstance(attr_value, IndexedList):
+                memo[id(attr_value)] = IndexedList(copy.deepcopy(list(attr_value)))
+        return copy.deepcopy(self._master, memo)
+
+
+# --- Formula Evaluation ---
+class FormulaError(Exception):
+    """An Excel error value (e.g. '#N/A') raised while evaluating a formula."""
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_formula(formula):
+    """
+    Parses an Excel formula string into a small expression tree of nested tuples.
+    Results are cached because the same template formulas are evaluated on every request.
+    """
+    tokens = [t for t in Tokenizer(formula).items if t.type != Token.WSPACE]
+    parser = _FormulaParser(tokens)
+    tree = parser.parse_expression()
+    if parser.pos != len(tokens):
+        raise FormulaError('#NAME?')
+    return tree
+
+
+class _FormulaParser:
+    """Recursive-descent parser over openpyxl Tokenizer tokens, using Excel operator precedence."""
+    _COMPARISON_OPS = ('=', '<>', '<', '>', '<=', '>=')
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise FormulaError('#NAME?')
+        self.pos += 1
+        return token
+
+    def _peek_infix(self, ops):
+        token = self._peek()
+        if token is not None and token.type == Token.OP_IN and token.value in ops:
+            self.pos += 1
+            return token.value
+        return None
+
+    def _binary(self, operand, ops):
+        left = operand()
+        op = self._peek_infix(ops)
+        while op is not None:
+            left = ('bin', op, left, operand())
+            op = self._peek_infix(ops)
+        return left
+
+    def parse_expression(self):
+        return self._binary(self._parse_concat, self._COMPARISON_OPS)
+
+    def _parse_concat(self):
+        return self._binary(self._parse_additive, ('&',))
+
+    def _parse_additive(self):
+        return self._binary(self._parse_multiplicative, ('+', '-'))
+
+    def _parse_multiplicative(self):
+        return self._binary(self._parse_power, ('*', '/'))
+
+    def _parse_power(self):
+        return self._binary(self._parse_unary, ('^',))
+
+    def _parse_unary(self):
+        token = self._peek()
+        if token is not None and token.type == Token.OP_PRE:
+            self.pos += 1
+            operand = self._parse_unary()
+            return ('neg', operand) if token.value == '-' else operand
+        return self._parse_postfix()
+
+    def _parse_postfix(self):
+        node = self._parse_primary()
+        token = self._peek()
+        while token is not None and token.type == Token.OP_POST and token.value == '%':
+            self.pos += 1
+            node = ('pct', node)
+            token = self._peek()
+        return node
+
+    def _parse_primary(self):
+        token = self._next()
+        if token.type == Token.OPERAND:
+            if token.subtype == Token.NUMBER:
+                return ('const', float(token.value) if any(ch in token.value for ch in '.eE') else int(token.value))
+            if token.subtype == Token.TEXT:
+                return ('const', token.value[1:-1].replace('""', '"'))
+            if token.subtype == Token.LOGICAL:
+                return ('const', token.value.upper() == 'TRUE')
+            if token.subtype == Token.ERROR:
+                return ('error', token.value)
+            return self._parse_reference(token.value)
+        if token.type == Token.FUNC and token.subtype == Token.OPEN:
+            name = token.value[:-1].upper()
+            if name.startswith('_XLFN.'):
+                name = name[len('_XLFN.'):]
+            args = []
+            closing = self._peek()
+            if closing is not None and closing.type == Token.FUNC and closing.subtype == Token.CLOSE:
+                self.pos += 1
+                return ('func', name, ())
+            while True:
+                args.append(self.parse_expression())
+                token = self._next()
+                if token.type == Token.SEP and token.subtype == Token.ARG:
+                    continue
+                if token.type == Token.FUNC and token.subtype == Token.CLOSE:
+                    return ('func', name, tuple(args))
+                raise FormulaError('#NAME?')
+        if token.type == Token.PAREN and token.subtype == Token.OPEN:
+            node = self.parse_expression()
+            closing = self._next()
+            if closing.type != Token.PAREN or closing.subtype != Token.CLOSE:
+                raise FormulaError('#NAME?')
+            return node
+        raise FormulaError('#NAME?')
+
+    @staticmethod
+    def _parse_reference(ref):
+        sheet_name = None
+        if '!' in ref:
+            sheet_part, ref = ref.rsplit('!', 1)
+            sheet_name = sheet_part[1:-1].replace("''", "'") if sheet_part.startswith("'") else sheet_part
+        try:
+            min_col, min_row, max_col, max_row = openpyxl.utils.range_boundaries(ref.replace('$', ''))
+        except (ValueError, TypeError):
+            # Defined names and other references the evaluator does not understand
+            return ('error', '#NAME?')
+        return ('ref', sheet_name, (min_col, min_row, max_col, max_row), ':' in ref)
+
+
+class FormulaEvaluator:
+    """
+    Computes formula results directly on an in-memory openpyxl workbook, so extracted values
+    no longer depend on an Excel recalculation or a save/reload with data_only=True.
+    Supports arithmetic and comparison operators, cross-sheet references and the functions
+    the template relies on (VLOOKUP, SUM and a few common helpers). Anything else evaluates
+    to an Excel error string such as '#NAME?'.
+    wb may also be a PopulatedWorkbookView. values and lookup_indexes carry results over from an
+    earlier evaluation whose inputs are known not to have changed (see StatementEvaluation);
+    lookup_indexes is only read, so it can be shared.
+    """
+    def __init__(self, wb, values=None, lookup_indexes=None):
+        self.wb = wb
+        # wb[name] and wb.sheetnames rebuild the sheet list on every call, so resolve the sheets once
+        self._sheet_cells = {ws.title: ws._cells for ws in wb.worksheets}
+        self._values = values if values is not None else {} # (sheet, row, col) -> computed formula result
+        self._in_progress = set() # cells currently being evaluated (cycle guard)
+        self._lookup_indexes = dict(lookup_indexes or {}) # (sheet, bounds) -> {normalized first-column key: row offset}
+        self.error_count = 0      # formulas that failed with an unexpected error (shown as #VALUE!)
+        self._functions = {
+            'SUM': self._fn_sum,
+            'VLOOKUP': self._fn_vlookup,
+            'IF': self._fn_if,
+            'IFERROR': self._fn_iferror,
+            'MIN': self._fn_min,
+            'MAX': self._fn_max,
+            'AVERAGE': self._fn_average,
+            'ABS': self._fn_abs,
+            'ROUND': self._fn_round,
+        }
+
+    # --- Cell access ---
+    def value(self, sheet_name, row, col):
+        """Returns the value of a cell as Excel would display it, evaluating formulas on demand."""
+        try:
+            return self._cell_value(sheet_name, row, col)
+        except FormulaError as fe:
+            return fe.code
+
+    def _cell_value(self, sheet_name, row, col):
+        key = (sheet_name, row, col)
+        if key in self._values:
+            return self._scalar(self._values[key])
+        # Read the cell without creating it (ws.cell() would add empty cells to the sheet)
+        cell = self._sheet_cells[sheet_name].get((row, col))
+        raw = cell.value if cell is not None else None
+        if not (isinstance(raw, str) and raw.startswith('=') and cell.data_type == 'f'):
+            return raw
+        if key in self._in_progress:
+            # Circular reference: Excel shows 0 without iterative calculation enabled
+            return 0
+        self._in_progress.add(key)
+        try:
+            result = self._evaluate(compile_formula(raw), sheet_name)
+            if isinstance(result, _RangeRef):
+                result = result.top_left()
+            if result is None:
+                # A formula pointing at a blank cell displays 0 in Excel
+                result = 0
+        except FormulaError as fe:
+            self._values[key] = fe
+            raise
+        except Exception as e:
+            # Counted per extraction (see error_count) rather than logged per cell
+            self.error_count += 1
+            logging.debug("Could not evaluate formula %s!%s%s '%s': %s", sheet_name, get_column_letter(col), row, raw, e)
+            self._values[key] = FormulaError('#VALUE!')
+            raise self._values[key]
+        finally:
+            self._in_progress.discard(key)
+        self._values[key] = result
+        return result
+
+    # --- Expression evaluation ---
+    def _evaluate(self, node, sheet_name):
+        kind = node[0]
+        if kind == 'const':
+            return node[1]
+        if kind == 'ref':
+            _, ref_sheet, bounds, is_range = node
+            ref_sheet = ref_sheet or sheet_name
+            if ref_sheet not in self._sheet_cells:
+                raise FormulaError('#REF!')
+            if not is_range:
+                return self._scalar(self._cell_value(ref_sheet, bounds[1], bounds[0]))
+            return _RangeRef(self, ref_sheet, bounds)
+        if kind == 'func':
+            handler = self._functions.get(node[1])
+            if handler is None:
+                raise FormulaError('#NAME?')
+            return handler(node[2], sheet_name)
+        if kind == 'bin':
+            return self._binary_op(node[1], self._evaluate(node[2], sheet_name), self._evaluate(node[3], sheet_name))
+        if kind == 'neg':
+            return -self._number(self._evaluate(node[1], sheet_name))
+        if kind == 'pct':
+            return self._number(self._evaluate(node[1], sheet_name)) / 100
+        if kind == 'error':
+            raise FormulaError(node[1])
+        raise FormulaError('#VALUE!')
+
+    def _binary_op(self, op, left, right):
+        if isinstance(left, _RangeRef): left = left.top_left()
+        if isinstance(right, _RangeRef): right = right.top_left()
+        if op == '&':
+            return self._text(left) + self._text(right)
+        if op in _FormulaParser._COMPARISON_OPS:
+            return _compare(op, left, right)
+        left, right = self._number(left), self._number(right)
+        if op == '+': return left + right
+        if op == '-': return left - right
+        if op == '*': return left * right
+        if op == '/':
+            if right == 0:
+                raise FormulaError('#DIV/0!')
+            return left / right
+        if op == '^':
+            try:
+                return left ** right
+            except (ZeroDivisionError, OverflowError):
+                raise FormulaError('#NUM!')
+        raise FormulaError('#VALUE!')
+
+    # --- Coercion helpers ---
+    @staticmethod
+    def _scalar(value):
+        if isinstance(value, FormulaError):
+            raise value
+        return value
+
+    @staticmethod
+    def _number(value):
+        if isinstance(value, _RangeRef):
+            value = value.top_left()
+        if value is None:
+            return 0
+        if isinstance(value, bool):
+            return int(value)
+        if isinstance(value, (int, float)):
+            return value
+        if isinstance(value, str):
+            try:
+                return float(value.replace(',', '')) if value.strip() else 0
+            except ValueError:
+                pass
+        raise FormulaError('#VALUE!')
+
+    @staticmethod
+    def _text(value):
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return 'TRUE' if value else 'FALSE'
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        return str(value)
+
+    def _flatten_numbers(self, args, sheet_name):
+        """Yields the numbers SUM/MIN/MAX/AVERAGE consider: text and blanks inside ranges are skipped."""
+        for arg in args:
+            value = self._evaluate(arg, sheet_name)
+            if isinstance(value, _RangeRef):
+                for cell_value in value.values():
+                    if isinstance(cell_value, FormulaError):
+                        raise cell_value
+                    if isinstance(cell_value, (int, float)) and not isinstance(cell_value, bool):
+                        yield cell_value
+            else:
+                yield self._number(value)
+
+    # --- Functions ---
+    def _fn_sum(self, args, sheet_name):
+        return sum(self._flatten_numbers(args, sheet_name))
+
+    def _fn_min(self, args, sheet_name):
+        return min(self._flatten_numbers(args, sheet_name), default=0)
+
+    def _fn_max(self, args, sheet_name):
+        return max(self._flatten_numbers(args, sheet_name), default=0)
+
+    def _fn_average(self, args, sheet_name):
+        numbers = list(self._flatten_numbers(args, sheet_name))
+        if not numbers:
+            raise FormulaError('#DIV/0!')
+        return sum(numbers) / len(numbers)
+
+    def _fn_abs(self, args, sheet_name):
+        if len(args) != 1:
+            raise FormulaError('#VALUE!')
+        return abs(self._number(self._evaluate(args[0], sheet_name)))
+
+    def _fn_round(self, args, sheet_name):
+        if len(args) not in (1, 2):
+            raise FormulaError('#VALUE!')
+        number = self._number(self._evaluate(args[0], sheet_name))
+        digits = int(self._number(self._evaluate(args[1], sheet_name))) if len(args) == 2 else 0
+        # Excel rounds half away from zero, unlike Python's round()
+        factor = 10 ** digits
+        rounded = math.floor(abs(number) * factor + 0.5) / factor
+        return math.copysign(rounded, number)
+
+    def _fn_if(self, args, sheet_name):
+        if len(args) not in (2, 3):
+            raise FormulaError('#VALUE!')
+        condition = self._evaluate(args[0], sheet_name)
+        if isinstance(condition, _RangeRef):
+            condition = condition.top_left()
+        truthy = bool(self._number(condition)) if not isinstance(condition, bool) else condition
+        if truthy:
+            return self._evaluate(args[1], sheet_name)
+        return self._evaluate(args[2], sheet_name) if len(args) == 3 else False
+
+    def _fn_iferror(self, args, sheet_name):
+        if len(args) != 2:
+            raise FormulaError('#VALUE!')
+        try:
+            result = self._evaluate(args[0], sheet_name)
+            if isinstance(result, _RangeRef):
+                result = self._scalar(result.top_left())
+            return result
+        except FormulaError:
+            return self._evaluate(args[1], sheet_name)
+
+    def _fn_vlookup(self, args, sheet_name):
+        if len(args) not in (3, 4):
+            raise FormulaError('#VALUE!')
+        lookup_value = self._evaluate(args[0], sheet_name)
+        if isinstance(lookup_value, _RangeRef):
+            lookup_value = self._scalar(lookup_value.top_left())
+        table = self._evaluate(args[1], sheet_name)
+        if not isinstance(table, _RangeRef):
+            raise FormulaError('#VALUE!')
+        col_index = int(self._number(self._evaluate(args[2], sheet_name)))
+        approximate = True
+        if len(args) == 4:
+            flag = self._evaluate(args[3], sheet_name)
+            approximate = bool(flag) if isinstance(flag, bool) else bool(self._number(flag))
+
+        min_col, min_row, max_col, max_row = table.bounds
+        if col_index < 1:
+            raise FormulaError('#VALUE!')
+        if col_index > max_col - min_col + 1:
+            raise FormulaError('#REF!')
+
+        if approximate:
+            row_offset = self._approximate_match(table, lookup_value)
+        else:
+            row_offset = self._exact_match_index(table).get(_lookup_key(lookup_value))
+        if row_offset is None:
+            raise FormulaError('#N/A')
+        result = self._scalar(self._cell_value(table.sheet_name, min_row + row_offset, min_col + col_index - 1))
+        return 0 if result is None else result
+
+    def _exact_match_index(self, table):
+        """Builds (once per evaluator) a first-column lookup dict for a VLOOKUP table."""
+        index_key = (table.sheet_name, table.bounds)
+        index = self._lookup_indexes.get(index_key)
+        if index is None:
+            index = {}
+            for offset, key_value in enumerate(table.first_column()):
+                if isinstance(key_value, FormulaError) or key_value is None:
+                    continue
+                index.setdefault(_lookup_key(key_value), offset)
+            self._lookup_indexes[index_key] = index
+        return index
+
+    def _approximate_match(self, table, lookup_value):
+        # Assumes an ascending first column, as Excel does: last row whose key <= lookup value
+        match = None
+        for offset, key_value in enumerate(table.first_column()):
+            if key_value is None or isinstance(key_value, FormulaError):
+                continue
+            if isinstance(key_value, str) != isinstance(lookup_value, str):
+                continue
+            if _compare('<=', key_value, lookup_value):
+                match = offset
+            else:
+                break
+        return match
+
+
+class _RangeRef:
+    """A lazily-read rectangular range (e.g. the table argument of VLOOKUP)."""
+    def __init__(self, evaluator, sheet_name, bounds):
+        min_col, min_row, max_col, max_row = bounds
+        if not (max_col and max_row):
+            # Whole-column/row references (A:A, 1:1) are clipped to the used area
+            ws = evaluator.wb[sheet_name]
+            max_col, max_row = max_col or ws.max_column, max_row or ws.max_row
+        self.bounds = (min_col or 1, min_row or 1, max_col, max_row)
+        self.sheet_name = sheet_name
+        self._evaluator = evaluator
+
+    def _get(self, row, col):
+        try:
+            return self._evaluator._cell_value(self.sheet_name, row, col)
+        except FormulaError as fe:
+            return fe
+
+    def top_left(self):
+        return self._evaluator._scalar(self._get(self.bounds[1], self.bounds[0]))
+
+    def first_column(self):
+        min_col, min_row, _, max_row = self.bounds
+        for row in range(min_row, max_row + 1):
+            yield self._get(row, min_col)
+
+    def values(self):
+        min_col, min_row, max_col, max_row = self.bounds
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                yield self._get(row, col)
+
+
+def _lookup_key(value):
+    """Normalizes a VLOOKUP key: text matches case-insensitively and numbers match across int/float."""
+    if isinstance(value, str):
+        return ('s', value.strip().casefold())
+    if isinstance(value, bool):
+        return ('b', value)
+    if isinstance(value, (int, float)):
+        return ('n', float(value))
+    return ('o', value)
+
+
+def _compare(op, left, right):
+    """Excel-style comparison: numbers sort before text, text compares case-insensitively."""
+    def rank(value):
+        if value is None: return (0, 0)
+        if isinstance(value, bool): return (2, int(value))
+        if isinstance(value, (int, float)): return (0, value)
+        return (1, str(value).casefold())
+    # A blank cell compares equal to 0 or "" depending on the other side
+    if left is None: left = '' if isinstance(right, str) else 0
+    if right is None: right = '' if isinstance(left, str) else 0
+    a, b = rank(left), rank(right)
+    if op == '=': return a == b
+    if op == '<>': return a != b
+    if op == '<': return a < b
+    if op == '>': return a > b
+    if op == '<=': return a <= b
+    return a >= b
+
+
+# --- Shared Styles ---
+class StyleRegistry:
+    """
+    Style table entries for the formats the processor applies to appended cells.
+    They are registered once on the master template, before any copies are made, so every
+    cloned workbook already contains them at the same ids. Formatting a cell is then a
+    plain integer assignment on its style array, with no Alignment objects created or
+    hashed per cell.
+    """
+    DATA_ALIGNMENT = Alignment(horizontal="left", vertical="top", wrap_text=True)
+    NUMBER_FORMATS = (numbers.FORMAT_NUMBER_00, numbers.FORMAT_DATE_YYYYMMDD2, "0.000")
+
+    def __init__(self, wb):
+        self.alignment_id = wb._alignments.add(self.DATA_ALIGNMENT)
+        self.number_format_ids = {fmt: self._register_number_format(wb, fmt) for fmt in self.NUMBER_FORMATS}
+
+    @staticmethod
+    def _register_number_format(wb, fmt):
+        # Same id scheme openpyxl uses when cell.number_format is assigned
+        if fmt in numbers.BUILTIN_FORMATS_REVERSE:
+            return numbers.BUILTIN_FORMATS_REVERSE[fmt]
+        return wb._number_formats.add(fmt) + numbers.BUILTIN_FORMATS_MAX_SIZE
+
+    def for_workbook(self, wb):
+        """Returns a registry valid for wb: this one for template copies, a new one otherwise."""
+        if wb._alignments.add(self.DATA_ALIGNMENT) == self.alignment_id and all(
+                self._register_number_format(wb, fmt) == fmt_id for fmt, fmt_id in self.number_format_ids.items()):
+            return self
+        return StyleRegistry(wb)
+
+    def align_rows(self, ws, start_row, end_row, max_col):
+        """Applies the data alignment to columns 1..max_col of rows start_row..end_row."""
+        alignment_id = self.alignment_id
+        for row in ws.iter_rows(min_row=start_row, max_row=end_row, min_col=1, max_col=max_col):
+            for cell in row:
+                if cell._style is None: # openpyxl creates the style array lazily
+                    cell._style = StyleArray()
+                cell._style.alignmentId = alignment_id
+
+
+# --- Formula Rewrite Plan ---
+class FormulaRewritePlan:
+    """
+    The VLOOKUP range adjustments for the template's formula cells, worked out once when the
+    template is loaded. Each formula is split into literal text fragments and VLOOKUP range
+    slots (with the target sheet already resolved), so rewriting a formula for a request is a
+    string join using that request's data end rows.
+    """
+    # VLOOKUP(lookup, [Sheet!]A1:B10, ...) -> prefix up to the range, optional sheet prefix
+    # ('Sheet Name'! or SheetName!), then the range split into start col/row and end col/row.
+    VLOOKUP_PATTERN = re.compile(
+        r"(VLOOKUP\s*\([^,]+,\s*)"                    # Start of VLOOKUP, lookup value, comma
+        r"((?:'[^']+'|[A-Za-z0-9_.]+)!)?"               # Optional sheet prefix
+        r"(\$?[A-Za-z]+\$?)(\d+):(\$?[A-Za-z]+\$?)(\d+)" # Range: start col, start row, end col, end row
+        r"(?=\s*,)",                                    # Followed by the comma before col_index
+        re.IGNORECASE,
+    )
+
+    def __init__(self, wb, formula_config):
+        self.entries = [] # (sheet_name, row, col, fragments, slots)
+        for sheet_name, details in formula_config.items():
+            if sheet_name not in wb.sheetnames:
+                logging.warning(f"Sheet '{sheet_name}' specified in formula_config not found in workbook. Skipping.")
+                continue
+            ws = wb[sheet_name]
+            try:
+                min_col_idx, min_row_idx, max_col_idx, max_row_idx = openpyxl.utils.range_boundaries(details['range'])
+            except Exception as range_parse_error:
+                logging.error(f"Error parsing formula range '{details['range']}' for sheet '{sheet_name}': {range_parse_error}. Skipping sheet.")
+                continue
+            for row in ws.iter_rows(min_row=min_row_idx, max_row=min(max_row_idx, ws.max_row),
+                                    min_col=min_col_idx, max_col=min(max_col_idx, ws.max_column)):
+                for cell in row:
+                    if cell.data_type == 'f' and isinstance(cell.value, str) and cell.value.startswith('='):
+                        entry = self._compile(sheet_name, cell.value)
+                        if entry is not None:
+                            self.entries.append((sheet_name, cell.row, cell.column) + entry)
+        logging.info(f"Built formula rewrite plan with {len(self.entries)} formula cells.")
+
+    def _compile(self, sheet_name, formula):
+        """Splits a formula into literal fragments and VLOOKUP range slots, or None if it has no VLOOKUP range."""
+        fragments, slots = [], []
+        last_end = 0
+        for match in self.VLOOKUP_PATTERN.finditer(formula):
+            vlookup_prefix, sheet_prefix, start_col_ref, start_row, end_col_ref, _ = match.groups()
+            sheet_prefix = sheet_prefix or ''
+            if sheet_prefix.startswith("'"):
+                target_sheet_name = sheet_prefix[1:-2].replace("''", "'")
+            elif sheet_prefix:
+                target_sheet_name = sheet_prefix[:-1]
+            else:
+                target_sheet_name = sheet_name
+            range_start = match.start(2) if match.group(2) else match.start(3)
+            fragments.append(formula[last_end:range_start])
+            # Slot: (target sheet, start row, text before the end row number, original range text)
+            slots.append((target_sheet_name, int(start_row), f"{sheet_prefix}{start_col_ref}{start_row}:{end_col_ref}", formula[range_start:match.end()]))
+            last_end = match.end()
+        if not slots:
+            return None
+        fragments.append(formula[last_end:])
+        return tuple(fragments), tuple(slots)
+
+    def rewrite(self, max_end_row_map):
+        """
+        Yields (sheet_name, row, col, adjusted formula, VLOOKUP ranges left as they were) for every
+        planned cell. A range is left as it was when its sheet has no data end row.
+        """
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        for sheet_name, row, col, fragments, slots in self.entries:
+            parts = [fragments[0]]
+            skipped_count = 0
+            for (target_sheet_name, start_row, range_head, original_range), fragment in zip(slots, fragments[1:]):
+                new_end_row_num = max_end_row_map.get(target_sheet_name)
+                if new_end_row_num is None or new_end_row_num < start_row:
+                    skipped_count += 1
+                    if debug:
+                        logging.debug("VLOOKUP adjustment skipped for %s in %s: end row %s (start row %s)",
+                                      original_range, target_sheet_name, new_end_row_num, start_row)
+                    parts.append(original_range)
+                else:
+                    parts.append(f"{range_head}{new_end_row_num}")
+                parts.append(fragment)
+            yield sheet_name, row, col, ''.join(parts), skipped_count
+
+    def apply(self, wb, max_end_row_map):
+        """
+        Writes the adjusted formulas into wb. Returns (cells changed, VLOOKUP ranges left as
+        they were because their sheet had no data end row). Individual cells are only logged
+        at DEBUG level.
+        """
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        updated_count = skipped_count = 0
+        for sheet_name, row, col, new_formula, skipped in self.rewrite(max_end_row_map):
+            skipped_count += skipped
+            cell = wb[sheet_name].cell(row=row, column=col)
+            if new_formula != cell.value:
+                if debug:
+                    logging.debug("Updating formula: %s!%s From: '%s' To: '%s'", sheet_name, cell.coordinate, cell.value, new_formula)
+                cell.value = new_formula
+                updated_count += 1
+        return updated_count, skipped_count
+
+
+# --- Formula Dependencies ---
+class FormulaDependencyGraph:
+    """
+    Which cells each template formula reads, worked out once when the template is loaded, so the
+    formulas a change reaches can be found without evaluating the rest. Ranges the rewrite plan
+    stretches over the appended data are recorded at their widest (down to Excel's last row),
+    since their end row differs per request.
+    """
+    def __init__(self, wb, rewrite_plan):
+        widest = {sheet_name: EXCEL_MAX_ROW for sheet_name in wb.sheetnames}
+        rewritten = {(sheet_name, row, col): formula for sheet_name, row, col, formula, _ in rewrite_plan.rewrite(widest)}
+        self.formula_cells = set()
+        self._readers = defaultdict(lambda: defaultdict(set)) # sheet -> bounds -> formula cells reading that range
+        for ws in wb.worksheets:
+            for (row, col), cell in ws._cells.items():
+                if not (isinstance(cell.value, str) and cell.value.startswith('=') and cell.data_type == 'f'):
+                    continue
+                key = (ws.title, row, col)
+                self.formula_cells.add(key)
+                try:
+                    tree = compile_formula(rewritten.get(key, cell.value))
+                except Exception:
+                    continue # Evaluates to an error whatever the data holds
+                for ref_sheet, bounds in self._references(tree, ws.title):
+                    self._readers[ref_sheet][bounds].add(key)
+        # Formulas that read other formula cells: {formula cell: formula cells reading it}
+        self._dependents = defaultdict(set)
+        for key in self.formula_cells:
+            sheet_name, row, col = key
+            for (min_col, min_row, max_col, max_row), readers in self._readers.get(sheet_name, {}).items():
+                if min_row <= row <= max_row and min_col <= col <= max_col:
+                    self._dependents[key] |= readers
+        logging.info(f"Built formula dependency graph for {len(self.formula_cells)} formula cells.")
+
+    @classmethod
+    def _references(cls, node, sheet_name):
+        """Yields (sheet, (min_col, min_row, max_col, max_row)) for every reference in a compiled formula."""
+        kind = node[0]
+        if kind == 'ref':
+            _, ref_sheet, (min_col, min_row, max_col, max_row), _ = node
+            # Whole-column and whole-row references (A:A, 1:1) cover the sheet in that direction
+            yield ref_sheet or sheet_name, (min_col or 1, min_row or 1, max_col or EXCEL_MAX_COLUMN, max_row or EXCEL_MAX_ROW)
+        elif kind == 'func':
+            for arg in node[2]:
+                yield from cls._references(arg, sheet_name)
+        elif kind == 'bin':
+            yield from cls._references(node[2], sheet_name)
+            yield from cls._references(node[3], sheet_name)
+        elif kind in ('neg', 'pct'):
+            yield from cls._references(node[1], sheet_name)
+
+    def affected(self, changed_cells, changed_formulas=()):
+        """
+        The formula cells whose value can differ after the cells in changed_cells ({sheet: {row:
+        set of columns}}) took new values and the formulas in changed_formulas got new text, directly
+        or through other formulas. Only ranges on the changed sheets are looked at.
+        """
+        dirty = set(changed_formulas)
+        for sheet_name, rows in changed_cells.items():
+            if not rows:
+                continue
+            changed_rows = sorted(rows)
+            for (min_col, min_row, max_col, max_row), readers in self._readers.get(sheet_name, {}).items():
+                if readers <= dirty:
+                    continue
+                position = bisect.bisect_left(changed_rows, min_row)
+                while position < len(changed_rows) and changed_rows[position] <= max_row:
+                    if any(min_col <= col <= max_col for col in rows[changed_rows[position]]):
+                        dirty |= readers
+                        break
+                    position += 1
+        pending = list(dirty)
+        while pending:
+            for dependent in self._dependents.get(pending.pop(), ()):
+                if dependent not in dirty:
+                    dirty.add(dependent)
+                    pending.append(dependent)
+        return dirty
+
+
+# --- Populated Workbook View ---
+_ViewCell = namedtuple('_ViewCell', 'value data_type')
+
+
+class PopulatedWorkbookView:
+    """
+    Read-only stand-in for the workbook build_workbook produces, for formula evaluation and
+    extraction: the master template's cells overlaid with the appended statement rows and the
+    rewritten formulas. Nothing is copied from the template, so one costs the size of the
+    statements, not of the template.
+    """
+    def __init__(self, master_wb, placements, rows, formulas, extents):
+        """placements, rows, formulas and extents are laid out as in StatementEvaluation."""
+        self.worksheets = []
+        for ws in master_wb.worksheets:
+            start_row = placements[ws.title][0] if ws.title in placements else 1
+            self.worksheets.append(_SheetView(ws, start_row, rows.get(ws.title, ()), formulas.get(ws.title, {}), extents[ws.title]))
+        self._sheets = {ws.title: ws for ws in self.worksheets}
+        self.sheetnames = list(self._sheets)
+
+    def __getitem__(self, sheet_name):
+        return self._sheets[sheet_name]
+
+
+class _SheetView:
+    """One sheet of a PopulatedWorkbookView. FormulaEvaluator reads cells through ws._cells.get, as on a worksheet."""
+    def __init__(self, master_ws, start_row, rows, formulas, extent):
+        self.title = master_ws.title
+        self.max_column = extent[1]
+        self._master_ws = master_ws
+        self._master_cells = master_ws._cells
+        self._start_row = start_row
+        self._rows = rows
+        self._formulas = formulas # {(row, col): rewritten formula}
+        self._cells = self
+
+    @property
+    def max_row(self):
+        # Only needed to clip whole-column references, so not worked out up front
+        return max(self._master_ws.max_row, self._start_row + len(self._rows) - 1)
+
+    def get(self, key, default=None):
+        formula = self._formulas.get(key)
+        if formula is not None:
+            return _ViewCell(formula, 'f')
+        row, col = key
+        offset = row - self._start_row
+        if 0 <= offset < len(self._rows) and col <= len(self._rows[offset]):
+            value = self._rows[offset][col - 1]
+            return _ViewCell(value, 'f' if _is_formula_text(value) else None)
+        return self._master_cells.get(key, default)
+
+
+def _is_formula_text(value):
+    """True for text openpyxl stores as a formula when it is assigned to a cell."""
+    return isinstance(value, str) and len(value) > 1 and value.startswith('=')
+
+
+def _excel_value(value):
+    """value as openpyxl stores it when it is assigned to a cell; raises where the assignment would."""
+    if value is None or isinstance(value, (bool, *NUMERIC_TYPES, *TIME_TYPES)):
+        return value
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    if isinstance(value, str):
+        value = value[:32767]
+        if ILLEGAL_CHARACTERS_RE.search(value):
+            raise IllegalCharacterError(f"{value} cannot be used in worksheets.")
+        return value
+    raise ValueError(f"Cannot convert {value!r} to Excel")
+
+
+def _statement_rows(df, num_rows):
+    """
+    The values append_data_to_excel stores for df's first num_rows rows, as one tuple per row over
+    the first 50 columns with missing values as None, and the (row offset, column) of the text
+    among them that openpyxl stores as a formula.
+    """
+    import numpy as np
+    import pandas as pd
+    values = df.to_numpy(dtype=object, copy=True)[:num_rows, :50]
+    values[pd.isna(values)] = None
+    formula_cells = []
+    for position, dtype in enumerate(df.dtypes.tolist()[:50]):
+        if dtype.kind not in 'biufcmM': # Only text columns can hold values openpyxl changes or rejects
+            values[:, position] = np.frompyfunc(_excel_value, 1, 1)(values[:, position])
+            is_formula = np.frompyfunc(_is_formula_text, 1, 1)(values[:, position]).astype(bool)
+            formula_cells.extend((offset, position + 1) for offset in np.flatnonzero(is_formula).tolist())
+    return list(map(tuple, values.tolist())), formula_cells
+
+
+# --- Incremental Evaluation ---
+def _changed_columns(previous, current):
+    """
+    1-based columns whose stored values differ between two rows (tuples, missing cells counting as
+    None). 1, 1.0 and True, or 0.0 and -0.0, compare equal but do not display the same.
+    """
+    if previous == current and list(map(type, previous)) == list(map(type, current)) and 0 not in previous:
+        return []
+    changed = []
+    for position in range(max(len(previous), len(current))):
+        before = previous[position] if position < len(previous) else None
+        after = current[position] if position < len(current) else None
+        if type(before) is not type(after) or before != after or (
+                isinstance(before, float) and math.copysign(1, before) != math.copysign(1, after)):
+            changed.append(position + 1)
+    return changed
+
+
+class StatementEvaluation:
+    """
+    One ticker's statements as FinancialStatementProcessor.evaluate_statements computed them: the
+    input digests, cleaned frames and stored rows, the layout, the formula values and lookup
+    indexes, and the extracted display sheets. Kept per ticker so that the next upload only
+    reloads the files and re-evaluates the cells its changes reach. Never modified once built, so
+    concurrent requests can start from the same one.
+    """
+    def __init__(self, digests, frames, rows, data_formulas, placements, end_rows, formulas, extents, values, lookup_indexes, sheets):
+        self.digests = digests               # {file type: sha256 of the input file}
+        self.frames = frames                 # {sheet: cleaned DataFrame}
+        self.rows = rows                     # {sheet: stored rows, see _statement_rows}
+        self.data_formulas = data_formulas   # {sheet: [(row, col)] of appended text that is stored as a formula}
+        self.placements = placements         # {sheet: (first row, formatted width)}
+        self.end_rows = end_rows             # {sheet: VLOOKUP end row}
+        self.formulas = formulas             # {sheet: {(row, col): rewritten formula}}
+        self.extents = extents               # {sheet: (last used row, last column)}
+        self.values = values                 # {(sheet, row, col): formula result}
+        self.lookup_indexes = lookup_indexes # FormulaEvaluator VLOOKUP indexes, {(sheet, bounds): index}
+        self.sheets = sheets                 # {sheet: {'headers', 'data'}} with raw values
+
+
+# --- Row Occupancy Index ---
+class RowOccupancy:
+    """
+    Sorted index of the non-empty rows of one worksheet. Built once from the template and
+    updated as rows are appended, so finding the next free block or the extent of a data
+    block is a couple of binary searches instead of a cell-by-cell scan of the sheet.
+    """
+    def __init__(self, rows=()):
+        self._rows = sorted(set(rows))
+
+    @classmethod
+    def from_worksheet(cls, ws):
+        # Iterate stored cells only; ws[row] / ws.cell() would create empty cells as a side effect
+        return cls(row for (row, _), cell in ws._cells.items() if not _is_blank(cell.value))
+
+    def copy(self):
+        clone = RowOccupancy()
+        clone._rows = list(self._rows)
+        return clone
+
+    def mark(self, rows):
+        """Records rows that now hold data."""
+        new_rows = set(rows)
+        if new_rows:
+            self._rows = sorted(new_rows.union(self._rows))
+
+    def is_occupied(self, row):
+        i = bisect.bisect_left(self._rows, row)
+        return i < len(self._rows) and self._rows[i] == row
+
+    def last_row(self):
+        """Last row holding data, or 0 for an empty sheet."""
+        return self._rows[-1] if self._rows else 0
+
+    def first_occupied(self, start_row, end_row):
+        """First row in [start_row, end_row] holding data, or None."""
+        i = bisect.bisect_left(self._rows, start_row)
+        if i < len(self._rows) and self._rows[i] <= end_row:
+            return self._rows[i]
+        return None
+
+    def run_end(self, row):
+        """Last row of the contiguous block of occupied rows that starts at the occupied row `row`."""
+        start = bisect.bisect_left(self._rows, row)
+        # Rows are unique and sorted, so rows[j] - rows[start] == j - start exactly while contiguous
+        lo, hi = start, len(self._rows) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self._rows[mid] - row == mid - start:
+                lo = mid
+            else:
+                hi = mid - 1
+        return self._rows[lo]
+
+    def first_free_block(self, start_row, block_size=4):
+        """First row at or after start_row that begins `block_size` consecutive empty rows."""
+        row = start_row
+        while True:
+            occupied = self.first_occupied(row, row + block_size - 1)
+            if occupied is None:
+                return row
+            row = self.run_end(occupied) + 1
+
+
+def _is_blank(value):
+    return value is None or (isinstance(value, float) and value != value) or str(value).strip() == ""
+
+
+# --- Stage Metrics ---
+def _peak_rss_bytes():
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # Linux reports KiB
+
+
+class _StageTimer:
+    """
+    Context manager returned by StageMetrics.stage(); call count() inside it to add rows/cells,
+    and event() for things that happen per cell (rewritten formulas, evaluation errors), which
+    are counted here instead of being logged one by one.
+    """
+    __slots__ = ('metrics', 'name', 'rows', 'cells', 'events', '_started', '_rss_before')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.rows = 0
+        self.cells = 0
+        self.events = None
+
+    def count(self, rows=0, cells=0):
+        self.rows += rows
+        self.cells += cells
+
+    def event(self, name, count=1):
+        if count:
+            if self.events is None:
+                self.events = {}
+            self.events[name] = self.events.get(name, 0) + count
+
+    def __enter__(self):
+        self._rss_before = _peak_rss_bytes()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self._started
+        self.metrics.record(self.name, elapsed, self.rows, self.cells, _peak_rss_bytes() - self._rss_before, self.events)
+        return False
+
+
+class _NullStage:
+    """Stand-in for _StageTimer when metrics are off."""
+    __slots__ = ()
+
+    def count(self, rows=0, cells=0):
+        pass
+
+    def event(self, name, count=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class StageMetrics:
+    """
+    Latency histograms plus row, cell and peak-RSS-growth counters for each processing stage,
+    rendered in Prometheus text format. Every process keeps its own counts and writes them to
+    <folder>/<pid>.json when flushed (after each request or job); render() adds up the files of all
+    processes, so whichever gunicorn worker answers /metrics reports the whole app, job pool
+    workers included.
+    """
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._lock = threading.Lock()
+        self._reset()
+        os.makedirs(folder, exist_ok=True)
+        _reset_in_forked_children(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._stages = {}
+        self._dirty = False
+
+    def stage(self, name):
+        """Times a `with` block as one observation of the named stage."""
+        return _StageTimer(self, name)
+
+    def record(self, name, seconds, rows=0, cells=0, rss_growth_bytes=0, events=None):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked (gunicorn worker, job pool): the parent's counts are reported from its own file
+                self._reset()
+            entry = self._stages.get(name)
+            if entry is None:
+                entry = self._stages[name] = {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0,
+                                              'rows': 0, 'cells': 0, 'rss_growth_bytes': 0}
+            bucket = bisect.bisect_left(self.BUCKETS, seconds)
+            if bucket < len(self.BUCKETS):
+                entry['buckets'][bucket] += 1 # Per bucket here; render() makes them cumulative
+            entry['sum'] += seconds
+            entry['count'] += 1
+            entry['rows'] += rows
+            entry['cells'] += cells
+            entry['rss_growth_bytes'] += max(rss_growth_bytes, 0)
+            if events:
+                entry_events = entry.setdefault('events', {})
+                for event, count in events.items():
+                    entry_events[event] = entry_events.get(event, 0) + count
+            self._dirty = True
+
+    def flush(self, force=False):
+        """Writes this process's counts to its file if anything was recorded since the last write."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            if not (self._dirty or force):
+                return
+            snapshot = json.dumps({'pid': self._pid, 'peak_rss_bytes': _peak_rss_bytes(), 'stages': self._stages})
+            self._dirty = False
+        path = os.path.join(self.folder, f"{os.getpid()}.json")
+        temp_path = _temp_path(path)
+        try:
+            with open(temp_path, 'w') as snapshot_file:
+                snapshot_file.write(snapshot)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not write metrics snapshot {path}: {e}")
+
+    def clear(self):
+        """Removes the files of earlier runs; called once at startup, before workers exist."""
+        for name in os.listdir(self.folder):
+            try: os.remove(os.path.join(self.folder, name))
+            except OSError: pass
+
+    def _snapshots(self):
+        for name in os.listdir(self.folder):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.folder, name)) as snapshot_file:
+                    yield json.load(snapshot_file)
+            except (OSError, ValueError):
+                continue # Removed or being replaced; its counts show up on the next scrape
+
+    @staticmethod
+    def _is_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass # Exists but belongs to someone else
+        return True
+
+    def render(self, extra_gauges=None):
+        """Prometheus text exposition of all processes' stage metrics."""
+        self.flush(force=True)
+        totals = {}
+        rss_by_pid = {}
+        for snapshot in self._snapshots():
+            # Counters of exited processes stay in the totals; only their memory gauge is dropped
+            if self._is_alive(snapshot['pid']):
+                rss_by_pid[snapshot['pid']] = snapshot['peak_rss_bytes']
+            for name, entry in snapshot['stages'].items():
+                total = totals.setdefault(name, {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0,
+                                                 'rows': 0, 'cells': 0, 'rss_growth_bytes': 0})
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], entry['buckets'])]
+                for field in ('sum', 'count', 'rows', 'cells', 'rss_growth_bytes'):
+                    total[field] += entry[field]
+                total_events = total.setdefault('events', {})
+                for event, count in entry.get('events', {}).items():
+                    total_events[event] = total_events.get(event, 0) + count
+
+        lines = [
+            "# HELP statement_stage_duration_seconds Time spent in each processing stage.",
+            "# TYPE statement_stage_duration_seconds histogram",
+        ]
+        for name, total in sorted(totals.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.BUCKETS, total['buckets']):
+                cumulative += bucket_count
+                lines.append(f'statement_stage_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'statement_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {total["count"]}')
+            lines.append(f'statement_stage_duration_seconds_sum{{stage="{name}"}} {total["sum"]:.6f}')
+            lines.append(f'statement_stage_duration_seconds_count{{stage="{name}"}} {total["count"]}')
+        for field, help_text in (('rows', "Rows processed by each stage."),
+                                 ('cells', "Cells processed by each stage."),
+                                 ('rss_growth_bytes', "Growth of the process's peak RSS during each stage.")):
+            metric = f"statement_stage_{field}_total"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for name, total in sorted(totals.items()):
+                lines.append(f'{metric}{{stage="{name}"}} {total[field]}')
+        lines.append("# HELP statement_stage_events_total Per-cell events in each stage (e.g. rewritten formulas, evaluation errors).")
+        lines.append("# TYPE statement_stage_events_total counter")
+        for name, total in sorted(totals.items()):
+            for event, count in sorted(total.get('events', {}).items()):
+                lines.append(f'statement_stage_events_total{{stage="{name}",event="{event}"}} {count}')
+        lines.append("# HELP statement_process_peak_rss_bytes Peak resident set size of each live app process.")
+        lines.append("# TYPE statement_process_peak_rss_bytes gauge")
+        for pid, rss in sorted(rss_by_pid.items()):
+            lines.append(f'statement_process_peak_rss_bytes{{pid="{pid}"}} {rss}')
+        for metric, (help_text, value) in (extra_gauges or {}).items():
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# --- Result Cache ---
+class ResultCache:
+    """
+    Content-addressed cache of process_files_for_web results, keyed by a hash of the uploaded
+    files and the template. An in-memory LRU tier is backed by an optional on-disk tier
+    (pickles in disk_dir, evicted oldest-access-first once disk_max_bytes is exceeded).
+    The tier's size is counted in memory as entries are written; the directory is only listed
+    when that count passes disk_max_bytes, which also picks up what other processes wrote.
+    Cached results are shared objects and must not be modified by callers.
+    """
+    # Eviction goes down to this share of disk_max_bytes, so the next writes don't list the directory again
+    DISK_EVICT_TO = 0.9
+
+    def __init__(self, max_entries=64, disk_dir=None, disk_max_bytes=0):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir if disk_max_bytes > 0 else None
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None # Size of the disk tier as last counted; None until the first write
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+        _reset_in_forked_children(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return self._entries[key]
+        result = self._disk_get(key)
+        with self._lock:
+            if result is None:
+                self.counters['misses'] += 1
+                return None
+            self.counters['disk_hits'] += 1
+            self._memory_put(key, result)
+        return result
+
+    def put(self, key, result):
+        with self._lock:
+            self.counters['stores'] += 1
+            self._memory_put(key, result)
+        self._disk_put(key, result)
+
+    def __contains__(self, key):
+        """Whether key is cached in either tier; unlike get, this neither loads the entry nor counts a hit."""
+        with self._lock:
+            if key in self._entries:
+                return True
+        return bool(self.disk_dir) and os.path.exists(self._disk_path(key))
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, memory_entries=len(self._entries))
+
+    def _memory_put(self, key, result):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pkl")
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as cache_file:
+                result = pickle.load(cache_file)
+            os.utime(path) # mtime doubles as the last-access time for eviction
+            return result
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Discarding unreadable result cache entry {path}: {e}")
+            try: os.remove(path)
+            except OSError: pass
+            return None
+
+    def _disk_put(self, key, result):
+        if not self.disk_dir:
+            return
+        try:
+            path = self._disk_path(key)
+            temp_path = _temp_path(path)
+            with open(temp_path, 'wb') as cache_file:
+                pickle.dump(result, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+                size = cache_file.tell()
+            try:
+                replaced = os.stat(path).st_size
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(temp_path, path)
+            with self._lock:
+                if self._disk_bytes is not None:
+                    self._disk_bytes += size - replaced
+                over_budget = self._disk_bytes is None or self._disk_bytes > self.disk_max_bytes
+            if over_budget:
+                self._disk_evict()
+        except OSError as e:
+            logging.warning(f"Could not write result cache entry for {key}: {e}")
+
+    def _disk_evict(self):
+        """Lists the disk tier, removes the least recently used entries if it is over budget and recounts it."""
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith('.pkl'):
+                try:
+                    stat = os.stat(os.path.join(self.disk_dir, name))
+                    entries.append((stat.st_mtime, stat.st_size, name))
+                except OSError:
+                    pass
+        total_bytes = sum(size for _, size, _ in entries)
+        if total_bytes > self.disk_max_bytes:
+            target_bytes = self.disk_max_bytes * self.DISK_EVICT_TO
+            for _, size, name in sorted(entries):
+                if total_bytes <= target_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.disk_dir, name))
+                    total_bytes -= size
+                    with self._lock:
+                        self.counters['evictions'] += 1
+                except OSError:
+                    pass
+        with self._lock:
+            self._disk_bytes = total_bytes
+
+
+# --- Streaming Output ---
+class StreamingWorkbookWriter:
+    """
+    Writes populated workbooks straight from the statement DataFrames, without building them in
+    openpyxl. What does not depend on the request is prepared once from the template file: every
+    part other than the three statement sheets goes into a ready-made zip that each output starts
+    from, copied byte for byte, and each statement sheet is split into the XML around its rows and
+    its template rows. Writing a workbook copies that zip and streams each statement sheet into it
+    row by row, so memory stays flat and the time taken depends on the appended rows.
+
+    A few template parts are changed once, the same way for every output: styles.xml gets the cell
+    formats of the appended cells, workbook.xml asks Excel to recalculate on load (formula cells on
+    the statement sheets are written without cached values) and the calculation chain is dropped,
+    as openpyxl also does. Raises ValueError for a template whose XML it does not recognize.
+    """
+    ROW_PATTERN = re.compile(r'<row\b([^>]*?)(?:/>|>(.*?)</row>)', re.DOTALL)
+    CELL_PATTERN = re.compile(r'<c\b([^>]*?)(?:/>|>(.*?)</c>)', re.DOTALL)
+    XF_PATTERN = re.compile(r'<xf\b([^>]*?)(?:/>|>(.*?)</xf>)', re.DOTALL)
+    ATTRIBUTE_PATTERN = re.compile(r'([\w:.-]+)="([^"]*)"')
+    # What openpyxl writes for a cell that had no style before one was applied
+    NEW_CELL_XF = ('numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"', '')
+    # Elements that come after calcPr in workbook.xml, for placing one if the template has none
+    CALC_PR_FOLLOWERS = ('<oleSize', '<customWorkbookViews', '<pivotCaches', '<smartTagPr', '<smartTagTypes',
+                         '<webPublishing', '<fileRecoveryPr', '<webPublishObjects', '<extLst', '</workbook>')
+    ROWS_PER_CHUNK = 500
+
+    def __init__(self, template_path, master_wb, append_rows, rewrite_plan, fixed_formats=None):
+        """
+        append_rows: {statement sheet: first row data is appended at}; fixed_formats:
+        {sheet: {(row, col): number format}} for template cells every output formats the same way.
+        """
+        self.rewrite_plan = rewrite_plan
+        fixed_formats = fixed_formats or {}
+        with zipfile.ZipFile(template_path) as template_zip:
+            infos = template_zip.infolist()
+            parts = {info.filename: template_zip.read(info.filename) for info in infos}
+
+        workbook_part = next(name for kind, name in self._relationships(parts, '_rels/.rels').values() if kind == 'officeDocument')
+        workbook_rels = self._relationships(parts, self._rels_name(workbook_part))
+        sheet_parts = self._sheet_parts(parts[workbook_part], workbook_rels)
+        related = {kind: name for kind, name in workbook_rels.values()}
+
+        self._sheets = {} # sheet name -> split sheet XML, see _split_sheet
+        for sheet_name in append_rows:
+            info = next(info for info in infos if info.filename == sheet_parts[sheet_name])
+            self._sheets[sheet_name] = self._split_sheet(info, parts[info.filename].decode('utf-8'), master_wb[sheet_name])
+
+        # Cell formats for appended cells, based on the format of the template cell they land on (None: no cell)
+        bases = {None}
+        for sheet_name, first_row in append_rows.items():
+            bases.update(style for row, (_, cells) in self._sheets[sheet_name]['rows'].items() if row >= first_row
+                         for _, _, style in cells.values())
+        variants = {(base, number_format, aligned) for base in bases
+                    for number_format in (None,) + StyleRegistry.NUMBER_FORMATS for aligned in (False, True)}
+        fixed_cells = {}
+        for sheet_name, formats in fixed_formats.items():
+            cells = self._sheets[sheet_name]['rows']
+            for (row, col), number_format in formats.items():
+                if row in cells and col in cells[row][1]:
+                    fixed_cells[sheet_name, row, col] = (cells[row][1][col][2], number_format, False)
+        variants.update(fixed_cells.values())
+        styles, self._xf_ids = self._patch_styles(parts[related['styles']].decode('utf-8'), variants)
+        patched = {
+            related['styles']: styles.encode('utf-8'),
+            workbook_part: self._patch_workbook(parts[workbook_part].decode('utf-8')).encode('utf-8'),
+        }
+
+        for (sheet_name, row, col), key in fixed_cells.items():
+            cell = self._sheets[sheet_name]['rows'][row][1][col]
+            self._sheets[sheet_name]['rows'][row][1][col] = self._restyled(cell, self._xf_ids[key])
+        for sheet in self._sheets.values():
+            sheet['row_xml'] = {row: open_tag + ''.join(cell[0] for cell in cells.values()) + '</row>'
+                                for row, (open_tag, cells) in sheet['rows'].items()}
+            sheet['row_order'] = sorted(sheet['rows'])
+
+        # The calculation chain lists formula cells, which appended rows can overwrite; Excel rebuilds it
+        skipped = {sheet['info'].filename for sheet in self._sheets.values()}
+        if 'calcChain' in related:
+            skipped.add(related['calcChain'])
+            rels_name = self._rels_name(workbook_part)
+            patched[rels_name] = re.sub(r'<Relationship\b[^>]*/calcChain"[^>]*/>', '', parts[rels_name].decode('utf-8')).encode('utf-8')
+            patched['[Content_Types].xml'] = re.sub(
+                r'<Override\b[^>]*PartName="/' + re.escape(related['calcChain']) + r'"[^>]*/>', '',
+                parts['[Content_Types].xml'].decode('utf-8')).encode('utf-8')
+
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as static_zip:
+            for info in infos:
+                if info.filename not in skipped:
+                    static_zip.writestr(self._zip_info(info), patched.get(info.filename) or parts[info.filename])
+        self._static_zip = buffer.getvalue()
+        self._column_letters = [None] + [get_column_letter(col) for col in range(1, 51)]
+        logging.info(f"Prepared streaming output for {len(infos)} template parts "
+                     f"({len(self._static_zip)} bytes copied per workbook).")
+
+    @staticmethod
+    def _rels_name(part_name):
+        directory, file_name = posixpath.split(part_name)
+        return posixpath.join(directory, '_rels', f"{file_name}.rels")
+
+    @staticmethod
+    def _relationships(parts, rels_name):
+        """{relationship id: (type, part name)} from a .rels part; the type is the last segment of its URI."""
+        base_dir = posixpath.dirname(posixpath.dirname(rels_name))
+        relationships = {}
+        for rel in ElementTree.fromstring(parts[rels_name]):
+            if rel.get('TargetMode') == 'External':
+                continue
+            target = rel.get('Target')
+            part_name = target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join(base_dir, target))
+            relationships[rel.get('Id')] = (rel.get('Type').rsplit('/', 1)[-1], part_name)
+        return relationships
+
+    @staticmethod
+    def _sheet_parts(workbook_xml, workbook_rels):
+        """{sheet name: worksheet part name} from workbook.xml."""
+        sheet_parts = {}
+        for element in ElementTree.fromstring(workbook_xml).iter():
+            if element.tag.endswith('}sheet'):
+                rel_id = next(value for key, value in element.attrib.items() if key.endswith('}id'))
+                sheet_parts[element.get('name')] = workbook_rels[rel_id][1]
+        return sheet_parts
+
+    @staticmethod
+    def _zip_info(info):
+        zip_info = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+        zip_info.compress_type = info.compress_type
+        zip_info.external_attr = info.external_attr
+        return zip_info
+
+    def _split_sheet(self, info, xml, ws):
+        """
+        The sheet XML before and after its rows, plus {row: (opening tag, {col: (cell XML, attributes,
+        style id)})}. Formula cells lose their cached values; shared formulas are written out per cell
+        (from openpyxl's translation in ws), since their anchor cell may be rewritten.
+        """
+        sheet_data = re.search(r'<sheetData\s*/>|<sheetData>(.*?)</sheetData>', xml, re.DOTALL)
+        if sheet_data is None:
+            raise ValueError(f"{info.filename} has no sheetData element")
+        rows = {}
+        last_row = last_col = 1
+        for row_match in self.ROW_PATTERN.finditer(sheet_data.group(1) or ''):
+            row_attributes = row_match.group(1)
+            row_number = re.search(r'\br="(\d+)"', row_attributes)
+            if row_number is None:
+                raise ValueError(f"{info.filename} has a row without a row number")
+            row = int(row_number.group(1))
+            cells = {}
+            for cell_match in self.CELL_PATTERN.finditer(row_match.group(2) or ''):
+                attributes = dict(self.ATTRIBUTE_PATTERN.findall(cell_match.group(1)))
+                if 'r' not in attributes:
+                    raise ValueError(f"{info.filename} has a cell without a reference in row {row}")
+                col = openpyxl.utils.column_index_from_string(openpyxl.utils.cell.coordinate_from_string(attributes['r'])[0])
+                inner = cell_match.group(2)
+                if inner and '<f' in inner:
+                    if re.search(r'<f\b[^>]*\bt="shared"', inner):
+                        formula = ws._cells[(row, col)].value
+                        inner = f"<f>{escape(formula[1:])}</f>"
+                    inner = re.sub(r'<v>.*?</v>|<v\s*/>', '', inner, flags=re.DOTALL)
+                    attributes.pop('t', None)
+                cells[col] = (self._cell_xml(attributes, inner), attributes, int(attributes.get('s', 0)))
+                last_col = max(last_col, col)
+            # spans is only a hint, and appended cells can fall outside it
+            rows[row] = ('<row' + re.sub(r'\sspans="[^"]*"', '', row_attributes) + '>', cells)
+            last_row = max(last_row, row)
+        dimension = re.search(r'<dimension ref="([A-Z]+\d+)(?::[A-Z]+\d+)?"\s*/>', xml[:sheet_data.start()])
+        return {
+            'info': info,
+            'head': xml[:sheet_data.start()] + '<sheetData>',
+            'tail': '</sheetData>' + xml[sheet_data.end():],
+            'top_left': dimension.group(1) if dimension else None,
+            'rows': rows,
+            'last_row': last_row,
+            'last_col': last_col,
+        }
+
+    @staticmethod
+    def _cell_xml(attributes, inner):
+        attribute_text = ''.join(f' {key}="{value}"' for key, value in attributes.items())
+        return f"<c{attribute_text}>{inner}</c>" if inner else f"<c{attribute_text}/>"
+
+    def _restyled(self, cell, style_id, inner=None):
+        """A template cell with another format (and, if given, other content)."""
+        _, attributes, base = cell
+        attributes = dict(attributes)
+        if style_id is None:
+            attributes.pop('s', None)
+        else:
+            attributes['s'] = str(style_id)
+        if inner is not None:
+            attributes.pop('t', None)
+            return self._cell_xml(attributes, inner), attributes, base
+        inner = self.CELL_PATTERN.fullmatch(cell[0]).group(2)
+        return self._cell_xml(attributes, inner), attributes, base
+
+    def _patch_styles(self, xml, variants):
+        """
+        Adds a cell format for each (base, number format, aligned) variant: the base format (a cellXfs
+        index, or None for a cell with no format yet) with the number format and/or the data alignment
+        applied. Returns (styles.xml, {variant: cellXfs index, None where no format is needed}).
+        """
+        cell_xfs = re.search(r'<cellXfs\b[^>]*?(?:/>|>(.*?)</cellXfs>)', xml, re.DOTALL)
+        if cell_xfs is None:
+            raise ValueError("styles.xml has no cellXfs element")
+        xfs = [(match.group(1).strip(), match.group(2) or '') for match in self.XF_PATTERN.finditer(cell_xfs.group(1) or '')]
+
+        num_fmts = re.search(r'<numFmts\b[^>]*?(?:/>|>(.*?)</numFmts>)', xml, re.DOTALL)
+        existing = (num_fmts.group(1) or '') if num_fmts else ''
+        format_ids = {}
+        for attribute_text in re.findall(r'<numFmt\b([^>]*?)/?>', existing):
+            attributes = dict(self.ATTRIBUTE_PATTERN.findall(attribute_text))
+            format_ids[unescape(attributes['formatCode'], {'&quot;': '"', '&apos;': "'"})] = int(attributes['numFmtId'])
+        next_format_id = max([numbers.BUILTIN_FORMATS_MAX_SIZE - 1] + list(format_ids.values())) + 1
+        added_formats = []
+        for number_format in StyleRegistry.NUMBER_FORMATS:
+            if number_format in numbers.BUILTIN_FORMATS_REVERSE:
+                format_ids[number_format] = numbers.BUILTIN_FORMATS_REVERSE[number_format]
+            elif number_format not in format_ids:
+                format_ids[number_format] = next_format_id
+                added_formats.append(f'<numFmt numFmtId="{next_format_id}" formatCode={quoteattr(number_format)}/>')
+                next_format_id += 1
+
+        alignment = ElementTree.tostring(StyleRegistry.DATA_ALIGNMENT.to_tree(), encoding='unicode').replace(' />', '/>')
+        xf_ids = {}
+        added_xfs = []
+        for base, number_format, aligned in sorted(variants, key=repr):
+            if number_format is None and not aligned:
+                xf_ids[base, number_format, aligned] = base
+                continue
+            if base is not None and base >= len(xfs):
+                raise ValueError(f"Template cell format {base} is not in styles.xml")
+            attribute_text, children = xfs[base] if base is not None else self.NEW_CELL_XF
+            attributes = dict(self.ATTRIBUTE_PATTERN.findall(attribute_text))
+            if number_format is not None:
+                attributes['numFmtId'] = str(format_ids[number_format])
+                attributes['applyNumberFormat'] = '1'
+            if aligned:
+                # Replaces any alignment of the base, like the alignment id assigned to appended cells
+                children = alignment + re.sub(r'<alignment\b[^>]*?(?:/>|>.*?</alignment>)', '', children, flags=re.DOTALL)
+                attributes['applyAlignment'] = '1'
+            attribute_text = ''.join(f' {key}="{value}"' for key, value in attributes.items())
+            added_xfs.append(f"<xf{attribute_text}>{children}</xf>" if children else f"<xf{attribute_text}/>")
+            xf_ids[base, number_format, aligned] = len(xfs) + len(added_xfs) - 1
+
+        new_cell_xfs = f'<cellXfs count="{len(xfs) + len(added_xfs)}">{cell_xfs.group(1) or ""}{"".join(added_xfs)}</cellXfs>'
+        xml = xml[:cell_xfs.start()] + new_cell_xfs + xml[cell_xfs.end():]
+        if added_formats:
+            count = len(re.findall(r'<numFmt\b', existing)) + len(added_formats)
+            new_num_fmts = f'<numFmts count="{count}">{existing}{"".join(added_formats)}</numFmts>'
+            if num_fmts is not None:
+                xml = xml[:num_fmts.start()] + new_num_fmts + xml[num_fmts.end():]
+            else:
+                style_sheet = re.search(r'<styleSheet\b[^>]*>', xml)
+                xml = xml[:style_sheet.end()] + new_num_fmts + xml[style_sheet.end():]
+        return xml, xf_ids
+
+    def _patch_workbook(self, xml):
+        """workbook.xml with calcPr fullCalcOnLoad set."""
+        calc_pr = re.search(r'<calcPr\b([^>]*?)(/?)>', xml)
+        if calc_pr is not None:
+            attribute_text = re.sub(r'\s*fullCalcOnLoad="[^"]*"', '', calc_pr.group(1))
+            return f'{xml[:calc_pr.start()]}<calcPr{attribute_text} fullCalcOnLoad="1"{calc_pr.group(2)}>{xml[calc_pr.end():]}'
+        position = min(index for index in (xml.find(tag) for tag in self.CALC_PR_FOLLOWERS) if index >= 0)
+        return f'{xml[:position]}<calcPr fullCalcOnLoad="1"/>{xml[position:]}'
+
+    def write(self, target, sheets, end_rows):
+        """
+        Writes the workbook to target (a path, or a seekable binary file object positioned at its
+        start). sheets: {statement sheet: (DataFrame, number format mask, first row, formatted
+        width)} as laid out by FinancialStatementProcessor.layout_statements; end_rows: the VLOOKUP
+        end rows. Returns the number of appended cells written.
+        """
+        formulas = {}
+        for sheet_name, row, col, formula, _ in self.rewrite_plan.rewrite(end_rows):
+            formulas.setdefault(sheet_name, {}).setdefault(row, {})[col] = formula
+        stream = open(target, 'w+b') if isinstance(target, (str, os.PathLike)) else target
+        try:
+            stream.write(self._static_zip)
+            cell_count = 0
+            with zipfile.ZipFile(stream, 'a') as output_zip:
+                for sheet_name, sheet in self._sheets.items():
+                    with output_zip.open(self._zip_info(sheet['info']), 'w') as sheet_stream:
+                        cell_count += self._write_sheet(sheet_stream, sheet, *sheets[sheet_name], formulas.get(sheet_name, {}))
+            return cell_count
+        finally:
+            if stream is not target:
+                stream.close()
+
+    def _write_sheet(self, sheet_stream, sheet, df, number_formats, start_row, width, formulas):
+        """Streams one statement sheet: template rows above the data, the appended rows, template rows below."""
+        num_rows = 0 if df.empty else max(0, min(len(df), EXCEL_MAX_ROW - start_row + 1))
+        max_cols = min(df.shape[1], 50) if num_rows else 0 # Same width limits as append_data_to_excel / apply_formatting
+        end_row = start_row + num_rows - 1
+        head = sheet['head']
+        if sheet['top_left'] is not None:
+            last_col = max(sheet['last_col'], max_cols, width if num_rows else 0)
+            dimension = f'<dimension ref="{sheet["top_left"]}:{get_column_letter(last_col)}{max(sheet["last_row"], end_row)}"/>'
+            head = re.sub(r'<dimension ref="[^"]*"\s*/>', lambda _: dimension, head, count=1)
+        sheet_stream.write(head.encode('utf-8'))
+
+        chunk = []
+        def flush():
+            sheet_stream.write(''.join(chunk).encode('utf-8'))
+            chunk.clear()
+
+        template_rows = sheet['rows']
+        for row in sheet['row_order']:
+            if row >= start_row:
+                break
+            chunk.append(self._template_row(sheet, row, formulas.get(row)))
+        if num_rows:
+            # One conversion for the whole frame: slicing out columns would deep-copy df.attrs (the format mask) each time
+            columns = df.to_numpy(dtype=object)[:num_rows, :max_cols].T.tolist()
+            for r_offset, row_values in enumerate(zip(*columns)):
+                row = start_row + r_offset
+                chunk.append(self._data_row(row, row_values, number_formats[r_offset], template_rows.get(row), width, formulas.get(row)))
+                if len(chunk) >= self.ROWS_PER_CHUNK:
+                    flush()
+        for row in sheet['row_order']:
+            if row > end_row and row >= start_row:
+                chunk.append(self._template_row(sheet, row, formulas.get(row)))
+        flush()
+        sheet_stream.write(sheet['tail'].encode('utf-8'))
+        return num_rows * max_cols
+
+    def _template_row(self, sheet, row, row_formulas):
+        if not row_formulas:
+            return sheet['row_xml'][row]
+        open_tag, cells = sheet['rows'][row]
+        parts = [open_tag]
+        for col, cell in cells.items():
+            formula = row_formulas.get(col)
+            parts.append(cell[0] if formula is None else self._restyled(cell, cell[1].get('s'), f"<f>{escape(formula[1:])}</f>")[0])
+        parts.append('</row>')
+        return ''.join(parts)
+
+    def _data_row(self, row, values, row_formats, template_row, width, row_formulas):
+        """One appended row, over the template row of the same number if there is one."""
+        open_tag, template_cells = template_row if template_row is not None else (f'<row r="{row}">', {})
+        row_formulas = row_formulas or {}
+        xf_ids = self._xf_ids
+        letters = self._column_letters
+        parts = [open_tag]
+        for col in range(1, max(len(values), width) + 1):
+            template_cell = template_cells.get(col)
+            base = template_cell[2] if template_cell is not None else None
+            aligned = col <= width
+            coordinate = f"{letters[col]}{row}"
+            if col <= len(values):
+                value = values[col - 1]
+                if value is None or value != value: # None or NaN
+                    value = None
+                number_format = row_formats[col - 1] if value is not None else None
+                style_id = xf_ids[base, number_format, aligned]
+                if col in row_formulas:
+                    parts.append(self._formula_cell(coordinate, style_id, row_formulas[col]))
+                else:
+                    parts.append(self._value_cell(coordinate, style_id, value))
+            else:
+                # Past the data columns only the alignment is applied; template content stays
+                style_id = xf_ids[base, None, aligned]
+                if col in row_formulas:
+                    parts.append(self._formula_cell(coordinate, style_id, row_formulas[col]))
+                elif template_cell is not None:
+                    parts.append(self._restyled(template_cell, style_id)[0])
+                elif style_id is not None:
+                    parts.append(f'<c r="{coordinate}" s="{style_id}"/>')
+        for col, template_cell in template_cells.items():
+            if col > max(len(values), width):
+                formula = row_formulas.get(col)
+                parts.append(template_cell[0] if formula is None else
+                             self._restyled(template_cell, template_cell[1].get('s'), f"<f>{escape(formula[1:])}</f>")[0])
+        parts.append('</row>')
+        return ''.join(parts)
+
+    @staticmethod
+    def _formula_cell(coordinate, style_id, formula):
+        style = '' if style_id is None else f' s="{style_id}"'
+        return f'<c r="{coordinate}"{style}><f>{escape(formula[1:])}</f></c>'
+
+    @classmethod
+    def _value_cell(cls, coordinate, style_id, value):
+        """A cell holding value, typed the way openpyxl types an assigned value."""
+        style = '' if style_id is None else f' s="{style_id}"'
+        if value is None:
+            return f'<c r="{coordinate}"{style}/>' if style else ''
+        if isinstance(value, bool):
+            return f'<c r="{coordinate}"{style} t="b"><v>{int(value)}</v></c>'
+        if isinstance(value, NUMERIC_TYPES):
+            return f'<c r="{coordinate}"{style}><v>{safe_string(value)}</v></c>'
+        if isinstance(value, str):
+            value = value[:32767]
+            if ILLEGAL_CHARACTERS_RE.search(value):
+                raise IllegalCharacterError(f"{value} cannot be used in worksheets.")
+            if len(value) > 1 and value.startswith('='):
+                return cls._formula_cell(coordinate, style_id, value)
+            if value in ERROR_CODES:
+                return f'<c r="{coordinate}"{style} t="e"><v>{escape(value)}</v></c>'
+            if value == '':
+                return f'<c r="{coordinate}"{style}/>'
+            space = ' xml:space="preserve"' if value.strip() and value.strip() != value else ''
+            return f'<c r="{coordinate}"{style} t="inlineStr"><is><t{space}>{escape(value)}</t></is></c>'
+        if isinstance(value, TIME_TYPES):
+            if getattr(value, 'tzinfo', None) is not None:
+                raise TypeError("Excel does not support timezones in datetimes. "
+                                "The tzinfo in the datetime/time object must be set to None.")
+            return f'<c r="{coordinate}"{style}><v>{safe_string(to_excel(value))}</v></c>'
+        raise ValueError(f"Cannot convert {value!r} to Excel")
+
+
+class StreamedWorkbook:
+    """
+    A populated workbook held as its statement DataFrames and their layout, and only written out
+    when saved (through StreamingWorkbookWriter). Stands in for an openpyxl Workbook wherever the
+    workbook is only saved: WorkbookStore downloads and batch.py outputs.
+    """
+    def __init__(self, writer, sheets, end_rows):
+        self.writer = writer
+        self.sheets = sheets
+        self.end_rows = end_rows
+
+    def save(self, target):
+        return self.writer.write(target, self.sheets, self.end_rows)
+
+    def close(self):
+        pass
+
+
+# --- Workbook Downloads ---
+class WorkbookStore:
+    """
+    Populated workbooks available for download, keyed by result key. A workbook is kept
+    unserialized (bounded LRU), as a StreamedWorkbook or an openpyxl Workbook, and only saved to
+    xlsx bytes the first time it is downloaded. The bytes then go into a ResultCache, so repeat downloads are served as-is
+    and, with its disk tier, from any worker process. The unserialized workbook only exists in
+    the process that built it. With an input_cache (opt-in, as it writes every upload's inputs
+    to disk) the inputs are kept too, and a worker asked for a workbook it never built rebuilds
+    it from them. With save_on_add, workbooks are instead serialized as soon as they are added,
+    for servers running several worker processes that share the byte cache's disk tier.
+    """
+    def __init__(self, max_pending, byte_cache, metrics=None, input_cache=None, save_on_add=False):
+        self.max_pending = max_pending
+        self.byte_cache = byte_cache
+        self.metrics = metrics
+        self.input_cache = input_cache
+        self.save_on_add = save_on_add
+        self._pending = OrderedDict() # result key -> (ticker, workbook)
+        self._in_flight = {} # result key -> Event, set once the thread serializing it is done
+        self._lock = threading.Lock()
+        _reset_in_forked_children(self)
+
+    def _after_fork(self):
+        # Serializations in flight belong to the parent's threads; the child never sees them finish
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    def add(self, key, ticker, wb, inputs=None):
+        if inputs and self.input_cache is not None:
+            self.input_cache.put(key, [UploadedFile(_input_name(source), _input_bytes(source)) for source in inputs])
+        with self._lock:
+            self._pending[key] = (ticker, wb)
+            self._pending.move_to_end(key)
+            while len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+        if self.save_on_add:
+            self.persist(key)
+
+    def __contains__(self, key):
+        """Whether the workbook for key can still be served by this process without its inputs."""
+        with self._lock:
+            if key in self._pending or key in self._in_flight:
+                return True
+        return key in self.byte_cache
+
+    def get(self, key, rebuild=None):
+        """
+        Returns (ticker, xlsx bytes) or None if the workbook is not (or no longer) available.
+        rebuild(inputs) -> (ticker, workbook) is used when only the inputs are still known.
+        """
+        artifact = self.byte_cache.get(key)
+        if artifact is not None:
+            return artifact
+        with self._lock:
+            event = self._in_flight.get(key)
+            serializing = event is None
+            if serializing:
+                event = self._in_flight[key] = threading.Event()
+        if not serializing:
+            # Another thread is already saving (or rebuilding) this workbook; use its bytes
+            event.wait()
+            return self.byte_cache.get(key)
+        try:
+            return self._serialize(key, rebuild)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            event.set()
+
+    def _serialize(self, key, rebuild):
+        with self._lock:
+            pending = self._pending.pop(key, None)
+        if pending is None:
+            inputs = self.input_cache.get(key) if self.input_cache is not None and rebuild is not None else None
+            if inputs is None:
+                return None
+            logging.info(f"Rebuilding workbook {key[:12]} from its stored inputs")
+            pending = rebuild(inputs)
+        ticker, wb = pending
+        buffer = io.BytesIO()
+        with (self.metrics.stage('save') if self.metrics is not None else _NULL_STAGE) as stage:
+            if isinstance(wb, StreamedWorkbook):
+                stage.count(cells=wb.save(buffer))
+            else:
+                wb.save(buffer)
+                stage.count(cells=sum(len(ws._cells) for ws in wb.worksheets))
+        artifact = (ticker, buffer.getvalue())
+        self.byte_cache.put(key, artifact)
+        logging.info(f"Serialized workbook for {ticker} ({len(artifact[1])} bytes) for download")
+        return artifact
+
+    def persist(self, key):
+        """Serializes a pending workbook now, e.g. before the process holding it goes away."""
+        return self.get(key) is not None
+
+
+# --- Statement Store ---
+class StatementStore:
+    """
+    Persistent SQLite store of processed statements. Every value is a row keyed by
+    (ticker, statement, kind, line item, period): kind 'input' holds the cleaned CSV data and
+    'output' the computed display sheets. Periods are ISO dates ('2023-12-31') or 'ttm'.
+
+    Writes are upserts tagged with the newest fiscal period of the file they came from (as_of),
+    and a value only replaces one from a file at least as new. A newer annual file therefore
+    updates the overlapping periods, adds its new ones and leaves older history in place, while
+    re-processing an old file cannot overwrite newer numbers. The latest full result per ticker
+    is kept as well (as JSON), so a stored ticker can be shown again without rebuilding its workbook.
+
+    Each call opens its own connection, so one store object can be shared by threads and by
+    forked worker processes.
+    """
+    KINDS = ('input', 'output')
+    PERIOD_FORMATS = ('%m/%d/%Y', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S')
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS statement_values (
+            ticker     TEXT NOT NULL,
+            statement  TEXT NOT NULL,
+            kind       TEXT NOT NULL,
+            line_item  TEXT NOT NULL,
+            period     TEXT NOT NULL,
+            position   INTEGER NOT NULL, -- row order within the statement
+            value      REAL,             -- numeric values
+            text       TEXT,             -- anything else
+            as_of      TEXT NOT NULL,    -- newest period of the file the value came from
+            result_key TEXT NOT NULL,
+            PRIMARY KEY (ticker, statement, kind, line_item, period)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS statement_values_by_period
+            ON statement_values (ticker, statement, kind, period);
+        CREATE INDEX IF NOT EXISTS statement_values_by_line_item
+            ON statement_values (kind, line_item);
+        CREATE TABLE IF NOT EXISTS statement_results (
+            ticker       TEXT PRIMARY KEY,
+            result_key   TEXT NOT NULL,
+            as_of        TEXT NOT NULL,
+            processed_at TEXT NOT NULL,
+            result       TEXT NOT NULL  -- process_statements result as JSON (see _result_json)
+        );
+    """
+    UPSERT_VALUE = """
+        INSERT INTO statement_values (ticker, statement, kind, line_item, period, position, value, text, as_of, result_key)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (ticker, statement, kind, line_item, period) DO UPDATE SET
+            position = excluded.position, value = excluded.value, text = excluded.text,
+            as_of = excluded.as_of, result_key = excluded.result_key
+        WHERE excluded.as_of >= statement_values.as_of
+    """
+    UPSERT_RESULT = """
+        INSERT INTO statement_results (ticker, result_key, as_of, processed_at, result) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (ticker) DO UPDATE SET
+            result_key = excluded.result_key, as_of = excluded.as_of,
+            processed_at = excluded.processed_at, result = excluded.result
+        WHERE excluded.as_of >= statement_results.as_of
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL") # Readers don't block the (single) writer
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        return contextlib.closing(sqlite3.connect(self.path, timeout=30))
+
+    @classmethod
+    def normalize_period(cls, header):
+        """'12/31/2023', a datetime or '2023-12-31' -> '2023-12-31'; other headers ('ttm') as stripped text."""
+        if isinstance(header, datetime):
+            return header.date().isoformat()
+        text = str(header).strip()
+        for period_format in cls.PERIOD_FORMATS:
+            try:
+                return datetime.strptime(text, period_format).date().isoformat()
+            except ValueError:
+                pass
+        return text
+
+    @staticmethod
+    def _split_value(value):
+        """(numeric value, text) columns for one cell; missing values are stored as NULL/NULL."""
+        if value is None:
+            return None, None
+        if isinstance(value, datetime):
+            return None, value.isoformat()
+        if isinstance(value, str):
+            return None, value
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None, str(value)
+        return (number, None) if math.isfinite(number) else (None, None)
+
+    def _rows(self, ticker, statement, kind, headers, rows, as_of, result_key):
+        """Value rows for one table: the first column holds the line items, the others one period each."""
+        periods = [(index, self.normalize_period(header)) for index, header in enumerate(headers)
+                   if index > 0 and header is not None and str(header).strip()]
+        for position, row in enumerate(rows):
+            line_item = row[0] if len(row) else None
+            if line_item is None or not str(line_item).strip():
+                continue
+            line_item = str(line_item).strip()
+            for index, period in periods:
+                value, text = self._split_value(row[index] if index < len(row) else None)
+                yield (ticker, statement, kind, line_item, period, position, value, text, as_of, result_key)
+
+    @staticmethod
+    def _as_of(periods):
+        """The newest dated period, or '' if there is none."""
+        dated = [period for period in periods if re.fullmatch(r"\d{4}-\d{2}-\d{2}", period)]
+        return max(dated, default='')
+
+    def upsert(self, result, statement_frames=None):
+        """
+        Stores a process_statements result (the computed sheets) and, optionally, the cleaned
+        input DataFrames ({sheet name: df}) it was built from. Returns the as_of date used.
+        """
+        ticker, result_key = result['ticker'], result['result_key']
+        tables = []
+        for statement, df in (statement_frames or {}).items():
+            if df.shape[1] > 1:
+                tables.append((statement, 'input', list(df.columns), df.to_numpy(dtype=object).tolist()))
+        for statement, sheet in result['sheets'].items():
+            tables.append((statement, 'output', sheet['headers'], sheet['data']))
+        as_of = self._as_of(self.normalize_period(header) for _, _, headers, _ in tables for header in headers[1:] if header is not None)
+
+        with self._connect() as conn, conn:
+            for statement, kind, headers, rows in tables:
+                conn.executemany(self.UPSERT_VALUE, self._rows(ticker, statement, kind, headers, rows, as_of, result_key))
+            conn.execute(self.UPSERT_RESULT, (ticker, result_key, as_of, datetime.now().isoformat(timespec='seconds'),
+                                              self._result_json(result)))
+        logging.debug("Stored %s (%s) as of %s", ticker, result_key[:12], as_of or 'undated')
+        return as_of
+
+    def latest_result(self, ticker):
+        """The newest stored process_statements result for ticker, or None."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT result FROM statement_results WHERE ticker = ?", (ticker.upper(),)).fetchone()
+        if row is None or not isinstance(row[0], str):
+            return None # Stores written before results were kept as JSON hold pickles, which are never loaded
+        return json.loads(row[0], object_hook=self._decode_json_value)
+
+    @staticmethod
+    def _result_json(result):
+        """The result's sheets as JSON; datetimes become {"$datetime": ISO string} so they load as datetimes again."""
+        def encode(value):
+            if isinstance(value, datetime):
+                return {'$datetime': value.isoformat()}
+            raise TypeError(f"Cannot store a {type(value).__name__} value")
+        return json.dumps({'ticker': result['ticker'], 'result_key': result['result_key'], 'sheets': result['sheets']},
+                          default=encode)
+
+    @staticmethod
+    def _decode_json_value(obj):
+        if obj.keys() == {'$datetime'}:
+            return datetime.fromisoformat(obj['$datetime'])
+        return obj
+
+    def tickers(self):
+        """[{'ticker', 'as_of', 'processed_at', 'result_key'}] for every stored ticker, alphabetically."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT ticker, as_of, processed_at, result_key FROM statement_results ORDER BY ticker").fetchall()
+        return [{'ticker': ticker, 'as_of': as_of, 'processed_at': processed_at, 'result_key': result_key}
+                for ticker, as_of, processed_at, result_key in rows]
+
+    def values(self, kind, line_items, tickers=None):
+        """[(ticker, line item, period, numeric value)] for these line items across all (or the given) tickers."""
+        query = (f"SELECT ticker, line_item, period, value FROM statement_values WHERE kind = ? "
+                 f"AND line_item IN ({', '.join('?' * len(line_items))}) AND value IS NOT NULL")
+        params = [kind, *line_items]
+        if tickers:
+            query += f" AND ticker IN ({', '.join('?' * len(tickers))})"
+            params.extend(ticker.upper() for ticker in tickers)
+        with self._connect() as conn:
+            return conn.execute(query, params).fetchall()
+
+    def history(self, ticker, kind='input', statements=None, periods=None):
+        """
+        Every stored period of a ticker's statements, newest first ('ttm' leads):
+        {statement: {'periods': [...], 'line_items': [...], 'values': {line item: {period: value}}}}.
+        `statements` and `periods` restrict the read to those names (both use the index).
+        """
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown kind '{kind}'; expected one of {', '.join(self.KINDS)}")
+        query = "SELECT statement, line_item, period, position, value, text FROM statement_values WHERE ticker = ? AND kind = ?"
+        params = [ticker.upper(), kind]
+        for column, names in (('statement', statements), ('period', periods)):
+            if names:
+                query += f" AND {column} IN ({', '.join('?' * len(names))})"
+                params.extend(names)
+        history = {}
+        with self._connect() as conn:
+            for statement, line_item, period, position, value, text in conn.execute(query, params):
+                sheet = history.setdefault(statement, {'periods': set(), 'positions': {}, 'values': {}})
+                sheet['periods'].add(period)
+                # Line items are listed in file order
+                sheet['positions'][line_item] = min(position, sheet['positions'].get(line_item, position))
+                sheet['values'].setdefault(line_item, {})[period] = value if value is not None else text
+        for sheet in history.values():
+            periods = sheet['periods']
+            sheet['periods'] = (['ttm'] if 'ttm' in periods else []) + sorted(periods - {'ttm'}, reverse=True)
+            positions = sheet.pop('positions')
+            sheet['line_items'] = sorted(positions, key=lambda line_item: (positions[line_item], line_item))
+        return history
+
+
+# --- Screening ---
+class StatementScreener:
+    """
+    Computes the template's key metrics for every ticker in a StatementStore in one pass.
+    The stored line items are pivoted into ticker x fiscal-year arrays: offset 0 is each
+    ticker's latest fiscal year, 1 the year before, and so on. Each metric is then a
+    column-wise operation over all tickers, and filters and sorting run on the resulting frame.
+    """
+    # Statement line items the metrics are built from, as named in the CSVs
+    LINE_ITEMS = {
+        'revenue': 'TotalRevenue',
+        'gross_profit': 'GrossProfit',
+        'operating_income': 'OperatingIncome',
+        'net_income': 'NetIncome',
+        'operating_cash_flow': 'OperatingCashFlow',
+        'free_cash_flow': 'FreeCashFlow',
+        'total_debt': 'TotalDebt',
+        'equity': 'StockholdersEquity',
+    }
+    METRICS = {
+        'revenue': "Revenue, latest fiscal year",
+        'gross_margin': "Gross profit / revenue",
+        'operating_margin': "Operating income / revenue",
+        'net_margin': "Net income / revenue",
+        'fcf_margin': "Free cash flow / revenue",
+        'cash_conversion': "Operating cash flow / net income",
+        'debt_to_equity': "Total debt / stockholders' equity",
+        'revenue_growth': "Revenue growth over the previous fiscal year",
+        'net_income_growth': "Net income growth over the previous fiscal year",
+        'revenue_cagr_3y': "Compound annual revenue growth over three fiscal years",
+    }
+    YEARS_NEEDED = 4 # The 3-year CAGR reaches back to offset 3
+    CONDITION_PATTERN = re.compile(r"([a-z0-9_]+)\s*(>=|<=|==|!=|>|<)\s*([-+]?\d+(?:\.\d*)?|[-+]?\.\d+)\s*(%?)", re.IGNORECASE)
+    OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le, '==': operator.eq, '!=': operator.ne}
+
+    def __init__(self, store):
+        self.store = store
+
+    def compute(self, tickers=None):
+        """One row per ticker (index) with 'fiscal_year_end' and every METRICS column; missing inputs give NaN."""
+        import numpy as np
+        import pandas as pd
+        rows = self.store.values('input', list(self.LINE_ITEMS.values()), tickers=tickers)
+        values = pd.DataFrame(rows, columns=['ticker', 'line_item', 'period', 'value'])
+        # Fiscal years only (no ttm), numbered from each ticker's latest one across all its statements
+        values = values[values['period'].str.fullmatch(r"\d{4}-\d{2}-\d{2}")]
+        values = values.assign(offset=values.groupby('ticker')['period'].rank(method='dense', ascending=False) - 1)
+        latest = values[values['offset'] == 0].groupby('ticker')['period'].first()
+        values = values[values['offset'] < self.YEARS_NEEDED]
+        wide = values.pivot_table(index='ticker', columns=['line_item', 'offset'], values='value', aggfunc='first')
+        empty = pd.Series(np.nan, index=wide.index)
+
+        def item(name, offset=0):
+            return wide.get((self.LINE_ITEMS[name], offset), empty)
+
+        revenue, net_income = item('revenue'), item('net_income')
+        revenue_3y_ago = item('revenue', 3)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            metrics = pd.DataFrame({
+                'fiscal_year_end': latest.reindex(wide.index),
+                'revenue': revenue,
+                'gross_margin': item('gross_profit') / revenue,
+                'operating_margin': item('operating_income') / revenue,
+                'net_margin': net_income / revenue,
+                'fcf_margin': item('free_cash_flow') / revenue,
+                'cash_conversion': item('operating_cash_flow') / net_income,
+                'debt_to_equity': item('total_debt') / item('equity'),
+                'revenue_growth': revenue / item('revenue', 1) - 1,
+                'net_income_growth': net_income / item('net_income', 1) - 1,
+                # Only defined when both ends are positive
+                'revenue_cagr_3y': ((revenue / revenue_3y_ago) ** (1 / 3) - 1).where((revenue > 0) & (revenue_3y_ago > 0)),
+            })
+        numeric = list(self.METRICS)
+        metrics[numeric] = metrics[numeric].replace([np.inf, -np.inf], np.nan)
+        metrics.index.name = 'ticker'
+        return metrics
+
+    @classmethod
+    def parse_conditions(cls, conditions):
+        """
+        "fcf_margin > 10% and revenue_cagr_3y > 5%" -> [('fcf_margin', '>', 0.1), ...]. Conditions
+        are joined with "and" (or commas); "%" divides the number by 100. Raises ValueError.
+        """
+        parsed = []
+        for part in re.split(r"\s+and\s+|,", conditions or '', flags=re.IGNORECASE):
+            if not part.strip():
+                continue
+            match = cls.CONDITION_PATTERN.fullmatch(part.strip())
+            if not match:
+                raise ValueError(f"Could not read the condition '{part.strip()}'; expected e.g. 'fcf_margin > 10%'")
+            metric, op, number, percent = match.groups()
+            metric = metric.lower()
+            if metric not in cls.METRICS:
+                raise ValueError(f"Unknown metric '{metric}'; available: {', '.join(cls.METRICS)}")
+            parsed.append((metric, op, float(number) / 100 if percent else float(number)))
+        return parsed
+
+    def screen(self, conditions=None, sort=None, limit=None, tickers=None):
+        """
+        The tickers whose metrics meet every condition (see parse_conditions), sorted by the
+        metric named in `sort` (descending with a leading '-'). Tickers missing a metric that
+        a condition uses are excluded. Returns a DataFrame like compute().
+        """
+        import numpy as np
+        parsed = self.parse_conditions(conditions)
+        descending = bool(sort) and sort.startswith('-')
+        sort_key = sort.lstrip('+-').lower() if sort else None
+        if sort_key and sort_key not in self.METRICS and sort_key not in ('ticker', 'fiscal_year_end'):
+            raise ValueError(f"Cannot sort by '{sort_key}'; available: ticker, fiscal_year_end, {', '.join(self.METRICS)}")
+        metrics = self.compute(tickers)
+        mask = np.ones(len(metrics), dtype=bool)
+        for metric, op, threshold in parsed:
+            mask &= self.OPERATORS[op](metrics[metric], threshold).to_numpy(dtype=bool, na_value=False)
+        result = metrics[mask]
+        if sort_key == 'ticker':
+            result = result.sort_index(ascending=not descending)
+        elif sort_key:
+            result = result.sort_values(sort_key, ascending=not descending, na_position='last', kind='stable')
+        return result.head(limit) if limit else result
+
+    @staticmethod
+    def records(frame):
+        """JSON-ready rows of a compute()/screen() frame; NaN becomes None."""
+        return [{'ticker': ticker, **{name: _json_value(value) for name, value in row.items()}}
+                for ticker, row in zip(frame.index, frame.astype(object).to_dict('records'))]
+
+
+# --- In-Memory Uploads ---
+class UploadedFile:
+    """An input CSV held in memory: its (sanitized) filename and raw bytes. Picklable, so it can be handed to job workers."""
+    __slots__ = ('filename', 'data')
+
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.data = data
+
+
+def _as_input(source):
+    """Normalizes a processor input: paths stay paths, any readable file-like object is read into an UploadedFile."""
+    if isinstance(source, (str, os.PathLike, UploadedFile)):
+        return source
+    name = getattr(source, 'filename', None) or getattr(source, 'name', None) or ''
+    return UploadedFile(os.path.basename(str(name)), source.read())
+
+
+def _input_name(source):
+    return source.filename if isinstance(source, UploadedFile) else os.path.basename(source)
+
+
+def _input_bytes(source):
+    if isinstance(source, UploadedFile):
+        return source.data
+    with open(source, 'rb') as input_file:
+        return input_file.read()
+
+
+# --- Financial Processor Class ---
+class FinancialStatementProcessor:
+    # Keep most methods as they are, just add data extraction
+    # Safe to share between threads; the template state below is read-only after __init__ (see the module docstring)
+
+    # Row where appended data starts on each statement sheet
+    SHEET_APPEND_ROWS = {
+        "Income Statement": 10,
+        "Balance Sheet": 7,
+        "Cash Flow Statement": 9
+    }
+    # Statement sheet for each input file type (classify_files keys)
+    STATEMENT_FILES = {'income': "Income Statement", 'balance': "Balance Sheet", 'cashflow': "Cash Flow Statement"}
+    # Statement CSV names: TICKER_annual_financials.csv, _balance-sheet.csv, _cash-flow.csv
+    FILENAME_PATTERN = re.compile(r"([A-Za-z0-9]+)_annual_(cash-flow|balance-sheet|financials)\.csv", re.IGNORECASE)
+    # A "(1,234)" or (56) field after the first column: accounting-style negative. Being a byte
+    # pattern it also matches inside quoted text, so it is only used for the numbers (see _read_typed_csv)
+    NEGATIVE_PARENS = re.compile(rb'(?m),("?)\((\d[\d,]*(?:\.\d+)?)\)\1(?=,|\r?$)')
+    # Number format for the ratios in Cash Flow Statement rows 2 and 3
+    RATIO_NUMBER_FORMAT = "0.000"
+    # Which parts of each sheet to display - ADJUST THESE RANGES AS NEEDED
+    DISPLAY_CONFIGS = {
+         # Ranges should cover headers and potential data area
+        "Income Statement":  {'display_range': 'A1:L40', 'header_row': 9}, # Adjusted range potentially
+        "Balance Sheet":     {'display_range': 'A1:K50', 'header_row': 6}, # Adjusted range potentially
+        "Cash Flow Statement":{'display_range': 'A1:L50', 'header_row': 8} # Adjusted range potentially
+    }
+    # Template formula cells whose VLOOKUP ranges are stretched to cover the appended data
+    FORMULA_CONFIG = {
+        "Income Statement":    {'range': 'C2:L8', 'adjust_rows_from': SHEET_APPEND_ROWS["Income Statement"]},
+        "Balance Sheet":       {'range': 'B2:K5', 'adjust_rows_from': SHEET_APPEND_ROWS["Balance Sheet"]},
+        "Cash Flow Statement": {'range': 'C2:L5', 'adjust_rows_from': SHEET_APPEND_ROWS["Cash Flow Statement"]}
+    }
+
+    def __init__(self, template_path, result_cache=None, workbook_store=None, metrics=None, statement_store=None, evaluation_cache=None):
+        self.template_path = template_path
+        self.result_cache = result_cache
+        # Last StatementEvaluation per ticker, so re-uploads only re-evaluate what changed
+        self.evaluation_cache = evaluation_cache
+        self.workbook_store = workbook_store
+        self.statement_store = statement_store
+        self.metrics = metrics
+        self.template_fingerprint = None
+        self.wb_template_structure = None # Store the initial template structure
+        self.template_pool = None
+        self.style_registry = None
+        self.template_occupancy = {}
+        self.template_extents = {}
+        self.formula_rewrite_plan = None
+        self.dependency_graph = None
+        self.template_max_rows = {}
+        self.output_writer = None
+        try:
+            # Load the template structure once during initialization
+            self.wb_template_structure = self.load_template_from_path(data_only=False)
+            self.validate_template_sheets(self.wb_template_structure)
+            with open(self.template_path, 'rb') as template_file:
+                self.template_fingerprint = hashlib.sha256(template_file.read()).hexdigest()
+            # Register the formats applied to appended cells before any copies are made,
+            # so every clone shares the same style ids
+            self.style_registry = StyleRegistry(self.wb_template_structure)
+            # Requests work on copies of the parsed template instead of re-reading the file
+            self.template_pool = TemplatePool(self.wb_template_structure)
+            # Non-empty rows per sheet; each request copies this and updates it as it appends
+            self.template_occupancy = {ws.title: RowOccupancy.from_worksheet(ws) for ws in self.wb_template_structure.worksheets}
+            # The template is fixed, so which formulas get rewritten (and where) is known up front
+            self.formula_rewrite_plan = FormulaRewritePlan(self.wb_template_structure, self.FORMULA_CONFIG)
+            # ...and so is which cells each formula reads, for re-evaluating only what a change reaches
+            self.dependency_graph = FormulaDependencyGraph(self.wb_template_structure, self.formula_rewrite_plan)
+            # (last used row, last column) per sheet, so extraction doesn't have to scan whole sheets for them
+            self.template_extents = {ws.title: (self._used_max_row(ws), ws.max_column) for ws in self.wb_template_structure.worksheets}
+            self.template_max_rows = {ws.title: ws.max_row for ws in self.wb_template_structure.worksheets}
+            # Downloads and batch outputs are streamed from the template file rather than saved by openpyxl
+            try:
+                ratio_cells = self._ratio_cells(self.wb_template_structure["Cash Flow Statement"])
+                self.output_writer = StreamingWorkbookWriter(
+                    self.template_path, self.wb_template_structure, self.SHEET_APPEND_ROWS, self.formula_rewrite_plan,
+                    fixed_formats={"Cash Flow Statement": {cell: self.RATIO_NUMBER_FORMAT for cell in ratio_cells}})
+            except Exception as writer_error:
+                logging.warning(f"Template cannot be streamed ({writer_error}); workbooks will be saved through openpyxl")
+        except Exception as e:
+            logging.error(f"Processor Initialization failed: {e}")
+            # No need to call cleanup_temp_template here, atexit handles it
+            raise e # Re-raise to prevent app start if processor fails
+
+    def load_template_from_path(self, data_only=False):
+        try:
+            if not os.path.exists(self.template_path):
+                raise FileNotFoundError(f"Template not found: {self.template_path}")
+            # Only called once at startup; requests clone the parsed copy via TemplatePool
+            wb = load_workbook(self.template_path, data_only=data_only)
+            logging.info(f"Loaded template structure from: {self.template_path} (data_only={data_only})")
+            return wb
+        except Exception as e:
+            logging.error(f"Error loading template: {e}")
+            raise Exception(f"Error loading template: {e}")
+
+    def validate_template_sheets(self, wb_to_check):
+        required = ["Income Statement", "Balance Sheet", "Cash Flow Statement"]
+        available_sheets = wb_to_check.sheetnames
+        for sheet in required:
+            if sheet not in available_sheets:
+                logging.error(f"Template sheet validation failed. Missing: '{sheet}'. Available: {available_sheets}")
+                raise ValueError(f"Required sheet '{sheet}' missing in template. Available: {available_sheets}")
+        logging.info("Template sheets validated successfully.")
+
+    def load_csv(self, file_path, sheet_name):
+        """
+        Reads a statement CSV from a path or an in-memory UploadedFile into the line-item label
+        column plus numeric period columns. Parenthesized negatives are rewritten at the byte level
+        for the number parse and read_csv handles the thousands separators, so the C parser
+        produces the numbers and clean_data has nothing left to convert in them. A file with
+        anything else in its period columns is read untyped, and clean_data converts it as before.
+
+        Period columns are int64 when every value is a whole number and float64 otherwise (e.g.
+        with a blank), so whole numbers reach the workbook, JSON and statement store as 1234, not
+        1234.0. This now also holds for columns written as "1,234" or "(56)", which used to be float64.
+        """
+        import pandas as pd # Imported on first use; prepare_for_workers() loads it before forking
+        file_name = _input_name(file_path)
+        try:
+            logging.debug("Loading CSV: %s for sheet %s", file_name, sheet_name)
+            data = file_path.data if isinstance(file_path, UploadedFile) else self._read_file_bytes(file_path)
+            try:
+                df = self._read_typed_csv(data)
+            except ValueError:
+                logging.debug("Non-numeric period values in %s; reading it untyped", file_name)
+                df = pd.read_csv(io.BytesIO(data))
+            logging.debug("Successfully loaded CSV: %s", file_name)
+            return df
+        except FileNotFoundError:
+            logging.error(f"CSV not found: {file_path}")
+            raise FileNotFoundError(f"CSV file not found: {file_name}")
+        except pd.errors.EmptyDataError:
+            logging.warning(f"CSV file is empty: {file_name}")
+            # Return an empty DataFrame instead of raising an error immediately
+            return pd.DataFrame()
+        except Exception as e:
+            logging.error(f"Error reading CSV {file_name}: {e}")
+            raise Exception(f"Error reading CSV {file_name}: {e}")
+
+    @staticmethod
+    def _read_file_bytes(path):
+        with open(path, 'rb') as csv_file:
+            return csv_file.read()
+
+    @classmethod
+    def _read_typed_csv(cls, data):
+        """
+        First column as text, every other column numeric (raises ValueError if one does not parse).
+        The numbers are parsed from the bytes with "(1,234)" fields turned into "-1,234". That
+        rewrite can also hit quoted text (a label like "Notes,(1),other"), so when it changed
+        anything the labels and headers are taken from the untouched bytes instead. It never adds
+        or removes quotes, commas or line breaks, so both parses have the same rows.
+        """
+        import pandas as pd
+        numbers, rewrites = cls.NEGATIVE_PARENS.subn(rb',\1-\2\1', data)
+        columns = pd.read_csv(io.BytesIO(numbers), nrows=0).columns
+        # An explicit mapping: read_csv only takes a defaultdict as dtype from pandas 1.5 on
+        dtypes = {column: 'float64' for column in columns[1:]} # Period columns
+        if len(columns):
+            dtypes[columns[0]] = object # Line-item labels
+        df = pd.read_csv(io.BytesIO(numbers), thousands=',', dtype=dtypes)
+        if rewrites and len(columns):
+            labels = pd.read_csv(io.BytesIO(data), usecols=[0], dtype=object)
+            df.columns = pd.read_csv(io.BytesIO(data), nrows=0).columns
+            df.iloc[:, 0] = labels.iloc[:, 0].to_numpy()
+        for column in df.columns[1:]: # read_csv makes repeated headers unique, so names are safe here
+            df[column] = cls._whole_numbers_as_int(df[column])
+        return df
+
+    @staticmethod
+    def _whole_numbers_as_int(column):
+        """A float64 column as int64 if it holds only whole numbers (no blanks), else unchanged."""
+        import numpy as np
+        values = column.to_numpy()
+        if not len(values) or not np.isfinite(values).all() or (values != np.trunc(values)).any():
+            return column
+        if np.abs(values).max() > 2 ** 53: # Beyond this, floats are not exact integers anyway
+            return column
+        return column.astype('int64')
+
+    def clean_data(self, df, sheet_name):
+        if df.empty:
+             logging.warning(f"Skipping cleaning for empty DataFrame: {sheet_name}")
+             return df
+        logging.debug("Cleaning data for sheet: %s", sheet_name)
+        df.columns = df.columns.str.strip()
+        if df.columns.tolist() and len(df.columns) >= 1:
+            try:
+                # Ensure the first column exists before trying to access iloc[:, 0]
+                if df.shape[1] > 0:
+                    df.iloc[:, 0] = df.iloc[:, 0].astype(str).str.replace(r"^\s+|\s+$|\t", "", regex=True)
+                else:
+                     logging.warning(f"DataFrame for {sheet_name} has no columns, skipping first column cleaning.")
+            except Exception as e:
+                logging.warning(f"Warning: Cleaning the first column failed for {sheet_name}: {e}")
+        # Drop rows where ALL columns are NaN
+        df.dropna(how='all', inplace=True)
+        # Parse "1,234" / "(56)" style numbers column-wise, so appending only has to assign values
+        df = self.coerce_numeric_columns(df)
+        df.attrs['number_formats'] = self.build_number_format_mask(df)
+        logging.debug("Finished cleaning data for sheet: %s. Shape: %s", sheet_name, df.shape)
+        return df
+
+    @staticmethod
+    def coerce_numeric_columns(df):
+        """
+        Converts numeric-looking text to numbers one column at a time: thousands separators are
+        removed and "(123)" becomes -123. Columns that convert completely become numeric (int64 if
+        they hold only whole numbers, float64 otherwise); mixed
+        columns (e.g. the line-item labels) keep their text and get numbers where they parse.
+        Blank strings become missing values.
+        """
+        import pandas as pd
+        coerced = {}
+        for position in range(df.shape[1]):
+            column = df.iloc[:, position]
+            if not (column.dtype == object or pd.api.types.is_string_dtype(column)):
+                coerced[position] = column
+                continue
+            column = column.astype(object)
+            try:
+                # .str yields NaN for non-string entries, which then simply fail to convert
+                text = column.str.replace(',', '', regex=False).str.strip()
+            except AttributeError: # No strings in this column at all
+                coerced[position] = column
+                continue
+            is_negative = (text.str.startswith('(') & text.str.endswith(')')).fillna(False).astype(bool)
+            text = text.where(~is_negative, text.str[1:-1])
+            parsed = pd.to_numeric(text, errors='coerce')
+            parsed = parsed.where(~is_negative, -parsed)
+            is_blank = (text == '').fillna(False).astype(bool) | column.isna()
+            parsed_ok = parsed.notna()
+            if (parsed_ok | is_blank).all():
+                coerced[position] = FinancialStatementProcessor._whole_numbers_as_int(parsed.astype('float64'))
+            else:
+                mixed = column.where(~parsed_ok, parsed.astype(object))
+                coerced[position] = mixed.where(~is_blank, None)
+        result = pd.DataFrame(coerced, index=df.index)
+        result.columns = df.columns
+        return result
+
+    @staticmethod
+    def build_number_format_mask(df):
+        """
+        Returns a (rows x columns) object array holding the number format to apply to each cell,
+        or None where the cell keeps the default format. Worked out per column from the dtypes.
+        """
+        import numpy as np
+        import pandas as pd
+        mask = np.full(df.shape, None, dtype=object)
+        for position in range(df.shape[1]):
+            column = df.iloc[:, position]
+            if pd.api.types.is_bool_dtype(column):
+                continue
+            if pd.api.types.is_numeric_dtype(column):
+                mask[column.notna().to_numpy(), position] = numbers.FORMAT_NUMBER_00
+            elif pd.api.types.is_datetime64_any_dtype(column):
+                mask[column.notna().to_numpy(), position] = numbers.FORMAT_DATE_YYYYMMDD2
+            else:
+                is_number = column.map(lambda v: isinstance(v, (int, float)) and not isinstance(v, bool) and v == v)
+                is_date = column.map(lambda v: isinstance(v, datetime))
+                mask[is_number.to_numpy(dtype=bool), position] = numbers.FORMAT_NUMBER_00
+                mask[is_date.to_numpy(dtype=bool), position] = numbers.FORMAT_DATE_YYYYMMDD2
+        return mask
+
+    def append_data_to_excel(self, df, wb, sheet_name, start_row, occupancy=None, extents=None):
+        if sheet_name not in wb.sheetnames:
+             logging.error(f"Sheet '{sheet_name}' not found in workbook during append.")
+             raise ValueError(f"Sheet '{sheet_name}' not found.")
+
+        ws = wb[sheet_name]
+        if occupancy is None:
+            occupancy = RowOccupancy.from_worksheet(ws)
+        # Start of the first block of 4 empty rows at or after 'start_row'
+        target_start_row = occupancy.first_free_block(start_row)
+
+        logging.debug("Determined append start row for '%s' as %s", sheet_name, target_start_row)
+
+        if df.empty:
+            logging.warning(f"DataFrame for '{sheet_name}' is empty. Skipping append.")
+            return # Don't try to append an empty dataframe
+
+        logging.debug("Appending %s rows to '%s' starting at row %s", len(df), sheet_name, target_start_row)
+
+        with self._stage('append') as stage:
+            # Values were already coerced column-wise in clean_data; the loop only assigns them
+            number_formats = df.attrs.get('number_formats')
+            if number_formats is None or number_formats.shape != df.shape:
+                number_formats = self.build_number_format_mask(df)
+            number_format_ids = self._style_registry_for(wb).number_format_ids
+            max_cols_to_write = min(df.shape[1], 50) # Limit writing width
+            # One conversion for the whole frame: slicing out columns would deep-copy df.attrs (the format mask) each time
+            columns = df.to_numpy(dtype=object)[:, :max_cols_to_write].T.tolist()
+            rows_written = []
+            for r_offset, row_values in enumerate(zip(*columns)):
+                current_ws_row = target_start_row + r_offset
+                if current_ws_row > EXCEL_MAX_ROW:
+                    logging.warning(f"Stopping append at row {current_ws_row} in sheet {sheet_name}: beyond Excel's row limit")
+                    break
+                row_formats = number_formats[r_offset]
+                row_has_data = False
+                for c_offset, value in enumerate(row_values, start=1):
+                    cell_to_write = ws.cell(row=current_ws_row, column=c_offset)
+                    if value is None or value != value: # None or NaN
+                        cell_to_write.value = None
+                        continue
+                    cell_to_write.value = value
+                    number_format = row_formats[c_offset - 1]
+                    if number_format is not None:
+                        if cell_to_write._style is None: # openpyxl creates the style array lazily
+                            cell_to_write._style = StyleArray()
+                        cell_to_write._style.numFmtId = number_format_ids[number_format]
+                    if not row_has_data:
+                        row_has_data = not _is_blank(value)
+                if row_has_data:
+                    rows_written.append(current_ws_row)
+            occupancy.mark(rows_written)
+            stage.count(rows=len(rows_written), cells=len(df) * max_cols_to_write)
+
+        # Apply alignment formatting after appending all data for this sheet
+        max_column = None
+        if extents is not None:
+            # The cells just written span columns 1..max_cols_to_write; formatting then styles every appended row
+            used_max_row, max_column = extents[sheet_name]
+            max_column = max(max_column, max_cols_to_write)
+            extents[sheet_name] = (max(used_max_row, min(target_start_row + len(df) - 1, EXCEL_MAX_ROW)), max_column)
+        self.apply_formatting(ws, target_start_row, len(df), max_column)
+
+
+    def apply_formatting(self, ws, start_row, num_rows, max_column=None):
+        if num_rows <= 0: return
+        end_row = min(start_row + num_rows - 1, EXCEL_MAX_ROW)
+        logging.debug("Applying alignment formatting to '%s' rows %s-%s", ws.title, start_row, end_row)
+        max_col_to_format = min(max_column or ws.max_column, 49) # Limit formatting width
+        with self._stage('formatting') as stage:
+            # Number formats are applied during append, so this only does alignment
+            self._style_registry_for(ws.parent).align_rows(ws, start_row, end_row, max_col_to_format)
+            stage.count(rows=end_row - start_row + 1, cells=(end_row - start_row + 1) * max_col_to_format)
+
+    def _stage(self, name):
+        """Metrics timer for one pipeline stage (a no-op when the processor has no metrics)."""
+        return self.metrics.stage(name) if self.metrics is not None else _NULL_STAGE
+
+    def _style_registry_for(self, wb):
+        if self.style_registry is None:
+            self.style_registry = StyleRegistry(wb)
+        return self.style_registry.for_workbook(wb)
+
+    def update_formulas(self, wb, data_length_map, formula_config, occupancy=None, rewrite_plan=None):
+        logging.debug("Starting formula update process...")
+        if occupancy is None:
+            occupancy = {}
+        appended = [sheet_name for sheet_name in formula_config if data_length_map.get(sheet_name, 0) > 0]
+        occupancy = {sheet_name: occupancy.get(sheet_name) or RowOccupancy.from_worksheet(wb[sheet_name]) for sheet_name in appended}
+        max_end_row_map = self._data_end_rows(data_length_map, formula_config, occupancy, {sheet_name: wb[sheet_name].max_row for sheet_name in appended})
+
+        # Now, adjust formulas based on the calculated max_end_row_map
+        if rewrite_plan is None:
+            rewrite_plan = FormulaRewritePlan(wb, formula_config)
+        updated_count, skipped_count = rewrite_plan.apply(wb, max_end_row_map)
+        if skipped_count:
+            logging.warning(f"{skipped_count} VLOOKUP range(s) left unadjusted: their sheet has no data end row")
+        logging.debug("Adjusted %s formulas.", updated_count)
+        logging.debug("Formula update finished.")
+        return {'formulas_rewritten': updated_count, 'vlookup_skipped': skipped_count}
+
+
+    def _data_end_rows(self, data_length_map, formula_config, occupancy, max_rows):
+        """
+        Last data row per sheet, which the VLOOKUP ranges are stretched to. occupancy and max_rows
+        ({sheet: RowOccupancy}, {sheet: ws.max_row}) describe the sheets after the appends and are
+        only needed for sheets that got data.
+        """
+        max_end_row_map = {}
+        # Determine the actual end row for data in each relevant sheet
+        for sheet_name, details in formula_config.items():
+            data_start_row_config = details['adjust_rows_from'] # The row where data STARTS
+            if sheet_name in data_length_map and data_length_map[sheet_name] > 0:
+                sheet_occupancy = occupancy[sheet_name]
+                # Only look where data could have been appended, slightly beyond the expected end
+                max_check_row = data_start_row_config + data_length_map[sheet_name] + 5
+                max_check_row = min(max_check_row, max_rows[sheet_name] + 5) # Don't check excessively far
+
+                first_data_row = sheet_occupancy.first_occupied(data_start_row_config, max_check_row)
+                if first_data_row == data_start_row_config and first_data_row > 1 and sheet_occupancy.is_occupied(first_data_row - 1):
+                    # The configured start row continues a block above it (e.g. headers), so it is not the data start
+                    first_data_row = sheet_occupancy.first_occupied(data_start_row_config + 1, max_check_row)
+
+                if first_data_row is None:
+                    # Could not find any data start row, use config start row for end calculation
+                    max_end_row_map[sheet_name] = data_start_row_config + data_length_map[sheet_name] - 1
+                    logging.warning(f"Could not find data start row for '{sheet_name}'. Using config start {data_start_row_config}. Calculated end row: {max_end_row_map[sheet_name]}")
+                else:
+                    block_end_row = sheet_occupancy.run_end(first_data_row)
+                    if block_end_row < max_check_row:
+                        # An empty row follows the data block. Assume data ended just before it.
+                        max_end_row_map[sheet_name] = block_end_row
+                        logging.debug("Determined data range for '%s': Rows %s to %s", sheet_name, first_data_row, max_end_row_map[sheet_name])
+                    else:
+                        # Data runs past the checked range; calculate the end from the data length
+                        max_end_row_map[sheet_name] = min(first_data_row + data_length_map[sheet_name] - 1, max_rows[sheet_name])
+                        logging.debug("Data seems contiguous for '%s'. Determined range: Rows %s to %s", sheet_name, first_data_row, max_end_row_map[sheet_name])
+
+            else:
+                # If no data was appended, the "last row" for formula adjustment is effectively the row *before* data would start
+                max_end_row_map[sheet_name] = data_start_row_config - 1
+                logging.debug("No data appended to '%s'. Effective last row for formula adjustment: %s", sheet_name, max_end_row_map[sheet_name])
+        return max_end_row_map
+
+    @staticmethod
+    def _used_max_row(ws):
+        """
+        Last row holding a value or a style. Unlike ws.max_row this ignores empty cells that were
+        only created by reads (e.g. ws[row] scans), which a saved and reloaded workbook would drop.
+        """
+        used_rows = [row for (row, _), cell in ws._cells.items() if cell._value is not None or cell.has_style]
+        return max(used_rows, default=1)
+
+    def _extract_data_from_workbook(self, wb, sheet_configs, extents=None, format_values=True, stage=_NULL_STAGE, evaluator=None):
+        """
+        Extracts data from specified sheets and ranges in the workbook. Formula cells are computed in-process.
+        Only the cells inside each display range are read. `extents` ({sheet: (last used row, last column)},
+        as returned by build_workbook) saves scanning every cell of a sheet to clip the range to the used area.
+        With format_values=False the rows hold the raw values (numbers, datetimes) instead of display strings.
+        Formula evaluation errors are counted on `stage` (and logged once) instead of per cell, unless
+        the caller passes its own `evaluator` and reports them itself.
+        """
+        extracted_data = {}
+        report_errors = evaluator is None
+        if evaluator is None:
+            evaluator = FormulaEvaluator(wb)
+        logging.debug("Starting data extraction from processed workbook.")
+        for sheet_name, config in sheet_configs.items():
+            if sheet_name not in wb.sheetnames:
+                logging.warning(f"Sheet '{sheet_name}' not found in workbook for extraction.")
+                extracted_data[sheet_name] = {'headers': [], 'data': []}
+                continue
+
+            ws = wb[sheet_name]
+            data_range_str = config.get('display_range', None)
+            header_row_num = config.get('header_row', 1) # Default to row 1 if not specified
+
+            sheet_data = []
+            headers = []
+
+            if data_range_str:
+                try:
+                    # Ensure max row doesn't exceed actual sheet dimensions
+                    extent = extents[sheet_name] if extents and sheet_name in extents else (self._used_max_row(ws), ws.max_column)
+                    min_col_idx, max_col_idx, header_row, min_row_idx, max_row_idx = self._display_window(config, extent)
+
+                    # --- Extract Headers ---
+                    # Check if header row is valid and within sheet bounds
+                    if header_row is not None:
+                        # Extract headers only within the specified column range
+                        headers = [evaluator.value(sheet_name, header_row, col_idx) for col_idx in range(min_col_idx, max_col_idx + 1)]
+                    else:
+                         logging.warning(f"Header row {header_row_num} is outside the sheet bounds or display range for sheet '{sheet_name}'. No headers extracted.")
+                         headers = [""] * (max_col_idx - min_col_idx + 1) # Placeholder headers
+
+
+                    # --- Extract Data Rows ---
+                    logging.debug("Extracting data from '%s' calculated range %s%s:%s%s", sheet_name, get_column_letter(min_col_idx), min_row_idx, get_column_letter(max_col_idx), max_row_idx)
+                    # Ensure min_row_idx is not greater than max_row_idx after header adjustment
+                    if min_row_idx <= max_row_idx:
+                        for row_idx in range(min_row_idx, max_row_idx + 1):
+                             # Extract row data only within the specified column range
+                             row_data = [evaluator.value(sheet_name, row_idx, col_idx) for col_idx in range(min_col_idx, max_col_idx + 1)]
+                             sheet_data.append(self.format_row_for_display(row_data) if format_values else row_data)
+                    else:
+                         logging.debug("No data rows to extract for sheet '%s' after header processing (min_row > max_row).", sheet_name)
+
+
+                except Exception as extract_error:
+                    logging.error(f"Error extracting data from range '{data_range_str}' in sheet '{sheet_name}': {extract_error}", exc_info=True)
+                    # Provide empty data on error for this sheet
+                    headers = []
+                    sheet_data = []
+            else:
+                 logging.warning(f"No 'display_range' specified for sheet '{sheet_name}'. Skipping data extraction.")
+
+
+            extracted_data[sheet_name] = {'headers': headers, 'data': sheet_data}
+            logging.debug("Extracted %s rows of data with %s headers for sheet '%s'.", len(sheet_data), len(headers), sheet_name)
+
+        if report_errors:
+            self._report_formula_errors(evaluator, stage)
+        logging.debug("Finished data extraction from workbook.")
+        return extracted_data
+
+    @staticmethod
+    def _report_formula_errors(evaluator, stage):
+        if evaluator.error_count:
+            stage.event('formula_errors', evaluator.error_count)
+            logging.warning(f"{evaluator.error_count} formula(s) could not be evaluated and show #VALUE!; enable DEBUG logging for the cells")
+
+    @staticmethod
+    def _display_window(config, extent):
+        """
+        (first column, last column, header row or None, first data row, last data row) of a
+        DISPLAY_CONFIGS entry, clipped to the sheet's (last used row, last column) extent.
+        """
+        min_col, min_row, max_col, max_row = openpyxl.utils.range_boundaries(config['display_range'])
+        max_row = min(max_row, extent[0])
+        max_col = min(max_col, extent[1])
+        header_row = config.get('header_row', 1) # Default to row 1 if not specified
+        if not 1 <= header_row <= max_row:
+            header_row = None
+        elif header_row >= min_row:
+            # Adjust data start row if headers were within the display range
+            min_row = header_row + 1
+        return min_col, max_col, header_row, min_row, max_row
+
+    @staticmethod
+    def format_row_for_display(row_data):
+        """Display strings for one extracted row: numbers as "1,234.00", dates as YYYY-MM-DD, the rest as is."""
+        formatted_row = []
+        for cell_value in row_data:
+            if isinstance(cell_value, (int, float)):
+                # Basic number formatting for display
+                try:
+                     # Simple comma format, 2 decimal places
+                     formatted_row.append(f"{cell_value:,.2f}")
+                except (ValueError, TypeError):
+                     formatted_row.append(cell_value) # Fallback
+            elif isinstance(cell_value, datetime):
+                formatted_row.append(cell_value.strftime('%Y-%m-%d'))
+            else:
+                formatted_row.append(cell_value) # Keep strings, None, etc. as is
+        return formatted_row
+
+    @classmethod
+    def format_result_for_display(cls, result):
+        """Copy of a process_statements result with every data row formatted for the HTML page."""
+        sheets = {
+            sheet_name: {'headers': sheet['headers'], 'data': [cls.format_row_for_display(row) for row in sheet['data']]}
+            for sheet_name, sheet in result['sheets'].items()
+        }
+        return dict(result, sheets=sheets)
+
+    def result_cache_key(self, ticker_symbol, file_map):
+        """Content hash of the three input files (by statement type), the ticker and the template."""
+        digest = hashlib.sha256()
+        digest.update(f"{self.template_fingerprint}|{ticker_symbol}".encode())
+        for file_type in ('income', 'balance', 'cashflow'):
+            file_bytes = _input_bytes(file_map[file_type])
+            digest.update(f"|{file_type}:{len(file_bytes)}|".encode())
+            digest.update(file_bytes)
+        return digest.hexdigest()
+
+    def classify_files(self, file_paths):
+        """
+        Matches the three inputs to their statements by filename (TICKER_annual_type.csv) and
+        returns (ticker, {'income': ..., 'balance': ..., 'cashflow': ...}).
+        """
+        if len(file_paths) != 3:
+            raise ValueError("Please provide exactly 3 CSV files.")
+
+        ticker_symbol = None
+        file_map = {}
+
+        # --- File Classification ---
+        logging.debug("Classifying input files...")
+        with self._stage('classify'):
+            for file_path in map(_as_input, file_paths):
+                filename = _input_name(file_path)
+                match = self.FILENAME_PATTERN.match(filename)
+                if not match:
+                    raise ValueError(f"Invalid filename format: {filename}. Expected TICKER_annual_type.csv")
+
+                current_ticker, sheet_type_raw = match.groups()
+                current_ticker_upper = current_ticker.upper()
+
+                if ticker_symbol is None:
+                    ticker_symbol = current_ticker_upper
+                elif ticker_symbol != current_ticker_upper:
+                    raise ValueError(f"Ticker symbol mismatch in filenames: Expected '{ticker_symbol}', found '{current_ticker_upper}' in {filename}")
+
+                stype = sheet_type_raw.lower()
+                if stype == "financials" and 'income' not in file_map:
+                    file_map['income'] = file_path
+                elif stype == "balance-sheet" and 'balance' not in file_map:
+                    file_map['balance'] = file_path
+                elif stype == "cash-flow" and 'cashflow' not in file_map:
+                    file_map['cashflow'] = file_path
+                else:
+                     # Handle duplicate types
+                     raise ValueError(f"Duplicate file type '{stype}' found or invalid type for filename {filename}")
+
+            if len(file_map) != 3:
+                 missing = {'income', 'balance', 'cashflow'} - file_map.keys()
+                 # Map internal keys back to expected file types for user message
+                 type_map = {'income': 'financials', 'balance': 'balance-sheet', 'cashflow': 'cash-flow'}
+                 missing_types = [type_map[m] for m in missing]
+                 raise ValueError(f"Missing required file types: {', '.join(missing_types)}")
+            logging.debug("Files classified successfully for ticker: %s", ticker_symbol)
+        return ticker_symbol, file_map
+
+    def load_statements(self, file_map, reuse=None):
+        """
+        Loads and cleans the three statements; returns {sheet name: cleaned DataFrame}. Statements
+        in reuse ({sheet name: cleaned DataFrame} loaded earlier from identical files) are not loaded again.
+        """
+        # --- Load and Clean Data ---
+        logging.debug("Loading and cleaning CSV data...")
+        statement_dfs = {}
+        for file_type, sheet_name in self.STATEMENT_FILES.items():
+            if reuse and sheet_name in reuse:
+                statement_dfs[sheet_name] = reuse[sheet_name]
+                continue
+            with self._stage('load_csv') as stage:
+                raw_df = self.load_csv(file_map[file_type], sheet_name)
+                stage.count(rows=len(raw_df), cells=raw_df.size)
+            with self._stage('clean_data') as stage:
+                statement_dfs[sheet_name] = self.clean_data(raw_df, sheet_name)
+                stage.count(rows=len(raw_df), cells=raw_df.size)
+        return statement_dfs
+
+    def build_workbook(self, file_map, statement_dfs=None):
+        """
+        Appends the three statements (loaded from file_map unless already loaded by
+        load_statements) to a template copy and updates its formulas. Returns the workbook
+        and its per-sheet (last used row, last column) extents.
+        """
+        if statement_dfs is None:
+            statement_dfs = self.load_statements(file_map)
+        income_df = statement_dfs["Income Statement"]
+        balance_df = statement_dfs["Balance Sheet"]
+        cash_flow_df = statement_dfs["Cash Flow Statement"]
+
+        # --- Prepare In-Memory Workbook ---
+        logging.debug("Creating in-memory workbook from template...")
+        # Clone the resident parsed template (formulas kept, data_only=False)
+        with self._stage('template_checkout'):
+            wb = self.template_pool.checkout()
+        logging.debug("Cloned template workbook for processing.")
+
+        # --- Append Data ---
+        logging.debug("Appending data to temporary workbook...")
+        sheet_append_info = self.SHEET_APPEND_ROWS
+        # Per-request copy of the template's row index, kept up to date by the appends
+        occupancy = {name: index.copy() for name, index in self.template_occupancy.items()}
+        extents = dict(self.template_extents)
+        self.append_data_to_excel(income_df, wb, "Income Statement", sheet_append_info["Income Statement"], occupancy["Income Statement"], extents)
+        self.append_data_to_excel(balance_df, wb, "Balance Sheet", sheet_append_info["Balance Sheet"], occupancy["Balance Sheet"], extents)
+        self.append_data_to_excel(cash_flow_df, wb, "Cash Flow Statement", sheet_append_info["Cash Flow Statement"], occupancy["Cash Flow Statement"], extents)
+
+        # --- Update Formulas ---
+        logging.debug("Updating formulas in temporary workbook...")
+        data_lengths = {
+            "Income Statement": len(income_df),
+            "Balance Sheet": len(balance_df),
+            "Cash Flow Statement": len(cash_flow_df)
+        }
+        with self._stage('update_formulas') as stage:
+            for event, count in self.update_formulas(wb, data_lengths, self.FORMULA_CONFIG, occupancy, self.formula_rewrite_plan).items():
+                stage.event(event, count)
+
+        # --- Specific Formatting ---
+        logging.debug("Applying specific formatting to Cash Flow Statement rows 2 & 3...")
+        with self._stage('formatting'):
+            try:
+                if "Cash Flow Statement" in wb.sheetnames:
+                    cf_ws = wb["Cash Flow Statement"]
+                    for row_idx, col_idx in self._ratio_cells(cf_ws):
+                        cf_ws.cell(row=row_idx, column=col_idx).number_format = self.RATIO_NUMBER_FORMAT
+                else:
+                    logging.warning("Cash Flow Statement sheet not found for specific formatting.")
+            except Exception as fmt_error:
+                logging.warning(f"Could not apply specific formatting to Cash Flow rows 2-3: {fmt_error}")
+        return wb, extents
+
+    @staticmethod
+    def _ratio_cells(cf_ws):
+        """(row, column) of the numbers in Cash Flow Statement rows 2 and 3 from column C, which are shown with three decimals."""
+        # Determine max column dynamically but cap it reasonably
+        max_col_to_format = min(cf_ws.max_column + 1, 27) # Cap at Z
+        ratio_cells = []
+        for row_idx in [2, 3]:
+            for col_idx in range(3, max_col_to_format): # Start from column C (3)
+                # Stored cells only; formulas and text keep their format
+                cell = cf_ws._cells.get((row_idx, col_idx))
+                if cell is not None and isinstance(cell.value, (int, float)):
+                    ratio_cells.append((row_idx, col_idx))
+        return ratio_cells
+
+    @staticmethod
+    def _rows_with_data(df, start_row, num_rows):
+        """Rows that append_data_to_excel marks as occupied when it writes df's first num_rows rows from start_row."""
+        import numpy as np
+        import pandas as pd
+        values = df.to_numpy(dtype=object)[:num_rows]
+        has_data = np.zeros(num_rows, dtype=bool)
+        for position, dtype in enumerate(df.dtypes.tolist()[:50]):
+            if dtype.kind in 'biufcmM': # Numbers, booleans and dates: only missing values are blank
+                has_data |= ~pd.isna(values[:, position])
+            else:
+                has_data |= ~np.frompyfunc(_is_blank, 1, 1)(values[:, position]).astype(bool)
+        return (np.flatnonzero(has_data) + start_row).tolist()
+
+    def layout_statements(self, statement_dfs, previous=None):
+        """
+        Where build_workbook would put each statement, worked out from the template's row index
+        without a workbook. Returns ({sheet: (first row, columns aligned)}, {sheet: VLOOKUP end row}).
+        Statements that are the same frames as in previous (a StatementEvaluation) keep its layout.
+        """
+        occupancy = {name: index.copy() for name, index in self.template_occupancy.items()}
+        placements = {}
+        max_rows = {}
+        end_rows = {}
+        for sheet_name, append_row in self.SHEET_APPEND_ROWS.items():
+            df = statement_dfs[sheet_name]
+            if previous is not None and previous.frames.get(sheet_name) is df and sheet_name in previous.end_rows:
+                placements[sheet_name] = previous.placements[sheet_name]
+                end_rows[sheet_name] = previous.end_rows[sheet_name]
+                continue
+            target_start_row = occupancy[sheet_name].first_free_block(append_row)
+            # Same width limits as append_data_to_excel and apply_formatting
+            width = min(max(self.template_extents[sheet_name][1], min(df.shape[1], 50)), 49)
+            placements[sheet_name] = (target_start_row, width)
+            max_rows[sheet_name] = self.template_max_rows[sheet_name]
+            if not df.empty:
+                num_rows = max(0, min(len(df), EXCEL_MAX_ROW - target_start_row + 1))
+                occupancy[sheet_name].mark(self._rows_with_data(df, target_start_row, num_rows))
+                max_rows[sheet_name] = max(max_rows[sheet_name], target_start_row + num_rows - 1)
+        formula_config = {sheet_name: details for sheet_name, details in self.FORMULA_CONFIG.items() if sheet_name not in end_rows}
+        data_lengths = {sheet_name: len(statement_dfs[sheet_name]) for sheet_name in formula_config if sheet_name in statement_dfs}
+        end_rows.update(self._data_end_rows(data_lengths, formula_config, occupancy, max_rows))
+        return placements, {sheet_name: end_rows[sheet_name] for sheet_name in self.FORMULA_CONFIG}
+
+    def stream_workbook(self, statement_dfs):
+        """
+        The populated workbook for statement_dfs as a StreamedWorkbook, which is written out from the
+        template when saved, or None if the template could not be prepared for streaming (build_workbook
+        and save that instead).
+        """
+        if self.output_writer is None:
+            return None
+        placements, end_rows = self.layout_statements(statement_dfs)
+        sheets = {}
+        for sheet_name, (start_row, width) in placements.items():
+            df = statement_dfs[sheet_name]
+            number_formats = df.attrs.get('number_formats')
+            if number_formats is None or number_formats.shape != df.shape:
+                number_formats = self.build_number_format_mask(df)
+            sheets[sheet_name] = (df, number_formats, start_row, width)
+        return StreamedWorkbook(self.output_writer, sheets, end_rows)
+
+    def evaluate_statements(self, file_map, previous=None, statement_dfs=None):
+        """
+        Computes the display sheets for the statements in file_map on a PopulatedWorkbookView,
+        without building a workbook, and returns them as a StatementEvaluation (statement_dfs saves
+        loading the files when they are already loaded). Given the ticker's previous evaluation,
+        files that have not changed are not loaded again, and only the formulas and display cells
+        the differences reach (see FormulaDependencyGraph) are evaluated again; everything else is
+        carried over.
+        """
+        digests = {file_type: hashlib.sha256(_input_bytes(source)).hexdigest() for file_type, source in file_map.items()}
+        if statement_dfs is None:
+            unchanged = {}
+            if previous is not None:
+                unchanged = {sheet_name: previous.frames[sheet_name] for file_type, sheet_name in self.STATEMENT_FILES.items()
+                             if previous.digests.get(file_type) == digests.get(file_type)}
+            statement_dfs = self.load_statements(file_map, reuse=unchanged)
+        placements, end_rows = self.layout_statements(statement_dfs, previous)
+        if previous is not None and previous.placements != placements:
+            previous = None # Only if the template changed under it; start over
+
+        with self._stage('layout') as stage:
+            rows, data_formulas, extents = {}, {}, dict(self.template_extents)
+            for sheet_name, (start_row, _) in placements.items():
+                df = statement_dfs[sheet_name]
+                if not df.empty:
+                    # Same as the extents append_data_to_excel reports
+                    used_max_row, max_column = extents[sheet_name]
+                    extents[sheet_name] = (max(used_max_row, min(start_row + len(df) - 1, EXCEL_MAX_ROW)), max(max_column, min(df.shape[1], 50)))
+                if previous is not None and previous.frames[sheet_name] is df:
+                    rows[sheet_name], data_formulas[sheet_name] = previous.rows[sheet_name], previous.data_formulas[sheet_name]
+                    continue
+                num_rows = 0 if df.empty else max(0, min(len(df), EXCEL_MAX_ROW - start_row + 1))
+                sheet_rows, formula_cells = _statement_rows(df, num_rows)
+                rows[sheet_name] = sheet_rows
+                data_formulas[sheet_name] = [(start_row + offset, col) for offset, col in formula_cells]
+                stage.count(rows=num_rows, cells=num_rows * min(df.shape[1], 50))
+
+            if previous is not None and previous.end_rows == end_rows:
+                formulas = previous.formulas
+            else:
+                formulas, skipped_count = {}, 0
+                for sheet_name, row, col, formula, skipped in self.formula_rewrite_plan.rewrite(end_rows):
+                    formulas.setdefault(sheet_name, {})[row, col] = formula
+                    skipped_count += skipped
+                if skipped_count:
+                    logging.warning(f"{skipped_count} VLOOKUP range(s) left unadjusted: their sheet has no data end row")
+            view = PopulatedWorkbookView(self.wb_template_structure, placements, rows, formulas, extents)
+
+            changed_cells, dirty = {}, set()
+            values, lookup_indexes = {}, {}
+            if previous is not None:
+                for sheet_name, (start_row, _) in placements.items():
+                    changes = {} if rows[sheet_name] is previous.rows[sheet_name] else \
+                        self._changed_rows(sheet_name, start_row, previous.rows[sheet_name], rows[sheet_name])
+                    # Appended formulas can read anything, so they are always evaluated again
+                    for row, col in previous.data_formulas[sheet_name] + data_formulas[sheet_name]:
+                        changes.setdefault(row, set()).add(col)
+                    if changes:
+                        changed_cells[sheet_name] = changes
+                changed_formulas = []
+                if formulas is not previous.formulas:
+                    changed_formulas = [(sheet_name, row, col) for sheet_name, sheet_formulas in formulas.items()
+                                        for (row, col), formula in sheet_formulas.items()
+                                        if previous.formulas.get(sheet_name, {}).get((row, col)) != formula]
+                dirty = self.dependency_graph.affected(changed_cells, changed_formulas)
+                values = dict(previous.values)
+                for key in dirty:
+                    values.pop(key, None)
+                for sheet_name, changes in changed_cells.items():
+                    for row, cols in changes.items():
+                        for col in cols:
+                            values.pop((sheet_name, row, col), None)
+                touched_sheets = set(changed_cells) | {sheet_name for sheet_name, _, _ in dirty}
+                lookup_indexes = {key: index for key, index in previous.lookup_indexes.items() if key[0] not in touched_sheets}
+                logging.debug("Re-evaluating %d of %d template formulas after changes to %d cells", len(dirty),
+                              len(self.dependency_graph.formula_cells), sum(len(cols) for changes in changed_cells.values() for cols in changes.values()))
+            evaluator = FormulaEvaluator(view, values, lookup_indexes)
+
+        with self._stage('extract') as stage:
+            if previous is None:
+                sheets = self._extract_data_from_workbook(view, self.DISPLAY_CONFIGS, extents, format_values=False, stage=stage, evaluator=evaluator)
+                stage.count(rows=sum(len(sheet['data']) for sheet in sheets.values()),
+                            cells=sum(len(row) for sheet in sheets.values() for row in sheet['data']))
+            else:
+                stale = defaultdict(set) # Display cells to read again: {sheet: {(row, col)}}
+                for sheet_name, changes in changed_cells.items():
+                    stale[sheet_name].update((row, col) for row, cols in changes.items() for col in cols)
+                for sheet_name, row, col in dirty:
+                    stale[sheet_name].add((row, col))
+                sheets, reextract = {}, {}
+                for sheet_name, config in self.DISPLAY_CONFIGS.items():
+                    window = self._display_window(config, extents[sheet_name])
+                    if sheet_name not in previous.sheets or window != self._display_window(config, previous.extents[sheet_name]):
+                        reextract[sheet_name] = config
+                    else:
+                        sheets[sheet_name] = self._patch_display_sheet(sheet_name, previous.sheets[sheet_name], window, stale[sheet_name], evaluator, stage)
+                if reextract:
+                    sheets.update(self._extract_data_from_workbook(view, reextract, extents, format_values=False, stage=stage, evaluator=evaluator))
+                sheets = {sheet_name: sheets[sheet_name] for sheet_name in self.DISPLAY_CONFIGS}
+            self._report_formula_errors(evaluator, stage)
+        return StatementEvaluation(digests, statement_dfs, rows, data_formulas, placements, end_rows, formulas, extents,
+                                   evaluator._values, evaluator._lookup_indexes, sheets)
+
+    def _changed_rows(self, sheet_name, start_row, previous_rows, current_rows):
+        """
+        {row: set of columns} whose stored values differ between two versions of a sheet's appended
+        rows. Where only one version covers a cell, the other shows the template's cell there.
+        """
+        template_cells = self.wb_template_structure[sheet_name]._cells
+        def template_value(row, col):
+            cell = template_cells.get((row, col))
+            return cell.value if cell is not None else None
+        changes = {}
+        for offset in range(max(len(previous_rows), len(current_rows))):
+            row = start_row + offset
+            before = previous_rows[offset] if offset < len(previous_rows) else ()
+            after = current_rows[offset] if offset < len(current_rows) else ()
+            if len(before) != len(after):
+                width = max(len(before), len(after))
+                before = before + tuple(template_value(row, col) for col in range(len(before) + 1, width + 1))
+                after = after + tuple(template_value(row, col) for col in range(len(after) + 1, width + 1))
+            cols = _changed_columns(before, after)
+            if cols:
+                changes[row] = set(cols)
+        return changes
+
+    @staticmethod
+    def _patch_display_sheet(sheet_name, sheet, window, cells, evaluator, stage):
+        """
+        Copy of a previously extracted sheet ({'headers', 'data'}) with the display cells among
+        cells read again. Only the rows that change are copied; the previous sheet is left as it was.
+        """
+        min_col, max_col, header_row, first_row, last_row = window
+        headers, data = sheet['headers'], sheet['data']
+        copied_rows = set()
+        read_count = 0
+        for row, col in cells:
+            if not min_col <= col <= max_col:
+                continue
+            if row == header_row:
+                if headers is sheet['headers']:
+                    headers = list(headers)
+                headers[col - min_col] = evaluator.value(sheet_name, row, col)
+            elif first_row <= row <= last_row:
+                if data is sheet['data']:
+                    data = list(data)
+                offset = row - first_row
+                if offset not in copied_rows:
+                    data[offset] = list(data[offset])
+                    copied_rows.add(offset)
+                data[offset][col - min_col] = evaluator.value(sheet_name, row, col)
+            else:
+                continue
+            read_count += 1
+        stage.count(rows=len(copied_rows), cells=read_count)
+        return {'headers': headers, 'data': data}
+
+    def extract_statements(self, wb, extents=None):
+        """Raw values of the DISPLAY_CONFIGS ranges of a built workbook ({sheet: {'headers', 'data'}})."""
+        # Formulas are evaluated against the in-memory workbook; no save/reload round-trip
+        with self._stage('extract') as stage:
+            processed_data = self._extract_data_from_workbook(wb, self.DISPLAY_CONFIGS, extents, format_values=False, stage=stage)
+            for sheet in processed_data.values():
+                stage.count(rows=len(sheet['data']), cells=sum(len(row) for row in sheet['data']))
+        return processed_data
+
+    def store_result(self, result, statement_dfs=None):
+        """Saves a result to the statement store. A store failure is logged, not raised: the result itself is fine."""
+        try:
+            with self._stage('store'):
+                self.statement_store.upsert(result, statement_dfs)
+        except Exception as e:
+            logging.error(f"Could not store the result for {result['ticker']}: {e}", exc_info=True)
+
+    def rebuild_workbook(self, file_paths):
+        """Repeats the workbook part of process_files_for_web for the same inputs; returns (ticker, workbook)."""
+        ticker_symbol, file_map = self.classify_files(file_paths)
+        return ticker_symbol, self.download_workbook(file_map, self.load_statements(file_map))
+
+    def download_workbook(self, file_map, statement_dfs):
+        """The populated workbook offered for download: streamed from the template where possible, else built with openpyxl."""
+        return self.stream_workbook(statement_dfs) or self.build_workbook(file_map, statement_dfs)[0]
+
+    # Main processing method called by Flask
+    def process_files_for_web(self, file_paths):
+        """
+        Processes uploaded CSV files using the template and returns extracted data
+        suitable for web display. Doesn't save the final Excel file.
+        Inputs may be file paths, UploadedFile objects or readable file-like objects
+        with a filename (e.g. werkzeug FileStorage); everything else happens in memory.
+        """
+        return self.format_result_for_display(self.process_statements(file_paths))
+
+    def process_statements(self, file_paths):
+        """
+        Runs the pipeline and returns {'ticker', 'sheets', 'result_key'} with raw cell values
+        (numbers, datetimes, strings, None) in each sheet's rows. Results are cached by content,
+        and with an evaluation_cache a new upload for a ticker seen before only re-evaluates what changed.
+        """
+        ticker_symbol = None # Initialize ticker_symbol
+        started = time.perf_counter()
+
+        try:
+            ticker_symbol, file_map = self.classify_files(file_paths)
+
+            # --- Result Cache Lookup ---
+            # The content key identifies this result for the cache and for workbook downloads
+            with self._stage('cache_lookup'):
+                cache_key = self.result_cache_key(ticker_symbol, file_map)
+                cached_result = self.result_cache.get(cache_key) if self.result_cache is not None else None
+            if cached_result is not None:
+                logging.info("Result cache hit for ticker %s (%s)", ticker_symbol, cache_key[:12],
+                             extra={'fields': {'ticker': ticker_symbol, 'result_key': cache_key, 'cache_hit': True}})
+                if self.workbook_store is not None and cache_key not in self.workbook_store:
+                    # The store keeps fewer workbooks than the cache keeps results (and only this
+                    # process's); build this one again so the result's download link works
+                    self.workbook_store.add(cache_key, ticker_symbol, self.download_workbook(file_map, self.load_statements(file_map)),
+                                            inputs=list(file_map.values()))
+                return cached_result
+
+            # --- Evaluate Display Sheets ---
+            # Computed on a view of the template plus the statements; no workbook is built for it
+            logging.debug("Evaluating statements for web display...")
+            previous = self.evaluation_cache.get(ticker_symbol) if self.evaluation_cache is not None else None
+            evaluation = self.evaluate_statements(file_map, previous)
+            statement_dfs = evaluation.frames
+            if self.workbook_store is not None:
+                # Kept for the download link; only serialized if it is actually downloaded
+                self.workbook_store.add(cache_key, ticker_symbol, self.download_workbook(file_map, statement_dfs),
+                                        inputs=list(file_map.values()))
+
+            result = {'ticker': ticker_symbol, 'sheets': evaluation.sheets, 'result_key': cache_key}
+            if self.result_cache is not None:
+                self.result_cache.put(cache_key, result)
+            if self.evaluation_cache is not None:
+                self.evaluation_cache.put(ticker_symbol, evaluation)
+            if self.statement_store is not None:
+                self.store_result(result, statement_dfs)
+            # One summary line per upload; the per-stage detail is in the metrics and at DEBUG level
+            rows = sum(len(df) for df in statement_dfs.values())
+            elapsed = time.perf_counter() - started
+            logging.info("Processed %s (%s): %d statement rows in %.3fs", ticker_symbol, cache_key[:12], rows, elapsed,
+                         extra={'fields': {'ticker': ticker_symbol, 'result_key': cache_key, 'rows': rows,
+                                           'seconds': round(elapsed, 4), 'cache_hit': False,
+                                           'incremental': previous is not None}})
+            return result
+
+        except Exception as e:
+            logging.error(f"Error during web processing: {e}", exc_info=True) # Log traceback
+            raise # Re-raise the exception for Flask handler
+
+
+# --- JSON Output ---
+def _json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def columnar_statements(result):
+    """
+    Columnar form of a process_statements result: per sheet the headers, the label column and
+    one entry per remaining column holding its raw values (numbers stay numbers, dates become
+    ISO strings, blanks become null).
+    """
+    sheets = {}
+    for sheet_name, sheet in result['sheets'].items():
+        headers = [_json_value(header) for header in sheet['headers']]
+        columns = [[_json_value(row[i]) if i < len(row) else None for row in sheet['data']] for i in range(len(headers))]
+        sheets[sheet_name] = {
+            'headers': headers,
+            'label_header': headers[0] if headers else None,
+            'labels': columns[0] if columns else [],
+            'columns': [{'header': header, 'values': values} for header, values in zip(headers[1:], columns[1:])],
+        }
+    return {'ticker': result['ticker'], 'result_key': result['result_key'], 'sheets': sheets}
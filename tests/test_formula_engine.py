@@ -0,0 +1,141 @@
+"""
+Checks the formula engine, the streamed workbook writer and incremental re-evaluation against
+the openpyxl-built workbook, on the synthetic template and statements from
+benchmarks/generate_statements.py.
+
+    python -m unittest discover tests
+"""
+import csv
+import io
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from openpyxl import load_workbook # noqa: E402
+
+from generate_statements import write_statement_csvs, write_template # noqa: E402
+from processor import FinancialStatementProcessor, UploadedFile # noqa: E402
+
+
+def _comparable(value):
+    """Nested sheets/cell values with NaN made equal to itself and floats told apart from ints."""
+    if isinstance(value, dict):
+        return {key: _comparable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_comparable(item) for item in value]
+    if isinstance(value, float):
+        return ('float', 'nan' if math.isnan(value) else value)
+    return value
+
+
+def _cells(workbook_bytes):
+    """{sheet: {(row, column): (value, data type, number format)}} of a saved workbook."""
+    wb = load_workbook(io.BytesIO(workbook_bytes))
+    return {
+        ws.title: {coordinate: _comparable((cell.value, cell.data_type, cell.number_format))
+                   for coordinate, cell in ws._cells.items() if cell.value is not None or cell.has_style}
+        for ws in wb.worksheets
+    }
+
+
+def _edit_csv(data, edit):
+    rows = list(csv.reader(io.StringIO(data.decode())))
+    edit(rows)
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def _change_value(rows):
+    rows[3][-1] = "4,321"
+
+
+def _add_year(rows):
+    for index, row in enumerate(rows):
+        row.insert(2, "12/31/2099" if index == 0 else f"{index * 1000:,}")
+
+
+def _append_row(rows):
+    rows.append(["\tAddedItem "] + [f"({index + 1})" for index in range(len(rows[0]) - 1)])
+
+
+def _rename_line_item(rows):
+    rows[1][0] = "\tRenamedItem "
+
+
+class FormulaEngineTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.WARNING)
+        cls.folder = tempfile.mkdtemp()
+        cls.processor = FinancialStatementProcessor(write_template(os.path.join(cls.folder, 'template.xlsx')))
+        paths = write_statement_csvs(cls.folder, 'TEST', rows=30, seed=1)
+        cls.files = {}
+        for path in paths:
+            with open(path, 'rb') as csv_file:
+                cls.files[os.path.basename(path)] = csv_file.read()
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(cls.folder, ignore_errors=True)
+
+    def _file_map(self, files):
+        return self.processor.classify_files([UploadedFile(name, data) for name, data in files.items()])[1]
+
+    def _built_sheets(self, file_map):
+        wb, extents = self.processor.build_workbook(file_map, self.processor.load_statements(file_map))
+        return self.processor.extract_statements(wb, extents)
+
+    def test_evaluated_sheets_match_built_workbook(self):
+        file_map = self._file_map(self.files)
+        evaluation = self.processor.evaluate_statements(file_map)
+        self.assertEqual(_comparable(evaluation.sheets), _comparable(self._built_sheets(file_map)))
+
+    def test_streamed_workbook_matches_openpyxl_save(self):
+        self.assertIsNotNone(self.processor.output_writer, "template could not be prepared for streaming")
+        file_map = self._file_map(self.files)
+        statement_dfs = self.processor.load_statements(file_map)
+        wb, _ = self.processor.build_workbook(file_map, statement_dfs)
+        saved, streamed = io.BytesIO(), io.BytesIO()
+        wb.save(saved)
+        self.processor.stream_workbook(statement_dfs).save(streamed)
+        expected, actual = _cells(saved.getvalue()), _cells(streamed.getvalue())
+        self.assertEqual(list(actual), list(expected))
+        for sheet in expected:
+            with self.subTest(sheet=sheet):
+                self.assertEqual(actual[sheet], expected[sheet])
+
+    def test_incremental_evaluation_matches_fresh(self):
+        previous = self.processor.evaluate_statements(self._file_map(self.files))
+        names = sorted(self.files)
+        changes = [
+            ('change a value', {names[0]: _change_value}),
+            ('add a fiscal year', {names[1]: _add_year}),
+            ('append a line item', {names[2]: _append_row}),
+            ('rename a line item', {names[0]: _rename_line_item}),
+            ('change every file', {name: _change_value for name in names}),
+        ]
+        files = dict(self.files)
+        for label, edits in changes:
+            with self.subTest(change=label):
+                for name, edit in edits.items():
+                    files[name] = _edit_csv(files[name], edit)
+                file_map = self._file_map(files)
+                incremental = self.processor.evaluate_statements(file_map, previous)
+                fresh = self.processor.evaluate_statements(file_map)
+                self.assertEqual(_comparable(incremental.sheets), _comparable(fresh.sheets))
+                self.assertEqual(_comparable(incremental.sheets), _comparable(self._built_sheets(file_map)))
+                previous = incremental
+
+
+if __name__ == '__main__':
+    unittest.main()